@@ -1,11 +1,33 @@
-from time import sleep, time_ns
-from queue import Queue
-from threading import Thread, RLock
-from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM, SOL_SOCKET, SO_REUSEADDR
+from time import sleep, time_ns, monotonic, perf_counter
+from queue import Queue, Empty, Full
+from threading import Thread, RLock, Lock, Event
+from concurrent.futures import Future
+from socket import socket, socketpair, timeout as SocketTimeout, AF_INET, AF_UNIX, SOCK_STREAM, SOCK_DGRAM, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+from struct import Struct, error as StructError
 
+from urllib.parse import unquote
+
+import json
 import sys
 import os
 
+import keySpace
+from fingerTable import fingerTable, between, betweenRight, ownsKey
+from keySpace import distance
+from connPool import connPool
+from metrics import opStats, traceLog, writeAtomic, hopBuckets, ratioBuckets
+from objectStore import objectStore
+from lookupCache import lookupCache
+from iterativeLookup import iterativeLookup
+from failureDetector import failureDetector
+from membership import memberList, alive, left
+from chunkedFile import partialFile, fileDigests, readDigests
+from streamCodec import codecs, worthCompressing, zlibStream, zlibSink
+from nodeSnapshot import nodeSnapshot, recordedPeers, rejoinPlace
+from admission import admissionQueue, retryScheduler, priorityOf, backoff, \
+    queueLimit, busyRetries
+
 # all port are calculated based on __basePort
 basePort = 12000
 
@@ -17,11 +39,559 @@ basePort = 12000
 def toPort(knownNode):
     return basePort + knownNode + 1
 
+
+def toAddr(knownNode):
+    return ("127.0.0.1", toPort(knownNode))
+
+
+# returns hash number if filename is valid
+# otherwise returns None
+# the hash and the width of the ring are set in keySpace
+def toHash(filename):
+    key = keySpace.toKey(filename)
+    if key is None:
+        print("Invalid filename!")
+    return key
+
+
+# the control socket of peer ID, programs submit requests to a running
+# peer through it, see dhtClient.py
+def controlPath(dataDir, ID):
+    return os.path.join(dataDir, ".peer{0}.sock".format(ID))
+
+
+# the routing state of peer ID, kept up to date so that the peer
+# can restart where it was, see nodeSnapshot.py
+def snapshotPath(dataDir, ID):
+    return os.path.join(dataDir, ".peer{0}.snapshot".format(ID))
+
+
+# lists of names travel joined with ",", a "," or "%" in a name is
+# escaped as in a URL, names made of digits go as they are
+def joinNames(names):
+    return ",".join(name.replace("%", "%25").replace(",", "%2C")
+                    for name in names)
+
+
+def splitNames(text):
+    return [unquote(name) for name in text.split(",")] if text else []
+
+
+# a file received from a peer is written to dataDir/received_<name>
+# a name is hashed whatever it holds, but only a plain file name of
+# at most maxNameBytes becomes a path
+# raises ValueError for any other name
+maxNameBytes = 200
+
+
+def receivedPath(dataDir, filename):
+    if not filename or "\0" in filename or "/" in filename or \
+            os.sep in filename or \
+            os.altsep is not None and os.altsep in filename or \
+            len(filename.encode('utf-8')) > maxNameBytes:
+        raise ValueError("{0!r} cannot be a file name".format(filename))
+    return os.path.join(dataDir, "received_" + filename)
+
+
+# the name a transferred or fetched file is kept under
+# the sender names it along with the file, an older peer sends only the
+# file name, which is the name with an extension
+def transferName(content):
+    if "name" in content:
+        return content["name"]
+    return content["filename"].rsplit(".", 1)[0]
+
+
+# the content of the result request answering a submit,
+# the dict a future resolved with or the exception it raised
+# lists of names are joined by joinNames
+def resultContent(future):
+    try:
+        result = future.result()
+    except Exception as e:
+        return {"error": type(e).__name__,
+                "message": str(e.args[0]) if e.args else ""}
+    return dict((k, joinNames(str(x) for x in v) if isinstance(v, list)
+                 else v) for k, v in result.items())
+
+
+# what DHTNode._scan resolves with for the content of a scanned reply
+def scanResult(content):
+    names = splitNames(content["names"])
+    keys = content["keys"].split(",") if content["keys"] else []
+    return {"peer": int(content["_nodeID"]), "next": int(content["_firstID"]),
+            "second": int(content["_secondID"]), "names": names,
+            "keys": [int(k) for k in keys], "more": int(content["more"])}
+
+
+# is the ring narrow enough for the ports after basePort
+def checkRing():
+    if 2 * basePort + keySpace.ringSize + 1 > 65535:
+        raise ValueError("A ring of {0} IDs does not fit the ports "
+                         "after {1}".format(keySpace.ringSize, basePort))
+
+
+# framed requests start with frameMagic, a version byte and
+# the length of the body, so that many requests can share
+# one connection and a request can be followed by raw data
+frameMagic = b"DH"
+frameHeader = Struct("!2sBI")
+
+# versions of the frame body
+# frameText - the body is reqData.toString() in utf-8
+# frameBinary - the body is reqData.toBytes()
+frameText = 1
+frameBinary = 2
+
+# binary body:
+#   opcode, src, dst, stamp and the length of the schema
+#   the operation name if the opcode is 0
+#   the schema, "key:type,key:type" naming every field
+#   int values and the length of every str or bytes value
+#   str and bytes values one after another
+# the same schema is sent again and again, so its Struct is cached
+bodyHeader = Struct("!BiiQH")
+
+# types of a field value
+fieldInt = "i"
+fieldStr = "s"
+fieldBytes = "b"
+
+# schema -> (keys, types, Struct of the fixed part)
+schemaCache = dict()
+
+
+def compileSchema(schema: bytes):
+    entry = schemaCache.get(schema)
+    if entry is None:
+        keys, kinds = [], []
+        if schema:
+            for item in schema.decode('utf-8').split(","):
+                key, kind = item.rsplit(":", 1)
+                keys.append(key)
+                kinds.append(kind)
+        fixed = Struct("!" + "".join(
+            "q" if kind == fieldInt else "I" for kind in kinds))
+        entry = (keys, kinds, fixed)
+        if len(schemaCache) < 1024:
+            schemaCache[schema] = entry
+    return entry
+
+# opcode of every operation is its index + 1
+# only append to this list, the position is sent on the wire
+oprCodes = ["ping", "join", "quit", "abrupt", "store", "request",
+            "transfer", "update", "exit", "lookup", "found", "ready",
+            "handoff", "pull", "replicate", "stored", "missing",
+            "batch", "batched", "manifest", "fetch", "chunk",
+            "hop", "hopped", "submit", "result", "stats", "busy",
+            "stabilize", "stabilized", "scan", "scanned", "unrouted"]
+oprNames = dict((opr, i + 1) for i, opr in enumerate(oprCodes))
+
+# content fields holding a peer ID or a number
+# text content is untyped, these fields are parsed into int
+intFields = {"_nodeID", "_firstID", "_secondID", "leaveNode",
+             "key", "slot", "viaFinger", "size", "batch", "batches",
+             "ttl", "direct", "lo", "ack", "hops", "chunk", "offset",
+             "relay", "incarnation", "next", "owner", "backup", "attempt",
+             "pred", "hi", "limit", "more", "hopsLeft"}
+
+# a transfer is received into a preallocated buffer of this size
+transferBuffer = 1 << 20
+
+# a file larger than chunkSize is sent as a manifest of chunk hashes,
+# and fetched in chunks over up to transferStreams connections
+chunkSize = 4 << 20
+transferStreams = 4
+
+# a peer serves this many fetching streams at once, and lets as many
+# more wait, a fetch beyond them is refused busy and its downloader
+# turns to the next holder
+# downloads of manifests received here run downloadWorkers at a time
+fetchWorkers = 8
+downloadWorkers = 2
+
+# every ping round also gossips to this many random members
+gossipFanout = 1
+
+# keys are handed over to another peer this many names per request
+handoffBatch = 512
+
+# every key is copied to this many successors of its owner
+replicaFactor = 2
+
+# a replica whose key no longer falls to one of the replicaFactor peers
+# before us was dropped from its owner's chain, it is removed after
+# this many seconds
+replicaExpiry = 30.0
+
+# an iterative lookup asks this many peers at once for the next hop,
+# and gives up on a peer which did not answer within hopTimeout seconds
+lookupParallel = 2
+hopTimeout = 1.0
+
+# a join, store, request, batch or lookup is forwarded at most this
+# many times, more than a walk from successor to successor round a
+# ring of that many peers takes, a request still on its way after that
+# went round in circles and fails
+routeTTL = 128
+
+# a joining peer nobody placed after this many seconds gives up
+joinTimeout = 30
+
+# every peer asks its successor for the successor's predecessor this
+# often, and adopts it if it sits between them, so that pointers
+# left wrong by joins at the same place of the ring are repaired
+stabilizeInterval = 1.0
+
+# a scan lists the keys of a peer this many names per page by default,
+# and never more than scanPageMax, waiting scanTimeout seconds for a page
+scanPageSize = 1000
+scanPageMax = 10000
+scanTimeout = 10
+
+# an old receiver never says it is ready,
+# the file is sent anyway after this many seconds
+readyTimeout = 3
+
+
+# send the transfer request req and then the file at path on sock
+# the receiver replies ready once it is reading the file, so the
+# request and the file never arrive in the same read
+# a file worth compressing at level is offered as a zlib stream,
+# and compressed if the ready reply accepts it
+# otherwise the file is sent by the kernel without copying it
+# through python
+# returns the number of bytes of the file sent, the seconds it took
+# and the zlibStream if it was compressed, else None
+def sendFile(sock, req, path, level=0):
+    req.setContent(size=os.path.getsize(path))
+    if worthCompressing(path, level):
+        req.setContent(codec="zlib")
+    sock.sendall(req.toFrame())
+
+    decoder = frameDecoder()
+    ready = None
+    sock.settimeout(readyTimeout)
+    try:
+        ready = decoder.next()
+        while ready is None:
+            data = sock.recv(4096)
+            if not data:
+                raise ConnectionError("Receiver closed the transfer")
+            decoder.feed(data)
+            ready = decoder.next()
+    except SocketTimeout:
+        pass
+    sock.settimeout(None)
+
+    begin = perf_counter()
+    if ready is not None and ready.getContent().get("codec") == "zlib":
+        stream = zlibStream(path, level)
+        for block in stream.blocks():
+            sock.sendall(block)
+        return stream.raw, perf_counter() - begin, stream
+    with open(path, "rb") as file:
+        sent = sock.sendfile(file)
+    return sent, perf_counter() - begin, None
+
+
+# receive a file sent by sendFile on sock into path
+# payload is what was read together with the transfer request
+# without a size the file ends when the sender closes the connection
+# returns the number of bytes received and the seconds it took
+def recvFile(sock, path, size=None, payload=b""):
+    bufferSize = transferBuffer if size is None \
+        else max(1, min(transferBuffer, size - len(payload)))
+    buffer = memoryview(bytearray(bufferSize))
+    begin = perf_counter()
+    received = len(payload)
+    with open(path, "wb") as file:
+        file.write(payload)
+        while size is None or received < size:
+            want = len(buffer) if size is None \
+                else min(len(buffer), size - received)
+            n = sock.recv_into(buffer, want)
+            if n == 0:
+                break
+            file.write(buffer[:n])
+            received += n
+    return received, perf_counter() - begin
+
+
+# receive a zlib stream sent by sendFile on sock into path
+# returns the number of bytes of the file received, the seconds it
+# took and the zlibSink
+def recvCompressed(sock, path, payload=b""):
+    buffer = memoryview(bytearray(transferBuffer))
+    begin = perf_counter()
+    with open(path, "wb") as file:
+        sink = zlibSink(file)
+        if payload:
+            sink.feed(payload)
+        while not sink.done:
+            n = sock.recv_into(buffer)
+            if n == 0:
+                break
+            sink.feed(buffer[:n])
+    return sink.raw, perf_counter() - begin, sink
+
+
+# send size bytes at offset of the file at path on sock
+# the chunk request telling the size is followed by the bytes
+# returns the bytes of the file sent, fewer than size past its end
+def sendRange(sock, req, path, offset, size):
+    size = max(0, min(size, os.path.getsize(path) - offset))
+    sock.sendall(reqData("chunk", req.dst, req.src,
+                         {"offset": offset, "size": size},
+                         req.stamp).toFrame())
+    if size == 0:
+        return 0
+    with open(path, "rb") as file:
+        return sock.sendfile(file, offset, size)
+
+
+# ask peer for size bytes at offset of filename on sock
+# decoder keeps what was read after the bytes of the chunk
+# returns the bytes, raises KeyError if peer does not have the file
+def fetchRange(sock, decoder, src, peer, filename, name, offset, size):
+    sock.sendall(reqData("fetch", src, peer,
+                         {"_nodeID": src, "filename": filename, "name": name,
+                          "offset": offset, "size": size}).toFrame())
+    reply = decoder.next()
+    while reply is None:
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionError("Peer {} closed the fetch".format(peer))
+        decoder.feed(data)
+        reply = decoder.next()
+    if reply.opr == "busy":
+        raise ConnectionRefusedError("Peer {} is busy".format(peer))
+    if reply.opr != "chunk":
+        raise KeyError(filename)
+
+    size = int(reply.getContent()["size"])
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    payload = decoder.rest()[:size]
+    view[:len(payload)] = payload
+    received = len(payload)
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise ConnectionError("Peer {} closed the fetch".format(peer))
+        received += n
+    return buffer
+
+
+# ask peer for a page of the keys it keeps in (lo, hi],
+# following the name after, see objectStore.page
+# returns the content of its scanned reply
+def scanPage(src, peer, lo, hi, limit, after, stamp, timeout):
+    content = {"_nodeID": src, "lo": lo, "hi": hi, "limit": limit}
+    if after is not None:
+        content["after"] = after
+    with socket(AF_INET, SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(toAddr(peer))
+        sock.sendall(reqData("scan", src, peer, content, stamp).toFrame())
+        decoder = frameDecoder()
+        reply = decoder.next()
+        while reply is None:
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError("Peer {} closed the scan".format(peer))
+            decoder.feed(data)
+            reply = decoder.next()
+    if reply.opr == "busy":
+        raise ConnectionRefusedError("Peer {} is busy".format(peer))
+    return reply.getContent()
+
+
+# the successors our keys are copied to, as far as we know them
+def replicaChain(nodeID, first, second, replicaCount):
+    chain = []
+    for peer in (first, second):
+        if peer != nodeID and peer not in chain:
+            chain.append(peer)
+    return tuple(chain[:replicaCount])
+
+
+# the peers of chain which were not in old, each with the ttl of the
+# replicate request it gets, the last one we know passes it on to the
+# successors we do not know
+def chainAdditions(old, chain, replicaCount):
+    return [(peer, 1 if i < len(chain) - 1 else replicaCount - i)
+            for i, peer in enumerate(chain) if old is None or peer not in old]
+
+
+# the first limit entries of the pages listed from lo, each name once
+def mergePages(lo, limit, *pages):
+    entries = dict()
+    for page in pages:
+        for entry in page:
+            entries.setdefault(entry.name, entry)
+    return sorted(entries.values(), key=lambda e: (
+        distance(lo, e.key) or keySpace.ringSize, e.name))[:limit]
+
+
+# the range of the keys of a suspected or dead predecessor pred, which
+# its successor answers for from its replicas until they are promoted
+# returns None while pred is alive
+def orphanRange(members, pred, nodeID):
+    if pred is None or members.state(pred) in (None, alive):
+        return None
+    peers = [p for p in members.alivePeers() if p not in (nodeID, pred)]
+    if len(peers) == 0:
+        return nodeID, nodeID
+    return min(peers, key=lambda p: distance(p, nodeID)), pred
+
+
+# ask every peer in peers for its best next hop towards key
+# the queries go out at once, each on a connection of its own
+# returns peer -> content of its hopped reply for the peers which
+# answered within timeout seconds
+def askHops(src, peers, key, stamp, timeout):
+    selector = DefaultSelector()
+    replies = dict()
+    for peer in peers:
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.setblocking(False)
+        sock.connect_ex(toAddr(peer))
+        frame = reqData("hop", src, peer, {"_nodeID": src, "key": key},
+                        stamp).toFrame()
+        selector.register(sock, EVENT_WRITE, [peer, frame, frameDecoder()])
+
+    deadline = monotonic() + timeout
+    while selector.get_map():
+        left = deadline - monotonic()
+        if left <= 0:
+            break
+        for entry, mask in selector.select(left):
+            sock = entry.fileobj
+            peer, frame, decoder = entry.data
+            try:
+                if mask & EVENT_WRITE:
+                    entry.data[1] = frame[sock.send(frame):]
+                    if not entry.data[1]:
+                        selector.modify(sock, EVENT_READ, entry.data)
+                    continue
+                data = sock.recv(4096)
+                if not data:
+                    raise ConnectionError()
+                decoder.feed(data)
+                reply = decoder.next()
+                if reply is None:
+                    continue
+                replies[peer] = reply.getContent()
+            except (OSError, ValueError):
+                pass
+            selector.unregister(sock)
+            sock.close()
+
+    for entry in list(selector.get_map().values()):
+        entry.fileobj.close()
+    selector.close()
+    return replies
+
+
+# the opr requests moving names from src to dst,
+# fields are added to the content of every request
+# names are joined by joinNames
+def nameBatches(opr, src, dst, names, **fields):
+    names = sorted(names)
+    batches = (len(names) + handoffBatch - 1) // handoffBatch
+    for i in range(batches):
+        content = {
+            "_nodeID": src,
+            "names": joinNames(names[i * handoffBatch:
+                                     (i + 1) * handoffBatch]),
+            "batch": i + 1, "batches": batches}
+        content.update(fields)
+        yield reqData(opr, src, dst, content)
+
+
+# the filenames listed in a manifest file, one per line
+# blank lines and lines starting with # are skipped,
+# "0042.txt" stands for file 0042, and only the last extension comes
+# off, "report.v2.txt" stands for report.v2
+def readManifest(path):
+    names = []
+    with open(path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                names.append(line.rsplit(".", 1)[0])
+    return names
+
+
+# the names of a store or request command,
+# an argument starting with @ is a manifest file
+def commandNames(args):
+    names = []
+    for arg in args:
+        if arg.startswith("@"):
+            names.extend(readManifest(arg[1:]))
+        else:
+            names.append(arg)
+    return names
+
+
+# a callback printing how a request submitted from the terminal ended
+def printAnswer(opr, filename):
+    def done(future):
+        try:
+            result = future.result()
+        except KeyError:
+            print("File {0} is not in the DHT".format(filename))
+            return
+        except Exception as e:
+            print("{0} {1} failed: {2}".format(opr, filename, e))
+            return
+        print("\n ---- {0} {1} done by Peer {2} in {3:.3f} s, "
+              "{4} hops ----".format(opr, filename, result["peer"],
+                                     result["seconds"], result["hops"]))
+    return done
+
+
+# a callback printing how a batch submitted from the terminal ended
+def printBatch(opr):
+    def done(future):
+        try:
+            result = future.result()
+        except Exception as e:
+            print("Batch {0} failed: {1}".format(opr, e))
+            return
+        print("\n ---- Batch {0} done: {1} files on {2} peers in "
+              "{3:.3f} s, at most {4} hops ----".format(
+                  opr, result["done"], result["peers"],
+                  result["seconds"], result["hops"]))
+        if result["missing"]:
+            print("Missing: " + ",".join(result["missing"]))
+        if result["unanswered"]:
+            print("No answer for: " + ",".join(result["unanswered"]))
+    return done
+
+
+# human-readable throughput
+def rate(size, seconds):
+    return "{0:.2f} MB/s".format(size / max(seconds, 1e-9) / 1e6)
+
+
+# operations changing the routing state
+# they are handled one by one in the order they arrived
+routingOprs = {"update", "join", "quit", "abrupt", "stabilize", "stabilized"}
+
+# operations holding their connection while they wait, a busy peer
+# refuses them beyond admission.heldLimit
+# a transfer answers a request of the receiver and is never refused,
+# its sender does not read the connection
+heldOprs = {"fetch", "scan"}
+
 # a data class for data transferring
 
 
 class reqData(object):
-    def __init__(self, opr: str, src: int, dst: int, content="", stamp=time_ns()):
+    def __init__(self, opr: str, src: int, dst: int, content="", stamp=None):
         # operation:
         # ping - ping other nodes
         # join quit abrupt - a node join or quit(graceful) the DHT
@@ -36,10 +606,29 @@ class reqData(object):
         self.dst = dst
 
         # data within the request
-        self.content = content
+        # either a "key: value, key: value" string or a dict,
+        # a string is only parsed the first time it is read
+        self._text = None
+        self._fields = None
+        if isinstance(content, dict):
+            self._fields = dict(content)
+        else:
+            self._text = content
 
         # a unique ID for a request
-        self.stamp = stamp
+        # it is kept unchanged while the request is forwarded
+        self.stamp = time_ns() if stamp is None else stamp
+
+        # raw bytes which followed the request on its connection
+        self.payload = b""
+
+    # content in the "key: value, key: value" text form
+    @property
+    def content(self):
+        if self._text is None:
+            self._text = ", ".join("{0}: {1}".format(k, v)
+                                   for k, v in self._fields.items())
+        return self._text
 
     # construct a reqData object frm given string
     @classmethod
@@ -53,19 +642,103 @@ class reqData(object):
                           str(self.dst), self.content, str(self.stamp)))
         return sz
 
+    # construct a reqData object from a binary body
+    @classmethod
+    def fromBytes(cls, data: bytes):
+        code, src, dst, stamp, size = bodyHeader.unpack_from(data)
+        pos = bodyHeader.size
+        if code == 0:
+            nameSize = data[pos]
+            opr = data[pos + 1:pos + 1 + nameSize].decode('utf-8')
+            pos += 1 + nameSize
+        else:
+            opr = oprCodes[code - 1]
+
+        keys, kinds, fixed = compileSchema(data[pos:pos + size])
+        pos += size
+        values = fixed.unpack_from(data, pos)
+        pos += fixed.size
+
+        fields = dict(zip(keys, values))
+        for key, kind, value in zip(keys, kinds, values):
+            if kind != fieldInt:
+                raw = data[pos:pos + value]
+                pos += value
+                fields[key] = raw.decode('utf-8') \
+                    if kind == fieldStr else raw
+        if pos != len(data):
+            raise ValueError("Invalid frame body")
+
+        req = cls(opr, src, dst, stamp=stamp)
+        req._fields = fields
+        return req
+
+    # transform a reqData object to a binary body
+    def toBytes(self):
+        schema, values, tail = [], [], []
+        for key, value in self.getContent().items():
+            if isinstance(value, int):
+                schema.append(key + ":" + fieldInt)
+                values.append(value)
+                continue
+            if isinstance(value, bytes):
+                schema.append(key + ":" + fieldBytes)
+            else:
+                schema.append(key + ":" + fieldStr)
+                value = str(value).encode('utf-8')
+            values.append(len(value))
+            tail.append(value)
+        schema = ",".join(schema).encode('utf-8')
+        fixed = compileSchema(schema)[2]
+
+        code = oprNames.get(self.opr, 0)
+        parts = [bodyHeader.pack(code, self.src, self.dst,
+                                 self.stamp, len(schema))]
+        if code == 0:
+            name = self.opr.encode('utf-8')
+            parts.append(bytes((len(name),)) + name)
+        parts.append(schema)
+        parts.append(fixed.pack(*values))
+        parts.extend(tail)
+        return b"".join(parts)
+
     # return the a dict relating to the content of this req
     def getContent(self):
-        kv = dict()
-        for s in self.content.split(", "):
-            item = s.split(": ")
-            kv[item[0]] = item[1]
-        return kv
+        if self._fields is None:
+            kv = dict()
+            if self._text:
+                for s in self._text.split(", "):
+                    item = s.split(": ")
+                    if item[0] in intFields:
+                        kv[item[0]] = int(item[1])
+                    else:
+                        kv[item[0]] = item[1]
+            self._fields = kv
+        return self._fields
+
+    # replace or add some key-value pairs of the content
+    def setContent(self, **kwargs):
+        self.getContent().update(kwargs)
+        self._text = None
+
+    # transform a reqData object to a frame
+    def toFrame(self, version=frameBinary):
+        if version == frameText:
+            body = self.toString().encode('utf-8')
+        else:
+            body = self.toBytes()
+        return frameHeader.pack(frameMagic, version, len(body)) + body
 
     # execute the request
-    def fulfill(self, addr="127.0.0.1"):
+    # with a pool the request shares a long-lived connection,
+    # otherwise a new connection is returned for the caller to use
+    def fulfill(self, pool=None, addr="127.0.0.1"):
+        if pool is not None:
+            pool.send(self.dst, self.toFrame())
+            return None
         reqSocket = socket(AF_INET, SOCK_STREAM)
         reqSocket.connect((addr, toPort(self.dst)))
-        reqSocket.send(self.toString().encode('utf-8'))
+        reqSocket.sendall(self.toFrame())
         return reqSocket
 
     # human-readable printing for terminal
@@ -76,24 +749,124 @@ class reqData(object):
             "Timestamp: {0}\n".format(self.stamp) + \
             "Content: {0}\n".format(self.content)
 
+# splits the bytes read from a connection into requests
+# it keeps partial requests until the rest arrives and
+# returns several requests read at once one by one
+# a connection which does not start with frameMagic comes from
+# an old peer and carries exactly one unframed request
+
+
+class frameDecoder(object):
+    def __init__(self):
+        self._buffer = bytearray()
+
+        # where the next request starts in self._buffer
+        self._offset = 0
+
+        # None until the first two bytes arrived
+        self.legacy = None
+
+    def feed(self, data):
+        # drop the requests already returned before growing
+        if self._offset > 0:
+            del self._buffer[:self._offset]
+            self._offset = 0
+        self._buffer += data
+
+    # the next complete request, None if more bytes are needed
+    # raise ValueError if the bytes are not a request
+    def next(self):
+        if self.legacy is None:
+            if len(self._buffer) < len(frameMagic):
+                return None
+            self.legacy = self._buffer[:len(frameMagic)] != frameMagic
+
+        if self.legacy:
+            if len(self._buffer) == 0:
+                return None
+            content = self._buffer.decode('utf-8')
+            self._buffer.clear()
+            return reqData.fromString(content)
+
+        start = self._offset
+        if len(self._buffer) - start < frameHeader.size:
+            return None
+        magic, version, length = frameHeader.unpack_from(self._buffer, start)
+        if magic != frameMagic:
+            raise ValueError("Invalid frame")
+        begin = start + frameHeader.size
+        end = begin + length
+        if len(self._buffer) < end:
+            return None
+        body = bytes(self._buffer[begin:end])
+        self._offset = end
+
+        try:
+            if version == frameBinary:
+                return reqData.fromBytes(body)
+            if version == frameText:
+                return reqData.fromString(body.decode('utf-8'))
+        except (IndexError, UnicodeDecodeError, StructError) as e:
+            raise ValueError("Invalid frame body") from e
+        raise ValueError("Unknown frame version {}".format(version))
+
+    # the bytes left after the last request
+    def rest(self):
+        data = bytes(self._buffer[self._offset:])
+        self._buffer.clear()
+        self._offset = 0
+        return data
+
 # the object stands for the node
 
 
 class DHTNode(object):
     # constructor
-    def __init__(self, ID, pingInterval):
-        # Local hash table that this peer keeps
-        self.localHashTable = dict()
-
+    def __init__(self, ID, pingInterval, workers=4, dataDir=None,
+                 replicas=replicaFactor, cacheFiles=0, interactive=True,
+                 verbose=True, metricsDir=None, traceSample=0,
+                 compressLevel=0, control=False, queueLimit=queueLimit,
+                 stabilizeInterval=stabilizeInterval):
         # initialize the nodeID
         self._nodeID = ID
 
+        # files this peer keeps track of, indexed by name and hash
+        # the index survives restarts in a file next to the data
+        self._dataDir = dataDir if dataDir is not None else os.getcwd()
+        self._store = objectStore(self._dataDir, os.path.join(
+            self._dataDir, ".peer{0}.index".format(ID)), toHash)
+
+        # copies of the keys owned by the peers before this one,
+        # and the successors our own keys were copied to last
+        self._replicaCount = replicas
+        self._replicas = objectStore(self._dataDir, os.path.join(
+            self._dataDir, ".peer{0}.replicas".format(ID)), toHash)
+        self.__replicaChain = None
+        # replica name -> when its key was first seen outside our range
+        self.__strays = dict()
+
+        # our successors, predecessor and fingers, read back by a restart
+        self._snapshot = nodeSnapshot(snapshotPath(self._dataDir, ID))
+
+        # owners of the keys we requested, and the last cacheFiles
+        # files we fetched, so that hot keys skip the ring walk
+        self._cache = lookupCache(fileCapacity=cacheFiles)
+
+        # files we send are offered as zlib streams at this level,
+        # 0 sends them as they are
+        self._compressLevel = compressLevel
+
         # initialize the firstSuccessor
         self._firstID = 0
 
         # initialize the secondSuccessor
         self._secondID = 0
 
+        # the predecessor as told by the peers stabilizing with us,
+        # None until one did, the closest peer pinging us stands in
+        self._predID = None
+        self._stabilizeInterval = stabilizeInterval
+
         # setup ping interval
         self._pingInterval = int(pingInterval)
 
@@ -103,20 +876,100 @@ class DHTNode(object):
         # a lock for thread
         self.__lock = RLock()
 
-        # countdown for abrupt quit
-        self.__lossCount = dict()
+        # long-lived connections to other nodes
+        # the producer reads whatever the peers send back on them
+        self._pool = connPool(toAddr, onConnect=self.__watch)
 
-        # We uses producer-consumer model for processing request
-        # therefore, we need to set up a thread-safe queue
-        self._operationQueue = Queue()
+        # connections the producer has to start watching
+        # and a socket pair waking the producer up
+        self.__pendingConns = []
+        self.__wakeReader, self.__wakeWriter = socketpair()
+
+        # set once the first update after a join arrives,
+        # which also tells the joining peer its predecessor
+        self.__joined = Event()
+        self.__joinPred = None
+        self.__joinError = None
+        # joins sent here before we knew our successors
+        self.__deferredJoins = []
+
+        # joining peer -> stamp of the last join of it we placed,
+        # and ours of our own join, a copy of either is dropped
+        self.__joinStamps = dict()
+
+        # peer -> number of handoff batches received from it
+        self.__handoffs = dict()
+
+        # path -> Event set once the chunked download to path ended
+        self.__downloads = dict()
+
+        # watches the peers pinging us, the closest one is
+        # our predecessor and a silent one left abruptly
+        self._detector = failureDetector(self._pingInterval)
 
-        # set up ping listener
-        self._pingListenerThread = Thread(
-            target=self.__pingListenerLoop, name="ping listener", daemon=True)
+        # every peer we heard of, kept up to date by gossip
+        # piggybacked on the pings
+        self._members = memberList(
+            ID, suspectTimeout=max(10, 3 * self._pingInterval))
 
-        # set up ping sender
-        self._pingSenderThread = Thread(
-            target=self.__pingSenderLoop, name="ping sender", daemon=True)
+        # Chord-style fingers used to shortcut lookups
+        self._fingers = fingerTable(ID)
+
+        # We uses producer-consumer model for processing request
+        # therefore, we need to set up a thread-safe queue
+        # it hands out requests by priority, and refuses new store
+        # and request work with a busy reply once queueLimit are waiting
+        self._operationQueue = admissionQueue(queueLimit)
+        # refused requests of our own wait here for their next attempt
+        self._retries = retryScheduler()
+
+        # the consumer hands requests changing the routing state to
+        # a single routing worker, and the rest to a pool of workers
+        # the work queue is short, requests wait in the operation queue
+        # where they are ordered by priority
+        self._routingQueue = Queue()
+        self._workQueue = Queue(maxsize=workers)
+        self._routingThread = Thread(
+            target=self.__workerLoop, args=(self._routingQueue,),
+            name="routing worker", daemon=True)
+        self._workerThreads = [
+            Thread(target=self.__workerLoop, args=(self._workQueue,),
+                   name="worker {}".format(i), daemon=True)
+            for i in range(workers)]
+
+        # a fetch or a download holds its thread while the file moves,
+        # they get pools of their own so that they do not hold the workers
+        self._fetchQueue = Queue(maxsize=fetchWorkers)
+        self._fetchThreads = [
+            Thread(target=self.__workerLoop, args=(self._fetchQueue,),
+                   name="fetch {}".format(i), daemon=True)
+            for i in range(fetchWorkers)]
+        self._downloadQueue = Queue()
+        self._downloadThreads = [
+            Thread(target=self.__workerLoop, args=(self._downloadQueue,),
+                   name="download {}".format(i), daemon=True)
+            for i in range(downloadWorkers)]
+
+        # queue depth and latency of every operation, written to
+        # metricsDir/peer<ID>.prom every ping interval
+        self._stats = opStats()
+        self._metricsDir = metricsDir
+        if metricsDir is not None:
+            os.makedirs(metricsDir, exist_ok=True)
+
+        # one request stamp in traceSample is followed through the ring
+        # in metricsDir/trace<ID>.jsonl
+        self._trace = None
+        if metricsDir is not None and traceSample > 0:
+            self._trace = traceLog(os.path.join(
+                metricsDir, "trace{0}.jsonl".format(ID)), traceSample)
+
+        # set up the thread sending and receiving pings
+        # pings and the handling of every request are printed
+        # when verbose
+        self._verbose = verbose
+        self._pingThread = Thread(
+            target=self.__pingLoop, name="ping loop", daemon=True)
 
         # set up producer thread
         self._producerThread = Thread(
@@ -127,54 +980,74 @@ class DHTNode(object):
             target=self.__consumerLoop, name="consumer thread")
 
         # set up a thread dedicated in listenning user input
+        # a peer driven by a program reads no commands
+        self._interactive = interactive
         self._commandListenerThread = Thread(
             target=self.__commandListenerLoop, name="command listener")
 
+        # programs connect to the control socket to submit requests
+        self._controlPath = controlPath(self._dataDir, ID) if control \
+            else None
+        self.__controlSocket = None
+
+        # stamp -> (future, time submitted) of every store and
+        # request submitted here which is not answered yet
+        self.__pending = dict()
+        self.__pingSocket = None
+
+        # stamp -> what came back so far of every batch submitted here
+        self.__batches = dict()
+
+        # set up a thread refreshing the finger table
+        self._fingerThread = Thread(
+            target=self.__fingerLoop, name="finger fixer", daemon=True)
+
+        # and one stabilizing the successors
+        self._stabilizeThread = Thread(
+            target=self.__stabilizeLoop, name="stabilizer", daemon=True)
+
     # start node service
     def start(self, startType, *, knownNode=None, fst=None, snd=None):
 
         # TCP socket accepting connection from other nodes
         self.__nodeSocket = socket(AF_INET, SOCK_STREAM)
+        self.__nodeSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         self.__nodeSocket.bind(("127.0.0.1", self._nodePort))
         self.__nodeSocket.listen()
 
-        # start with argument init or join
-        if startType == "init":
-            self._firstID = fst
-            self._secondID = snd
-        elif startType == "join":
-            # send a join request to the known node
-            joinSocket = reqData("join", self._nodeID,
-                                 knownNode, "_nodeID: {}".format(
-                                     self._nodeID)).fulfill()
-            reply = str()
-
-            try:
-                while True:
-                    conn, addr = self.__nodeSocket.accept()
-                    reply = conn.recv(4096).decode('utf-8').strip()
-                    if reply != "":
-                        print("\n ---- Join request has been accepted ----")
-                        conn.close()
-                        break
-
-            except Exception:
-                joinSocket.close()
-            finally:
-                joinSocket.close()
+        # the reply of a join may come back on any connection,
+        # so requests are handled before the join is sent
+        self._producerThread.start()
+        self._consumerThread.start()
 
-            content = reqData.fromString(reply).getContent()
-            self._firstID = int(content["_firstID"])
-            self._secondID = int(content["_secondID"])
-            print("My first successor ID is {}".format(self._firstID))
-            print("My second successor ID is {}".format(self._secondID))
+        # start with argument init or join
+        # a peer which did not get into the ring stops the threads
+        # started above, they would keep the process alive
+        try:
+            if startType == "init":
+                self._firstID = fst
+                self._secondID = snd
+                self.__joined.set()
+            elif startType == "join":
+                self.__join(knownNode)
+            elif startType == "restart":
+                self.__restart(knownNode)
+        except Exception:
+            self.halt()
+            raise
+
+        # one UDP socket sends and receives every ping
+        self.__pingSocket = socket(AF_INET, SOCK_DGRAM)
+        self.__pingSocket.bind(("127.0.0.1", basePort + self._nodePort))
 
         # start all the threads
-        self._producerThread.start()
-        self._consumerThread.start()
-        self._pingListenerThread.start()
-        self._pingSenderThread.start()
-        self._commandListenerThread.start()
+        self._pingThread.start()
+        if self._interactive:
+            self._commandListenerThread.start()
+        self._fingerThread.start()
+        self._stabilizeThread.start()
+        if self._controlPath is not None:
+            self.__listenControl()
 
         # print log
         print("Start peer {0} at port {1}".format(
@@ -183,29 +1056,314 @@ class DHTNode(object):
               + "{0} and second successor on port {1}".format(
             self._firstPort, self._secondPort))
 
+    # send a join request to the known node
+    # and wait for the update from the predecessor
+    def __join(self, knownNode):
+        begin = monotonic()
+        req = reqData("join", self._nodeID, knownNode,
+                      {"_nodeID": self._nodeID})
+        self.__joinStamps[self._nodeID] = req.stamp
+        req.fulfill(self._pool)
+        if not self.__joined.wait(joinTimeout):
+            raise TimeoutError("Nobody placed Peer {0} joining through "
+                               "Peer {1}".format(self._nodeID, knownNode))
+        if self.__joinError is not None:
+            raise self.__joinError
+        self._stats.observe("joinSeconds", monotonic() - begin)
+        print("\n ---- Join request has been accepted ----")
+
+        # the keys between the predecessor and this peer
+        # are kept by the successor until now
+        if self.__joinPred is not None:
+            reqData("pull", self._nodeID, self._firstID,
+                    {"_nodeID": self._nodeID, "key": self.__joinPred,
+                     "incarnation": self._members.incarnation}
+                    ).fulfill(self._pool)
+
+    # take back the place saved in our snapshot
+    # the predecessor and successors we had are asked for their
+    # successors at once, and if nobody joined in between the
+    # predecessor is told to point to us again and the first successor
+    # to give our keys back, without walking the ring
+    # otherwise we join through one of them, or through knownNode
+    def __restart(self, knownNode=None):
+        begin = monotonic()
+        state = self._snapshot.load()
+        peers, replies = [], dict()
+        if state is not None:
+            peers = recordedPeers(state, self._nodeID)
+            self._stats.count("hopQueries", len(peers))
+            replies = askHops(self._nodeID, peers, self._nodeID,
+                              time_ns(), hopTimeout)
+        place = None if state is None else \
+            rejoinPlace(state, self._nodeID, replies)
+
+        if place is None:
+            self._stats.count("coldRestarts")
+            live = [p for p in peers if p in replies]
+            if live:
+                knownNode = live[0]
+            if knownNode is None:
+                raise ConnectionError(
+                    "No peer of the snapshot of Peer {0} answered".format(
+                        self._nodeID))
+            print("Snapshot is stale, join through Peer {0}".format(
+                knownNode))
+            self.__join(knownNode)
+            return
+
+        pred, first, second = place
+        with self.__lock:
+            self._firstID, self._secondID = first, second
+            self._predID = pred
+            self._fingers.restore(state["fingers"])
+        # it is our predecessor even before it pings us
+        self._detector.heartbeat(pred)
+        self.__markJoined()
+
+        # the incarnation tells peers which saw us die that we are back
+        incarnation = self._members.incarnation
+        reqData("update", self._nodeID, pred,
+                {"_firstID": self._nodeID, "_secondID": first,
+                 "incarnation": incarnation}).fulfill(self._pool)
+        reqData("pull", self._nodeID, first,
+                {"_nodeID": self._nodeID, "key": pred,
+                 "incarnation": incarnation}).fulfill(self._pool)
+        self._stats.count("warmRestarts")
+        self._stats.observe("joinSeconds", monotonic() - begin)
+        print("\n ---- Restarted between Peer {0} and Peer {1} ----".format(
+            pred, first))
+        self._replicateChain()
+
+    # write our routing state, see nodeSnapshot
+    # every ping interval and whenever a successor or the
+    # predecessor changed, an unchanged state is not written again
+    def _saveSnapshot(self):
+        with self.__lock:
+            state = {"_nodeID": self._nodeID, "_firstID": self._firstID,
+                     "_secondID": self._secondID,
+                     "pred": self._predecessor(),
+                     "fingers": self._fingers.entries()}
+        try:
+            if self._snapshot.save(state):
+                self._stats.count("snapshotWrites")
+        except OSError as e:
+            print("Cannot write snapshot: {0}".format(e))
+
     # terminate the program
     def stop(self):
         # send exit signal to threads
-        reqData("exit", self._nodeID, self._nodeID).fulfill()
+        reqData("exit", self._nodeID, self._nodeID).fulfill().close()
         print("Depature gracefully :-)")
         return
 
+    # block until the node stopped
+    # returns False if it is still running after timeout seconds
+    def wait(self, timeout=None):
+        self._consumerThread.join(timeout)
+        return not self._consumerThread.is_alive()
+
+    # stop every thread without telling the other peers,
+    # as if the process had been killed
+    def halt(self):
+        try:
+            reqData("exit", self._nodeID, self._nodeID).fulfill().close()
+        except OSError:
+            # stopped already
+            pass
+
+    # leave the DHT gracefully
+    # the successor keeps our keys from now on
+    # the two peers pinging us and the successor we ping are told
+    # directly, everybody else hears it by gossip
+    # the quit only walks the ring when we do not know who pings us
+    def quit(self):
+        if self._firstID != self._nodeID:
+            self._handoff(self._firstID, self._nodeID, self._nodeID, False)
+        self._members.leave()
+        content = {"_nodeID": self._nodeID,
+                   "_firstID": self._firstID,
+                   "_secondID": self._secondID,
+                   "incarnation": self._members.incarnation}
+        preds = [p for p in self._detector.peers() if p != self._nodeID]
+        if len(preds) < 2:
+            reqData("quit", self._nodeID, self._firstID,
+                    content).fulfill(self._pool)
+            return
+        if self._firstID not in preds:
+            preds.append(self._firstID)
+        for peer in preds:
+            try:
+                reqData("quit", self._nodeID, peer,
+                        dict(content, relay=0)).fulfill(self._pool)
+            except OSError:
+                print("Peer {} is unreachable".format(peer))
+        reqData("quit", self._nodeID, self._nodeID,
+                dict(content, relay=0)).fulfill(self._pool)
+
+    # store or request filename on behalf of a program
+    # returns a Future resolved with a dict holding the peer which
+    # answered, the hops the request took and the seconds it took,
+    # plus the bytes received for a request
+    # a request for a file nobody has raises KeyError
+    # an iterative request finds the owner itself, see __iterate,
+    # instead of passing the request from peer to peer
+    def _submit(self, opr, filename, iterative=False):
+        future = Future()
+        req = reqData(opr, self._nodeID, self._nodeID,
+                      {"_nodeID": self._nodeID, "filename": filename,
+                       "ack": 1, "hops": 0})
+        with self.__lock:
+            self.__pending[req.stamp] = (future, monotonic(), opr)
+        if iterative:
+            Thread(target=self.__iterate, args=(req,), name="lookup",
+                   daemon=True).start()
+            return future
+        try:
+            req.fulfill(self._pool)
+        except OSError as e:
+            self._resolve(req.stamp, error=e)
+        return future
+
+    # store or request every name in names at once
+    # the names travel in one batch per next hop instead of
+    # one request per name
+    # returns a Future resolved with a dict holding the number of
+    # names done, the names nobody had, the names nobody answered for,
+    # the number of peers which answered, the most hops a name took
+    # and the seconds it took
+    def _submitBatch(self, opr, names):
+        future = Future()
+        names = sorted(set(names))
+        req = reqData("batch", self._nodeID, self._nodeID,
+                      {"_nodeID": self._nodeID, "kind": opr,
+                       "names": joinNames(names), "hops": 0})
+        state = {"future": future, "submitted": monotonic(),
+                 "waiting": set(names), "done": 0, "missing": [],
+                 "peers": set(), "hops": 0}
+        if len(names) == 0:
+            self._finishBatch(state)
+            return future
+        with self.__lock:
+            self.__batches[req.stamp] = state
+        try:
+            req.fulfill(self._pool)
+        except OSError as e:
+            with self.__lock:
+                self.__batches.pop(req.stamp, None)
+            future.set_exception(e)
+        return future
+
+    # resolve the future of a batch with what came back
+    def _finishBatch(self, state):
+        seconds = monotonic() - state["submitted"]
+        self._stats.observe("batchSeconds", seconds)
+        state["future"].set_result({
+            "done": state["done"],
+            "missing": sorted(state["missing"]),
+            "unanswered": sorted(state["waiting"]),
+            "peers": len(state["peers"]),
+            "hops": state["hops"],
+            "seconds": seconds})
+
+    # list a page of the keys peer keeps, ours if peer is None
+    # keys in (lo, hi] only, lo == hi lists them all
+    # a scan goes on from the last name of the previous page, after
+    # returns a Future resolved with a dict holding the peer, its first
+    # and second successors as next and second, the names of the page
+    # and their keys, and more, 1 while the peer may keep more names
+    def _scan(self, peer=None, lo=0, hi=0, limit=scanPageSize, after=None):
+        future = Future()
+        limit = max(1, min(limit, scanPageMax))
+        if peer is None or peer == self._nodeID:
+            future.set_result(scanResult(
+                self._scanContent(lo, hi, limit, after)))
+            return future
+
+        def fetch():
+            try:
+                content = scanPage(self._nodeID, peer, lo, hi, limit, after,
+                                   time_ns(), scanTimeout)
+                self._stats.count("scanPages")
+                future.set_result(scanResult(content))
+            except (OSError, ValueError) as e:
+                future.set_exception(e)
+
+        Thread(target=fetch, name="scan", daemon=True).start()
+        return future
+
+    # the content of a scanned reply listing a page of our keys
+    # the replicas of a predecessor which seems dead are listed with them
+    def _scanContent(self, lo, hi, limit, after):
+        entries = self._store.page(lo, hi, limit, after)
+        orphans = orphanRange(self._members, self._predID, self._nodeID)
+        if orphans is not None:
+            entries = mergePages(lo, limit, entries, self._replicas.page(
+                lo, hi, limit, after, within=orphans))
+        self._stats.count("scannedKeys", len(entries))
+        return {"_nodeID": self._nodeID, "_firstID": self._firstID,
+                "_secondID": self._secondID,
+                "names": joinNames(e.name for e in entries),
+                "keys": ",".join(str(e.key) for e in entries),
+                "more": int(len(entries) == limit)}
+
+    # answer the submitted request with this stamp
+    def _resolve(self, stamp, error=None, **result):
+        with self.__lock:
+            entry = self.__pending.pop(stamp, None)
+        if entry is None:
+            return
+        future, submitted, opr = entry
+        if future.done():
+            return
+        if error is not None:
+            self._stats.count(opr + "Failed")
+            if self._trace is not None:
+                self._trace.event(stamp, self._nodeID, "failed",
+                                  error=repr(error))
+            future.set_exception(error)
+            return
+        result["seconds"] = monotonic() - submitted
+        self._stats.observe(opr + "Seconds", result["seconds"])
+        if "hops" in result:
+            self._stats.observe("hops", result["hops"], hopBuckets)
+        if self._trace is not None:
+            self._trace.event(stamp, self._nodeID, "answered",
+                              seconds=round(result["seconds"], 6),
+                              hops=result.get("hops"),
+                              holder=result.get("peer"))
+        future.set_result(result)
+
+    # fail submitted requests nobody answered for too long
+    def _expirePending(self, timeout=60):
+        now = monotonic()
+        with self.__lock:
+            stale = [stamp for stamp, (future, submitted, opr)
+                     in self.__pending.items() if now - submitted > timeout]
+        for stamp in stale:
+            self._resolve(stamp, error=TimeoutError(
+                "No answer after {0} seconds".format(timeout)))
+
+        # a batch ends with the names nobody answered for
+        with self.__lock:
+            stale = [self.__batches.pop(stamp) for stamp, state
+                     in list(self.__batches.items())
+                     if now - state["submitted"] > timeout]
+        for state in stale:
+            self._finishBatch(state)
+
+    # Local hash table that this peer keeps, hash -> set of filenames
+    @property
+    def localHashTable(self):
+        return self._store.hashTable()
+
     # put data into local hash table
     def putData(self, filename):
-        print("\n ---- Store {0} request accepted ----".format(filename))
-        fileHash = self._toHash(filename)
-        if fileHash in self.localHashTable:
-            self.localHashTable[fileHash].append(filename)
-        elif fileHash not in self.localHashTable:
-            self.localHashTable[fileHash] = [filename]
+        self._store.put(filename)
 
     # find is filename in this peer
     def fetchData(self, filename):
-        fileHash = self._toHash(filename)
-        if fileHash in self.localHashTable and \
-                filename in self.localHashTable[fileHash]:
-            return True
-        return False
+        return filename in self._store
 
     @property
     def _nodePort(self):
@@ -219,167 +1377,751 @@ class DHTNode(object):
     def _secondPort(self):
         return toPort(self._secondID)
 
+    # ask the producer to read requests from sock
+    # it is called by the pool for every new outgoing connection
+    def __watch(self, sock, decoder=None):
+        with self.__lock:
+            self.__pendingConns.append((sock, decoder or frameDecoder()))
+        self.__wakeWriter.send(b"w")
+
     # producer thread
-    # gets request from self.__nodeSocket
+    # gets request from self.__nodeSocket and every pooled connection
     # and store them into self._operationQueue
+    # a request on a shared connection is queued with conn None,
+    # a request owning its connection is queued with that connection
     def __producerLoop(self):
-        while True:
-            conn, addr = self.__nodeSocket.accept()
-            conn.settimeout(120)
-            try:
-                content = conn.recv(4096).decode('utf-8')
-                req = reqData.fromString(content)
-                self._operationQueue.put((conn, req))
-
+        selector = DefaultSelector()
+        selector.register(self.__nodeSocket, EVENT_READ)
+        selector.register(self.__wakeReader, EVENT_READ)
+
+        running = True
+        while running:
+            for key, mask in selector.select():
+                sock = key.fileobj
+                if sock is self.__nodeSocket:
+                    conn, addr = sock.accept()
+                    selector.register(conn, EVENT_READ, frameDecoder())
+                elif sock is self.__wakeReader:
+                    sock.recv(4096)
+                    with self.__lock:
+                        pending = self.__pendingConns
+                        self.__pendingConns = []
+                    for conn, decoder in pending:
+                        selector.register(conn, EVENT_READ, decoder)
+                else:
+                    try:
+                        data = sock.recv(65536)
+                    except OSError:
+                        data = b""
+                    if not data:
+                        selector.unregister(sock)
+                        self._pool.discard(sock)
+                        sock.close()
+                        continue
+                    self._pool.touch(sock)
+                    key.data.feed(data)
+                    running = self.__drain(selector, sock, key.data) and \
+                        running
+
+        selector.close()
+
+    # queue every complete request read from sock
+    # returns False once the exit request arrived
+    def __drain(self, selector, sock, decoder):
+        try:
+            while True:
+                req = decoder.next()
+                if req is None:
+                    return True
+
+                # the connection belongs to this single request
+                if decoder.legacy or \
+                        req.opr in ("transfer", "fetch", "hop", "scan"):
+                    selector.unregister(sock)
+                    sock.settimeout(120)
+                    req.payload = decoder.rest()
+                    if not self._operationQueue.put(
+                            (sock, req, monotonic()), priorityOf(req.opr),
+                            held=req.opr in heldOprs):
+                        self.__refuseHeld(req, sock)
+                    return req.opr != "exit"
+
+                # replies to the sender may reuse this connection
+                self._pool.adopt(req.src, sock)
+                if not self._operationQueue.put((None, req, monotonic()),
+                                                priorityOf(req.opr)):
+                    self.__refuse(req)
                 if req.opr == "exit":
-                    break
+                    return False
 
-            except ValueError:
-                print("Invalid request!")
+        except ValueError:
+            print("Invalid request!")
+            selector.unregister(sock)
+            self._pool.discard(sock)
+            sock.close()
+            return True
 
     # consumer thread
-    # read self._operationQueue and handle these requests
+    # read self._operationQueue and pass these requests to the workers
     def __consumerLoop(self):
+        self._routingThread.start()
+        for worker in self._workerThreads + self._fetchThreads + \
+                self._downloadThreads:
+            worker.start()
+
         while True:
-            # print("Checking operation queue....", self._operationQueue.empty())
-            # sleep(5)
-            if self._operationQueue.empty() is False:
-                conn, req = self._operationQueue.get()
-                # print(req)
-                if req.opr == "store":
-                    self.__doStore(req)
-                    conn.close()
-                elif req.opr == "request":
-                    self.__doRequest(req)
-                    conn.close()
-                elif req.opr == "join":
-                    self.__doJoin(req)
-                    conn.close()
-                elif req.opr == "quit":
-                    self.__doQuit(req)
-                    conn.close()
-                    if self._nodeID == int(req.getContent()["_nodeID"]):
-                        self.stop()
-                elif req.opr == "abrupt":
-                    self.__doAbrupt(req)
+            item = self._operationQueue.get()
+            self._stats.observeDepth(self._operationQueue.qsize())
+            conn, req, queued = item
+            self._stats.observe("queueWaitSeconds", monotonic() - queued)
+            if req.opr == "exit":
+                if conn is not None:
                     conn.close()
-                elif req.opr == "transfer":
-                    self.__doTransfer(req, conn)
-                elif req.opr == "update":
-                    self.__doUpdate(req)
-                    conn.close()
-                elif req.opr == "exit":
-                    conn.close()
-                    break
-
+                break
+            if req.opr in routingOprs:
+                self._routingQueue.put(item)
+            elif req.opr == "fetch":
+                try:
+                    self._fetchQueue.put_nowait(item)
+                except Full:
+                    self.__refuseHeld(req, conn)
+            elif req.opr == "manifest":
+                self._downloadQueue.put(item)
+            else:
+                self._workQueue.put(item)
+
+        # let the workers finish what they have got
+        self._routingQueue.put(None)
+        for worker in self._workerThreads:
+            self._workQueue.put(None)
+        for worker in self._downloadThreads:
+            self._downloadQueue.put(None)
+        for worker in self._fetchThreads:
+            self._fetchQueue.put(None)
+        self._routingThread.join()
+        for worker in self._workerThreads + self._downloadThreads:
+            worker.join()
+
+        self._retries.close()
+        self._pool.close()
+        self._store.close()
+        self._replicas.close()
+
+        # the ping threads stop once the ping socket is closed
+        # shutting it down first wakes the ping loop, which would hold
+        # the port until its receive timed out, and a restart needs it
+        self.__nodeSocket.close()
+        if self.__pingSocket is not None:
+            try:
+                self.__pingSocket.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+            self.__pingSocket.close()
+        if self.__controlSocket is not None:
+            self.__controlSocket.shutdown(SHUT_RDWR)
+            self.__controlSocket.close()
+            os.remove(self._controlPath)
+        with self.__lock:
+            pending = list(self.__pending.keys())
+        for stamp in pending:
+            self._resolve(stamp, error=ConnectionError("Peer stopped"))
+        with self.__lock:
+            batches = list(self.__batches.values())
+            self.__batches.clear()
+        for state in batches:
+            self._finishBatch(state)
+        self._dumpMetrics()
+        if self._trace is not None:
+            self._trace.close()
         return
 
-    # Ping loop
-    def __pingSenderLoop(self):
+    # worker thread
+    # handle the requests of one queue until None arrives
+    def __workerLoop(self, queue):
         while True:
-            if self._pingListenerThread.is_alive() is False:
+            item = queue.get()
+            if item is None:
                 break
-            sendSocket = socket(AF_INET, SOCK_DGRAM)
-            content = reqData("ping", self._nodeID, self._firstID, stamp=time_ns()
-                              ).toString().encode('utf-8')
-            sendSocket.sendto(
-                content, ("127.0.0.1", basePort + self._firstPort))
-
-            content = reqData("ping", self._nodeID, self._secondID, stamp=time_ns()
-                              ).toString().encode('utf-8')
-            sendSocket.sendto(
-                content, ("127.0.0.1", basePort + self._secondPort))
-
+            conn, req, queued = item
+            try:
+                self.__handle(conn, req)
+            except Exception as e:
+                print("Failed to handle {0} request: {1}".format(req.opr, e))
+            seconds = monotonic() - queued
+            self._stats.record(req.opr, seconds)
+            if self._trace is not None:
+                self._trace.event(req.stamp, self._nodeID, req.opr,
+                                  src=req.src, seconds=round(seconds, 6))
+
+    # call the handler of a request
+    def __handle(self, conn, req):
+        if req.opr == "store":
+            self.__doStore(req)
+        elif req.opr == "request":
+            self.__doRequest(req)
+        elif req.opr == "join":
+            self.__doJoin(req)
+        elif req.opr == "quit":
+            self.__doQuit(req)
+            if self._nodeID == int(req.getContent()["_nodeID"]):
+                self.stop()
+        elif req.opr == "abrupt":
+            self.__doAbrupt(req)
+        elif req.opr == "transfer":
+            # the transfer closes its own connection
+            self.__doTransfer(req, conn)
+            conn = None
+        elif req.opr == "update":
+            self.__doUpdate(req)
+        elif req.opr == "stabilize":
+            self.__doStabilize(req)
+        elif req.opr == "stabilized":
+            self.__doStabilized(req)
+        elif req.opr == "lookup":
+            self.__doLookup(req)
+        elif req.opr == "found":
+            self.__doFound(req)
+        elif req.opr == "hop":
+            self.__doHop(req, conn)
+        elif req.opr == "scan":
+            self.__doScan(req, conn)
+        elif req.opr == "pull":
+            self.__doPull(req)
+        elif req.opr == "handoff":
+            self.__doHandoff(req)
+        elif req.opr == "replicate":
+            self.__doReplicate(req)
+        elif req.opr in ("stored", "missing", "unrouted"):
+            self.__doAnswer(req)
+        elif req.opr == "batch":
+            self.__doBatch(req)
+        elif req.opr == "busy":
+            self.__doBusy(req)
+        elif req.opr == "batched":
+            self.__doBatched(req)
+        elif req.opr == "manifest":
+            self.__doManifest(req)
+        elif req.opr == "fetch":
+            # a download keeps fetching on conn, it closes conn itself
+            self.__doFetch(req, conn)
+            conn = None
+
+        if conn is not None:
+            conn.close()
+
+    # ping loop
+    # one socket pings both successors every ping interval and receives
+    # the pings of the peers before us
+    # it waits until the next ping is due or the next peer would fall
+    # silent, so a dead peer is noticed on time and not when some
+    # other ping happens to arrive
+    def __pingLoop(self):
+        sock = self.__pingSocket
+        nextPing = monotonic()
+        while True:
+            now = monotonic()
+            try:
+                if now >= nextPing:
+                    self.__sendPings(sock)
+                    nextPing = now + self._pingInterval
+                for peer in self._detector.expired(now):
+                    self.__onSilent(peer)
+
+                # a new deadline is always more than a ping interval
+                # away, so waking up for the next ping never misses one
+                wake = nextPing
+                deadline = self._detector.nextDeadline()
+                if deadline is not None and deadline < wake:
+                    wake = deadline
+                sock.settimeout(max(wake - monotonic(), 0.001))
+                content, addr = sock.recvfrom(4096)
+            except SocketTimeout:
+                continue
+            except OSError:
+                # the node stopped
+                break
+            try:
+                req = reqData.fromString(content.decode('utf-8'))
+                gossip = req.getContent().get("gossip", "")
+            except (ValueError, IndexError, UnicodeDecodeError):
+                continue
+            # only the peers before us ping, the rest gossip
+            # a ping is answered with a pong carrying its stamp,
+            # so that the pinging peer sees the round trip time
+            self._stats.count("pingsReceived")
+            if req.opr == "ping":
+                if self._verbose:
+                    print("Ping response received from Peer {}".format(
+                        req.src))
+                self._detector.heartbeat(req.src)
+                pong = reqData("pong", self._nodeID, req.src, "", req.stamp)
+                try:
+                    sock.sendto(pong.toString().encode('utf-8'),
+                                ("127.0.0.1", basePort + toPort(req.src)))
+                except OSError:
+                    pass
+            elif req.opr == "pong":
+                self._stats.observe("pingRttSeconds", (time_ns() - req.stamp) / 1e9)
+            if self._members.heard(req.src):
+                self.__onMember(req.src, alive)
+            for peer, state in self._members.merge(gossip):
+                self.__onMember(peer, state)
+
+    # ping both successors and gossip to gossipFanout random members
+    # every message carries the latest membership changes
+    def __sendPings(self, sock):
+        for peer in self._members.expire():
+            self.__onMember(peer, "dead")
+        targets = [("ping", self._firstID), ("ping", self._secondID)]
+        targets += [("gossip", peer) for peer in self._members.randomPeers(
+            gossipFanout, (self._firstID, self._secondID))]
+        for opr, dst in targets:
+            gossip = self._members.piggyback()
+            content = reqData(opr, self._nodeID, dst,
+                              {"gossip": gossip} if gossip else "",
+                              stamp=time_ns()).toString().encode('utf-8')
+            sock.sendto(content, ("127.0.0.1", basePort + toPort(dst)))
+        self._stats.count("pingsSent", len(targets))
+        if self._verbose:
             print("Ping requests sent to Peers {} and {}".format(
                 self._firstID, self._secondID))
-            sendSocket.close()
-            sleep(self._pingInterval)
 
-    def __pingListenerLoop(self):
-        # bind a port for receiving ping
-        receiverSocket = socket(AF_INET, SOCK_DGRAM)
-        receiverSocket.bind(("127.0.0.1", basePort + self._nodePort))
-        while True:
-            content, addr = receiverSocket.recvfrom(4096)
-            req = reqData.fromString(content.decode('utf-8'))
-            print("Ping response received from Peer {}".format(req.src))
-
-            # update the time stamp
-            self.__lossCount[req.src] = req.stamp
-            currTime = time_ns()
-            removeKey = None
-            restKey = None
-
-            # check if a peer left abruptly
-            # no reply over 30s will be
-            # considered left abruptly
-            for k, v in self.__lossCount.items():
-                if (currTime - v) // 1e9 > 15 + 2 * self._pingInterval:
-                    removeKey = k
-
-            if removeKey is not None:
-                if len(self.__lossCount) > 2:
-                    del self.__lossCount[removeKey]
-                else:
-                    # handle abrupt leave
-                    del self.__lossCount[removeKey]
-                    restKey = max(self.__lossCount.keys())
-                    print("\n ---- Peer {} no longer alive ----".format(removeKey))
-                    # the informer will the first successor of the quit node
-                    # the second successor will not send this request
-                    if (removeKey > restKey and removeKey < self._nodeID) or\
-                        (removeKey < restKey and restKey > self._nodeID) or \
-                            (removeKey > restKey and removeKey > self._nodeID and restKey > self._nodeID):
-                        # inform the p2p network that one node left abruptly
-                        reqData("abrupt", self._nodeID, self._firstID,
-                                "_nodeID: {}, _firstID: {}, _secondID: {}, leaveNode: {}".format(
-                                    self._nodeID, self._firstID, self._secondID, removeKey
-                                )).fulfill()
-
-            removeKey = None
-            restKey = None
+    # the membership list learned that peer changed its state
+    def __onMember(self, peer, state):
+        if state == alive:
+            # the keys before a new peer are its own now
+            self._cache.invalidate(peer)
+            return
+        if state in ("dead", left):
+            print("Peer {0} is {1}".format(peer, state))
+            self._detector.remove(peer)
+            self._fingers.remove(peer)
+            self._cache.invalidate(peer)
+
+    # the failure detector suspects peer
+    # a peer other than the last two pinging us only went away,
+    # the first successor of a peer which left abruptly tells the others
+    def __onSilent(self, peer):
+        if peer == self._predID:
+            self._predID = None
+        rest = self._detector.peers()
+        if len(rest) != 1:
+            return
+        restKey = max(rest)
+        print("\n ---- Peer {} no longer alive ----".format(peer))
+        self._members.suspect(peer)
+        # the informer will the first successor of the quit node
+        # the second successor will not send this request
+        if between(peer, restKey, self._nodeID):
+            # the other peer pinging us is the predecessor of the
+            # quit node, it hears about it directly and everybody
+            # else by gossip
+            content = {"_nodeID": self._nodeID,
+                       "_firstID": self._firstID,
+                       "_secondID": self._secondID,
+                       "leaveNode": peer}
+            try:
+                reqData("abrupt", self._nodeID, restKey,
+                        dict(content, relay=0)).fulfill(self._pool)
+            except OSError:
+                # inform the p2p network that one node left abruptly
+                reqData("abrupt", self._nodeID, self._firstID,
+                        content).fulfill(self._pool)
 
     def __commandListenerLoop(self):
         while True:
             try:
-                command = input().lower()
-                command = command.split(" ")
+                command = [x for x in input().split(" ") if x]
+                if len(command) == 0:
+                    continue
+                command[0] = command[0].lower()
                 # quit command, quit gracefully
                 if command[0] == "quit":
-                    reqData("quit", self._nodeID, self._firstID,
-                            "_nodeID: {}, _firstID: {}, _secondID: {}".format(
-                                self._nodeID, self._firstID, self._secondID)).fulfill()
+                    self.quit()
                     break
-                # store command
-                # send a file to a peer
-                elif command[0] == "store" and len(command) > 1:
-                    reqData("store", self._nodeID, self._nodeID,
-                            "_nodeID: {}, filename: {}".format(
-                                self._nodeID, command[1])).fulfill()
-                # request command
-                # get file from one peer
-                elif command[0] == "request" and len(command) > 1:
-                    reqData("request", self._nodeID, self._nodeID,
-                            "_nodeID: {}, filename: {}".format(
-                                self._nodeID, command[1])).fulfill()
+                # store and request commands
+                # "store 1 2 3" and "store @manifest" send a batch,
+                # a single name is sent on its own as before
+                # "request -i 1234" looks the owner up iteratively
+                elif command[0] in ("store", "request") and \
+                        len(command) > 1:
+                    names = commandNames(x for x in command[1:] if x != "-i")
+                    if len(names) == 1 and "-i" in command:
+                        self._submit(command[0], names[0], iterative=True) \
+                            .add_done_callback(
+                                printAnswer(command[0], names[0]))
+                    elif len(names) == 1:
+                        reqData(command[0], self._nodeID, self._nodeID,
+                                {"_nodeID": self._nodeID,
+                                 "filename": names[0]}).fulfill(self._pool)
+                    else:
+                        self._submitBatch(command[0], names) \
+                            .add_done_callback(printBatch(command[0]))
+                # stats command
+                # print the connection pool counters and
+                # the queue depth and latency of every operation
+                elif command[0] == "stats":
+                    print(", ".join("{0}: {1}".format(k, v)
+                                    for k, v in self._pool.stats().items()))
+                    print("keys: {0}, replicas: {1}".format(
+                        len(self._store), len(self._replicas)))
+                    print("cache " + ", ".join(
+                        "{0}: {1}".format(k, v)
+                        for k, v in self._cache.stats().items()))
+                    print("detector " + ", ".join(
+                        "{0}: {1}".format(k, v)
+                        for k, v in self._detector.stats().items()))
+                    print("members " + ", ".join(
+                        "{0}: {1}".format(k, v)
+                        for k, v in self._members.stats().items()))
+                    for line in self._stats.summary():
+                        print(line)
                 else:
                     print("Invalid command")
+            except EOFError:
+                # nobody is typing, keep serving the DHT
+                break
             except Exception:
                 print("Invalid command")
 
+    # what the stats command prints, for programs
+    def stats(self):
+        return {"peer": self._nodeID, "firstID": self._firstID,
+                "secondID": self._secondID, "keys": len(self._store),
+                "replicas": len(self._replicas),
+                "pool": self._pool.stats(), "cache": self._cache.stats(),
+                "detector": self._detector.stats(),
+                "members": self._members.stats(),
+                "ops": self._stats.toDict()}
+
+    # listen on the control socket, a socket left by a peer
+    # which did not stop cleanly is replaced
+    def __listenControl(self):
+        if os.path.exists(self._controlPath):
+            os.remove(self._controlPath)
+        self.__controlSocket = socket(AF_UNIX, SOCK_STREAM)
+        self.__controlSocket.bind(self._controlPath)
+        self.__controlSocket.listen()
+        Thread(target=self.__controlLoop, name="control",
+               daemon=True).start()
+
+    # control thread
+    # every program connected to the control socket gets a thread
+    def __controlLoop(self):
+        while True:
+            try:
+                conn, addr = self.__controlSocket.accept()
+            except OSError:
+                break
+            Thread(target=self.__serveControl, args=(conn,),
+                   name="control client", daemon=True).start()
+
+    # read the requests of a program until it disconnects
+    # a submit is answered by a result with the same stamp once its
+    # future is done, so a program may have many submits in flight
+    def __serveControl(self, conn):
+        decoder = frameDecoder()
+        lock = Lock()
+
+        def reply(req, content):
+            with lock:
+                try:
+                    conn.sendall(reqData("result", self._nodeID, req.src,
+                                         content, req.stamp).toFrame())
+                except OSError:
+                    pass
+
+        try:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                decoder.feed(data)
+                req = decoder.next()
+                while req is not None:
+                    self.__control(req, reply)
+                    req = decoder.next()
+        except (OSError, ValueError):
+            pass
+        conn.close()
+
+    # handle a request of a program, answered through reply
+    def __control(self, req, reply):
+        content = req.getContent()
+        if req.opr == "submit":
+            if "names" in content:
+                future = self._submitBatch(
+                    content["kind"], splitNames(content["names"]))
+            else:
+                future = self._submit(
+                    content["kind"], content["filename"],
+                    int(content.get("iterative", 0)) == 1)
+            future.add_done_callback(
+                lambda f: reply(req, resultContent(f)))
+        elif req.opr == "scan":
+            future = self._scan(
+                int(content["peer"]) if "peer" in content else None,
+                int(content.get("lo", 0)), int(content.get("hi", 0)),
+                int(content.get("limit", scanPageSize)),
+                content.get("after"))
+            future.add_done_callback(
+                lambda f: reply(req, resultContent(f)))
+        elif req.opr == "stats":
+            reply(req, {"stats": json.dumps(self.stats())})
+        elif req.opr == "quit":
+            reply(req, {})
+            self.quit()
+        else:
+            reply(req, {"error": "ValueError",
+                        "message": "Unknown operation " + req.opr})
+
+    # a line about the request with stamp, printed when verbose
+    # and kept in the trace if the stamp is traced
+    def _log(self, stamp, text):
+        if self._verbose:
+            print(text)
+        if self._trace is not None:
+            self._trace.event(stamp, self._nodeID, "log", text=text.strip())
+
+    # write the metrics where a Prometheus textfile collector
+    # or anybody else can read them
+    def _dumpMetrics(self):
+        if self._metricsDir is None:
+            return
+        pool = self._pool.stats()
+        pool.pop("open")
+        extra = dict(("pool" + k.capitalize(), v) for k, v in pool.items())
+        try:
+            writeAtomic(os.path.join(self._metricsDir, "peer{0}.prom".format(
+                self._nodeID)), self._stats.prometheus(
+                    {"peer": self._nodeID}, extra))
+        except OSError as e:
+            print("Cannot write metrics: {0}".format(e))
+        if self._trace is not None:
+            self._trace.flush()
+
     # returns hash number if filename is valid
     # otherwise returns None
     def _toHash(self, filename):
-        digit = None
+        return toHash(filename)
+
+    # is this peer the owner of key when a lookup came from src
+    def _isOwner(self, key, src):
+        return ownsKey(key, src, self._nodeID)
+
+    # the best peer to forward a lookup for key to
+    def _nextHop(self, key):
+        if betweenRight(key, self._nodeID, self._firstID):
+            return self._firstID
+        finger = self._fingers.closestPreceding(key)
+        if finger is None:
+            return self._firstID
+        return finger
+
+    # the predecessor is the last peer which stabilized with us,
+    # or else the closest peer pinging us
+    # returns None if nobody has pinged us yet
+    def _predecessor(self):
+        pred = self._predID
+        if pred is not None and not self._members.gone(pred):
+            return pred
+        peers = [k for k in self._detector.peers() if k != self._nodeID]
+        if len(peers) == 0:
+            return None
+        return min(peers, key=lambda k: distance(k, self._nodeID))
+
+    # forward req to hop, or to the best hop for key
+    # a stale finger falls back to the first then the second successor
+    # returns the peer which accepted the request, None if all failed
+    # or the request was forwarded routeTTL times already
+    def __route(self, req, key=None, hop=None):
+        content = req.getContent()
+        left = int(content.get("hopsLeft", routeTTL)) - 1
+        if left < 0:
+            self._stats.count("routeExpired")
+            self._log(req.stamp, "The {0} request was forwarded {1} times, "
+                      "it is dropped".format(req.opr, routeTTL))
+            return None
+        req.setContent(hopsLeft=left)
+
+        if hop is None:
+            hop = self._nextHop(key)
+        candidates = []
+        for dst in (hop, self._firstID, self._secondID):
+            if dst not in candidates:
+                candidates.append(dst)
+
+        # requests submitted by a program count their hops
+        if "hops" in content:
+            req.setContent(hops=int(content["hops"]) + 1)
+
+        req.src = self._nodeID
+        for dst in candidates:
+            req.dst = dst
+            try:
+                req.fulfill(self._pool)
+                return dst
+            except OSError:
+                print("Peer {} is unreachable".format(dst))
+                self._fingers.remove(dst)
+        return None
+
+    # send a lookup for the successor of every finger start
+    # answers come back as found requests
+    def _fixFingers(self):
+        for i in range(len(self._fingers)):
+            try:
+                reqData("lookup", self._nodeID, self._nodeID,
+                        {"_nodeID": self._nodeID,
+                         "key": self._fingers.start(i),
+                         "slot": i}).fulfill(self._pool)
+            except OSError:
+                return
+
+    # finger loop
+    # refresh the finger table every ping interval
+    # and close pooled connections nobody used for a while
+    def __fingerLoop(self):
+        while True:
+            if self._producerThread.is_alive() is False:
+                break
+            self._fixFingers()
+            self._repairSuccessors()
+            self._repairReplicas()
+            self._expirePending()
+            self._pool.evictIdle()
+            self._saveSnapshot()
+            self._dumpMetrics()
+            sleep(self._pingInterval)
+
+    # a successor the membership list knows is gone is replaced by
+    # the next live members, in case the quit or abrupt notice was lost
+    def _repairSuccessors(self):
+        if not (self._members.gone(self._firstID) or
+                self._members.gone(self._secondID)):
+            return
+        succ = self._members.successors(2)
+        if len(succ) < 2 or (succ[0], succ[1]) == \
+                (self._firstID, self._secondID):
+            return
+        print("Successors {0} and {1} replaced by {2} and {3}".format(
+            self._firstID, self._secondID, succ[0], succ[1]))
+        reqData("update", self._nodeID, self._nodeID,
+                {"_firstID": succ[0], "_secondID": succ[1]}
+                ).fulfill(self._pool)
+
+    # stabilizer thread
+    # ask the first successor for its predecessor every stabilize
+    # interval, which also tells it that we may be its predecessor
+    def __stabilizeLoop(self):
+        while self._producerThread.is_alive():
+            sleep(self._stabilizeInterval)
+            if self._firstID == self._nodeID:
+                continue
+            succ = self._firstID
+            try:
+                reqData("stabilize", self._nodeID, succ,
+                        {"_nodeID": self._nodeID}).fulfill(self._pool)
+                self._stats.count("stabilizeMessages")
+            except OSError:
+                print("Peer {} is unreachable".format(succ))
+                self.__skipSuccessor(succ)
+
+    # the first successor did not take a stabilize, the second one
+    # takes its place at once and tells us its own successor, the
+    # membership list spreads the suspicion
+    def __skipSuccessor(self, succ):
+        with self.__lock:
+            if succ != self._firstID or self._secondID in (succ, self._nodeID):
+                return
+            self._firstID = self._secondID
+            self._cache.invalidate(succ)
+        self._members.suspect(succ)
+        self._stats.count("stabilizeRepairs")
+        print("My first successor is Peer {0} now".format(self._firstID))
         try:
-            digit = int(filename)
-            if digit < 0 or digit > 9999:
-                raise ValueError
-            digit = digit % 256
-        except ValueError:
-            digit = None
-            print("Invalid filename!")
-        return digit
+            reqData("stabilize", self._nodeID, self._firstID,
+                    {"_nodeID": self._nodeID}).fulfill(self._pool)
+            self._stats.count("stabilizeMessages")
+        except OSError:
+            print("Peer {} is unreachable".format(self._firstID))
+
+    # could peer be a closer predecessor than the one we know
+    # a stabilize a peer sent before it left is late, not closer
+    def __closerPred(self, peer):
+        pred = self._predID
+        return peer != self._nodeID and \
+            not self._members.gone(peer) and (
+                pred is None or self._members.gone(pred) or
+                between(peer, pred, self._nodeID))
+
+    # a peer before us stabilizes, it is our predecessor if it is
+    # closer than the one we knew
+    # the keys we keep in front of a new predecessor are its own,
+    # or belong further back and it passes them on
+    # a peer restarting from its snapshot may be stabilized with
+    # before it is back in the ring, it has no successors to tell yet
+    def __doStabilize(self, req):
+        if not self.__joined.is_set():
+            return
+        peer = int(req.getContent()["_nodeID"])
+        with self.__lock:
+            old = self._predID
+            changed = self.__closerPred(peer)
+            if changed:
+                self._predID = peer
+            content = {"_nodeID": self._nodeID, "_firstID": self._firstID,
+                       "_secondID": self._secondID}
+            if self._predID is not None:
+                content["pred"] = self._predID
+        try:
+            reqData("stabilized", self._nodeID, peer, content,
+                    req.stamp).fulfill(self._pool)
+            self._stats.count("stabilizeMessages")
+        except OSError:
+            print("Peer {} is unreachable".format(peer))
+        if changed:
+            print("Peer {0} is my predecessor now, it was Peer {1}".format(
+                peer, old))
+            self._saveSnapshot()
+            if self._store.select(
+                    lambda k: betweenRight(k, self._nodeID, peer)):
+                self._handoff(peer, self._nodeID, peer)
+
+    # our successor told us its predecessor and successor
+    # a peer between us and the successor is our successor now
+    def __doStabilized(self, req):
+        content = req.getContent()
+        succ = int(content["_nodeID"])
+        with self.__lock:
+            # an answer from a successor we replaced since
+            if succ != self._firstID:
+                return
+            first, second = succ, int(content["_firstID"])
+            pred = int(content.get("pred", self._nodeID))
+            if between(pred, self._nodeID, succ) and \
+                    not self._members.gone(pred):
+                first, second = pred, succ
+            if (first, second) == (self._firstID, self._secondID):
+                return
+            self._stats.count("stabilizeRepairs")
+            self._firstID, self._secondID = first, second
+            self._cache.invalidate(first)
+            self._cache.invalidate(second)
+        print("Stabilized, my first successor is Peer {0} and my second "
+              "successor is Peer {1}".format(first, second))
+        self._saveSnapshot()
+        self._replicateChain()
+
+        # a new successor may not be the last one,
+        # ask it at once instead of a stabilize interval later
+        if first != succ:
+            try:
+                reqData("stabilize", self._nodeID, first,
+                        {"_nodeID": self._nodeID}).fulfill(self._pool)
+                self._stats.count("stabilizeMessages")
+            except OSError:
+                print("Peer {} is unreachable".format(first))
 
     # update the successor and second successor of a peer
     def __doUpdate(self, req):
@@ -392,24 +2134,78 @@ class DHTNode(object):
         self._secondID = int(content["_secondID"])
         print("My first successor ID is {}".format(self._firstID))
         print("My second successor ID is {}".format(self._secondID))
+        self._cache.invalidate(self._firstID)
+        self._cache.invalidate(self._secondID)
+        # a restarted peer taking its place back
+        if "incarnation" in content and req.src != self._nodeID:
+            self._members.apply(req.src, alive, int(content["incarnation"]))
+        if not self.__joined.is_set() and "_nodeID" in content:
+            self.__joinPred = int(content["_nodeID"])
+            # it is our predecessor even before it pings us,
+            # while the peer before it may ping us first
+            self._detector.heartbeat(self.__joinPred)
+        self.__markJoined()
 
         self.__lock.release()
+        self._saveSnapshot()
+        self._replicateChain()
+
+    # we know our successors, the joins which waited for them go on
+    def __markJoined(self):
+        with self.__lock:
+            self.__joined.set()
+            deferred, self.__deferredJoins = self.__deferredJoins, []
+        for req in deferred:
+            self._operationQueue.put((None, req, monotonic()),
+                                     priorityOf("join"))
 
     def __doJoin(self, req):
-        joinNode = int(req.getContent()["_nodeID"])
+        content = req.getContent()
+        joinNode = int(content["_nodeID"])
+        self._cache.invalidate(joinNode)
+
+        # a copy of a join which succeeded already, or of our own,
+        # nobody would ever find a place for it
+        if self.__joinStamps.get(joinNode) == req.stamp:
+            return
+
+        # a peer joining at the same time sent the join here before
+        # we knew our own successors, it is handled once we do
+        with self.__lock:
+            if not self.__joined.is_set():
+                self.__deferredJoins.append(req)
+                return
+
+        # our successor crashed and joins again under the same ID
+        # before anybody noticed, it takes its place back
+        # its second successor is repaired by its first stabilize
+        if joinNode == self._firstID:
+            print("\n ---- Peer {} joins again ----".format(joinNode))
+            self.__joinStamps[joinNode] = req.stamp
+            reqData(
+                "update", self._nodeID, joinNode,
+                {"_nodeID": self._nodeID, "_firstID": self._secondID,
+                 "_secondID": self._secondID}).fulfill(self._pool)
+            return
+
+        # a request jumped here through a finger was not sent by
+        # our predecessor, so we have to know the predecessor ourselves
+        viaFinger = int(content.get("viaFinger", 0)) == 1
+        predNode = self._predecessor() if viaFinger else req.src
 
         # found where to join!
-        if (((self._nodeID > self._firstID) and (joinNode > self._nodeID or joinNode < self._firstID)) \
-                or (joinNode > self._nodeID and joinNode < self._firstID)) and req.src != joinNode:
+        if between(joinNode, self._nodeID, self._firstID) and \
+                req.src != joinNode and predNode is not None:
             # print log
             print("\n ---- Peer {} join request received! ----".format(joinNode))
-            self.__lossCount = dict()
+            self.__joinStamps[joinNode] = req.stamp
+            self._detector.clear()
 
             # response the join node
             reqData(
                 "update", self._nodeID, joinNode,
-                "_nodeID: {}, _firstID: {}, _secondID: {}".format(
-                    self._nodeID, self._firstID, self._secondID)).fulfill()
+                {"_nodeID": self._nodeID, "_firstID": self._firstID,
+                 "_secondID": self._secondID}).fulfill(self._pool)
 
             # set new successor
             # self._secondID = self._firstID
@@ -422,23 +2218,35 @@ class DHTNode(object):
             # update itself
             reqData(
                 "update", self._nodeID, self._nodeID,
-                "_nodeID: {}, _firstID: {}, _secondID: {}".format(
-                    self._nodeID, joinNode, self._firstID)).fulfill()
+                {"_nodeID": self._nodeID, "_firstID": joinNode,
+                 "_secondID": self._firstID}).fulfill(self._pool)
 
             # inform other nodes to update them selves
-            
             reqData(
-                "update", self._nodeID, req.src,
-                "_nodeID: {}, _firstID: {}, _secondID: {}".format(
-                    self._nodeID, self._nodeID, joinNode)).fulfill()
+                "update", self._nodeID, predNode,
+                {"_nodeID": self._nodeID, "_firstID": self._nodeID,
+                 "_secondID": joinNode}).fulfill(self._pool)
             print("\n")
         else:
             # pass the request to successor
-            print("Peer {} join request forward to my successor".format(
-                joinNode))
-            req.dst = self._firstID
-            req.src = self._nodeID
-            req.fulfill()
+            # the last hop has to come from the predecessor of the
+            # peer where joinNode joins, so only jump when we are far away
+            hop = self._firstID
+            if not between(joinNode, self._nodeID, self._secondID):
+                finger = self._fingers.closestPreceding(joinNode)
+                if finger is not None:
+                    hop = finger
+            req.setContent(viaFinger=0 if hop == self._firstID else 1)
+            print("Peer {0} join request forward to Peer {1}".format(
+                joinNode, hop))
+            if self.__route(req, hop=hop) is None:
+                # the joining peer stops waiting for its update
+                try:
+                    reqData("unrouted", self._nodeID, joinNode,
+                            {"_nodeID": self._nodeID}, req.stamp
+                            ).fulfill(self._pool)
+                except OSError:
+                    print("Peer {} is unreachable".format(joinNode))
 
     def __doQuit(self, req):
         content = req.getContent()
@@ -446,131 +2254,963 @@ class DHTNode(object):
         fstNode = int(content["_firstID"])
         sndNode = int(content["_secondID"])
 
-        if quitNode in self.__lossCount:
-            del self.__lossCount[quitNode]
+        self._detector.remove(quitNode)
+        self._fingers.remove(quitNode)
+        self._cache.invalidate(quitNode)
+        if quitNode == self._predID:
+            self._predID = None
+        if "incarnation" in content:
+            self._members.apply(quitNode, left, int(content["incarnation"]))
 
         # all nodes know this node is leaving
         if self._nodeID == quitNode:
             return
 
-        reqData("quit", self._nodeID,
-                self._firstID, req.content).fulfill()
+        # a quit sent straight to us is passed on by gossip
+        if int(content.get("relay", 1)) == 1:
+            reqData("quit", self._nodeID,
+                    self._firstID, req.getContent()).fulfill(self._pool)
 
         # the pre-predecesor of leaving node
         # send an update request to itself
         if self._secondID == quitNode:
             print("\n ---- Peer {0} will depart from network ----".format(quitNode))
             reqData("update", self._nodeID, self._nodeID,
-                    "_nodeID: {0}, _firstID: {1}, _secondID: {2}".format(
-                        quitNode, self._firstID, fstNode
-                    )).fulfill()
+                    {"_nodeID": quitNode, "_firstID": self._firstID,
+                     "_secondID": fstNode}).fulfill(self._pool)
         # the predecesor of leaving node
         # send an update request to itself
         elif self._firstID == quitNode:
             print("\n ---- Peer {0} will depart from network ----".format(quitNode))
             reqData("update", self._nodeID, self._nodeID,
-                    "_nodeID: {0}, _firstID: {1}, _secondID: {2}".format(
-                        quitNode, fstNode, sndNode
-                    )).fulfill()
+                    {"_nodeID": quitNode, "_firstID": fstNode,
+                     "_secondID": sndNode}).fulfill(self._pool)
 
     def __doAbrupt(self, req):
         quitNode = int(req.getContent()["leaveNode"])
         informer = int(req.getContent()["_nodeID"])
+        self._fingers.remove(quitNode)
+        self._cache.invalidate(quitNode)
+        self._members.suspect(quitNode)
 
         # the informer will be the first successor of the quit node
         # the second successor will not send this request
         if informer == self._secondID:
             # update itself
-            reqData("update", self._nodeID, self._nodeID, "_firstID: {}, _secondID: {}".format(
-                self._secondID, req.getContent()["_firstID"]
-            )).fulfill()
-            # update the other predecessor
-            reqData("update", self._nodeID, req.src, "_firstID: {}, _secondID: {}".format(
-                self._nodeID, informer
-            )).fulfill()
+            reqData("update", self._nodeID, self._nodeID, {
+                "_firstID": self._secondID,
+                "_secondID": req.getContent()["_firstID"]}).fulfill(self._pool)
+            # update the other predecessor, an abrupt sent straight
+            # here did not come from it
+            pred = req.src
+            if int(req.getContent().get("relay", 1)) == 0:
+                pred = self._predecessor()
+            if pred is not None:
+                reqData("update", self._nodeID, pred, {
+                    "_firstID": self._nodeID,
+                    "_secondID": informer}).fulfill(self._pool)
 
         elif informer != self._nodeID and self._firstID != quitNode:
             req.src = self._nodeID
             req.dst = self._firstID
-            req.fulfill()
+            req.fulfill(self._pool)
 
         return
 
     def __doStore(self, req):
-        filename = req.getContent()["filename"]
+        content = req.getContent()
+        filename = content["filename"]
         fileHash = self._toHash(filename)
 
         if fileHash == None:
             return
 
         # This is the peer which should keep track of this file
-        if (fileHash >= req.src and fileHash <= self._nodeID) or \
-                (req.src > self._nodeID and (fileHash > req.src or fileHash <= self._nodeID)):
+        owner = self._isOwner(fileHash, req.src)
+        if int(content.get("direct", 0)) == 1:
+            owner = self.__ownsDirect(req, fileHash, filename)
+        if owner:
+            self._log(req.stamp,
+                      "\n ---- Store {0} request accepted ----".format(
+                          filename))
             self.putData(filename)
+            self._replicate([filename])
+            self.__answer(req, "stored")
         else:
-            print(
-                "Store {0} request forwarded to my successor".format(filename))
-            reqData("store", self._nodeID,
-                    self._firstID, req.content).fulfill()
+            hop = self.__route(req, fileHash)
+            if hop is None:
+                self.__answer(req, "unrouted")
+                return
+            self._log(req.stamp,
+                      "Store {0} request forwarded to Peer {1}".format(
+                          filename, hop))
+
+    # tell the peer which submitted req how it ended
+    # only requests submitted by a program want an answer
+    def __answer(self, req, opr):
+        content = req.getContent()
+        if int(content.get("ack", 0)) != 1:
+            return
+        try:
+            reqData(opr, self._nodeID, int(content["_nodeID"]),
+                    {"_nodeID": self._nodeID,
+                     "filename": content["filename"],
+                     "hops": int(content.get("hops", 0))},
+                    req.stamp).fulfill(self._pool)
+        except OSError:
+            print("Peer {} is unreachable".format(content["_nodeID"]))
+
+    # a store or request submitted here was answered
+    # a join or a request nobody could route fails
+    def __doAnswer(self, req):
+        content = req.getContent()
+        if req.opr == "unrouted" and "filename" not in content:
+            if not self.__joined.is_set():
+                self.__joinError = ConnectionError(
+                    "Peer {0} could not route the join".format(req.src))
+                self.__markJoined()
+            return
+        if req.opr == "unrouted":
+            self._resolve(req.stamp, error=ConnectionError(
+                "Peer {0} could not route file {1}".format(
+                    req.src, content["filename"])))
+        elif req.opr == "missing":
+            self._resolve(req.stamp, error=KeyError(content["filename"]))
+        else:
+            self._resolve(req.stamp, peer=int(content["_nodeID"]),
+                          hops=int(content.get("hops", 0)))
+
+    # the operation queue is full, the sender of req retries later
+    # it is called by the producer, so a request of our own is
+    # retried without a round trip through our socket
+    def __refuse(self, req):
+        self._stats.count("rejected" + req.opr.capitalize())
+        self._log(req.stamp, "Too busy for the {0} request of Peer {1}".format(
+            req.opr, req.src))
+        busy = reqData("busy", self._nodeID, req.src,
+                       dict(req.getContent(), rejected=req.opr), req.stamp)
+        if req.src == self._nodeID:
+            self.__doBusy(busy)
+            return
+        try:
+            busy.fulfill(self._pool)
+        except OSError:
+            print("Peer {} is unreachable".format(req.src))
+
+    # too many fetches or scans wait already, the one on sock is answered
+    # busy on its own connection, and its sender gives up on this peer
+    def __refuseHeld(self, req, sock):
+        self._stats.count("rejected" + req.opr.capitalize())
+        try:
+            sock.sendall(reqData("busy", self._nodeID, req.src,
+                                 {"_nodeID": self._nodeID,
+                                  "rejected": req.opr}, req.stamp).toFrame())
+        except OSError:
+            pass
+        sock.close()
+
+    # the peer we sent a request to was too busy for it
+    # the request is sent again after a backoff, busyRetries times
+    # before a request of our own fails
+    def __doBusy(self, req):
+        content = dict(req.getContent())
+        opr = content.pop("rejected")
+        attempt = int(content.get("attempt", 0))
+        if attempt >= busyRetries:
+            self._stats.count("busyGaveUp")
+            self._log(req.stamp, "Peer {0} is still busy, the {1} request "
+                      "is dropped".format(req.src, opr))
+            origin = int(content["_nodeID"])
+            if origin != self._nodeID:
+                # the peer which submitted it gives up as well
+                req.src, req.dst = self._nodeID, origin
+                try:
+                    req.fulfill(self._pool)
+                except OSError:
+                    print("Peer {} is unreachable".format(origin))
+                return
+            self._resolve(req.stamp, error=ConnectionRefusedError(
+                "Peer {0} is busy".format(req.src)))
+            return
+        self._stats.count("busyRetries")
+        content["attempt"] = attempt + 1
+        retry = reqData(opr, self._nodeID, req.src, content, req.stamp)
+        self._retries.call(backoff(attempt), self.__retry, retry)
+
+    def __retry(self, req):
+        try:
+            req.fulfill(self._pool)
+        except OSError as e:
+            print("Peer {} is unreachable".format(req.dst))
+            self._resolve(req.stamp, error=e)
+
+    # a request sent straight here from a cache or an iterative lookup
+    # is checked against our own range, a stale one walks the ring from here
+    # a peer which lost track of its predecessor only owns the ring alone
+    def __ownsDirect(self, req, key, filename):
+        pred = self._predecessor()
+        if pred is None and self._firstID == self._nodeID or \
+                pred is not None and betweenRight(key, pred, self._nodeID):
+            return True
+        self._log(req.stamp, "Peer {0} does not own file {1} any more".format(
+            self._nodeID, filename))
+        req.setContent(direct=0)
+        req.src = self._nodeID
+        return False
+
+    # answer a request of our own from the cache
+    # returns True if the request needs no ring walk
+    def __requestCached(self, req, filename, fileHash):
+        path = self._cache.getFile(filename)
+        if path is not None:
+            self._log(req.stamp,
+                      "File {0} was fetched recently, it is at {1}".format(
+                          filename, path))
+            self._resolve(req.stamp, peer=self._nodeID, hops=0,
+                          size=os.path.getsize(path))
+            return True
+
+        owner = self._cache.owner(fileHash)
+        if owner is None or owner == self._nodeID:
+            return False
+        req.setContent(direct=1)
+        hop = self.__route(req, hop=owner)
+        if hop != owner:
+            self._cache.invalidate(owner)
+        if hop is None:
+            req.setContent(direct=0)
+            req.src = self._nodeID
+            return False
+        self._log(req.stamp,
+                  "Request for file {0} sent straight to Peer {1}".format(
+                      filename, hop))
+        return True
 
     def __doRequest(self, req):
-        filename = req.getContent()["filename"]
+        content = req.getContent()
+        filename = content["filename"]
         fileHash = self._toHash(filename)
         fileData = False
 
         if fileHash is None:
             return
 
+        if req.src == self._nodeID and \
+                int(content["_nodeID"]) == self._nodeID and \
+                int(content.get("direct", 0)) == 0 and \
+                self.__requestCached(req, filename, fileHash):
+            return
+
+        pred = self._predecessor()
+        owner = self._isOwner(fileHash, req.src)
+        if int(content.get("direct", 0)) == 1:
+            owner = self.__ownsDirect(req, fileHash, filename)
+
         # request sent to the smallest peer
-        if (fileHash >= req.src and fileHash <= self._nodeID) or \
-                (req.src > self._nodeID and (fileHash > req.src or fileHash <= self._nodeID)):
-            fileData = self.fetchData(filename)
+        # a replica on the way answers as well as the owner,
+        # and stands in for an owner which left abruptly
+        if owner:
+            fileData = self.fetchData(filename) or filename in self._replicas
+            if not fileData:
+                self.__answer(req, "missing")
+        elif filename in self._replicas:
+            self._log(req.stamp,
+                      "Request for file {0} served from a replica".format(
+                          filename))
+            fileData = True
         else:
-            print("File is not here, request for file: {0}, request has been sent to my successor".format(
-                filename))
-            reqData("request", self._nodeID,
-                    self._firstID, req.content).fulfill()
-        fullPath = os.getcwd() + "/"
+            hop = self.__route(req, fileHash)
+            if hop is None:
+                self.__answer(req, "unrouted")
+                return
+            self._log(req.stamp,
+                      "File is not here, request for file: {0}, "
+                      "request has been sent to Peer {1}".format(
+                          filename, hop))
         if fileData is True:
-            files = os.listdir()
-            files = [x.split(".") for x in files]
-            for x in files:
-                if x[0] == filename:
-                    filename = ".".join(x)
-                    fullPath = fullPath + filename
-
-            dstPeer = int(req.getContent()["_nodeID"])
-            print("\n ---- File {0} is stored here! ----".format(filename))
-            print("Sending file {0} to Peer {1}...".format(
-                filename, dstPeer))
-            t = reqData("transfer", self._nodeID, dstPeer,
-                        "_nodeID: {0}, filename: {1}".format(
-                            self._nodeID, filename))
-            transferSocket = t.fulfill()
-            sleep(3)
-            with open(fullPath, "rb") as file:
-                while True:
-                    fileData = file.read(2048)
-                    if fileData:
-                        transferSocket.send(fileData)
-                    else:
-                        print("The file has been sent")
-                        break
+            entry = self._store.get(filename) or self._replicas.get(filename)
+            if entry is None or entry.path is None:
+                self._log(req.stamp,
+                          "File {0} is not in {1}".format(
+                              filename, self._dataDir))
+                self.__answer(req, "missing")
+                return
+            # a request of our own for a file we keep needs no transfer,
+            # sending it to ourselves could wait for a worker of ours
+            if int(content["_nodeID"]) == self._nodeID:
+                self._log(req.stamp, "File {0} is stored here, at {1}".format(
+                    filename, entry.path))
+                self._resolve(req.stamp, peer=self._nodeID,
+                              hops=int(content.get("hops", 0)),
+                              size=os.path.getsize(entry.path))
+                return
+            fields = dict()
+            if "hops" in content:
+                fields["hops"] = int(content["hops"])
+            # the requester may remember who owns the range
+            if owner and pred is not None:
+                fields["lo"] = pred
+            self.__sendFile(int(content["_nodeID"]), entry, req.stamp,
+                            **fields)
+
+    # send the file of entry to dstPeer on a connection of its own
+    # a file larger than chunkSize is announced with a manifest instead,
+    # and dstPeer fetches its chunks from us and the replicas
+    # fields are added to the content of the transfer
+    def __sendFile(self, dstPeer, entry, stamp, **fields):
+        filename = os.path.basename(entry.path)
+        self._log(stamp,
+                  "\n ---- File {0} is stored here! ----".format(filename))
+        digests = fileDigests(entry.path, chunkSize)
+        if os.path.getsize(entry.path) > chunkSize:
+            self._log(stamp,
+                      "Sending the manifest of file {0} to Peer {1}".format(
+                          filename, dstPeer))
+            reqData("manifest", self._nodeID, dstPeer,
+                    dict(fields, _nodeID=self._nodeID, filename=filename,
+                         name=entry.name,
+                         size=os.path.getsize(entry.path), chunk=chunkSize,
+                         digests=",".join(digests),
+                         holders=",".join(str(x) for x in
+                                          self.__holders(entry.name))),
+                    stamp).fulfill(self._pool)
+            return
+        self._log(stamp,
+                  "Sending file {0} to Peer {1}...".format(filename, dstPeer))
+        t = reqData("transfer", self._nodeID, dstPeer,
+                    {"_nodeID": self._nodeID, "filename": filename,
+                     "name": entry.name, "sha256": digests[0]}, stamp)
+        t.setContent(**fields)
+        transferSocket = socket(AF_INET, SOCK_STREAM)
+        try:
+            transferSocket.connect(toAddr(dstPeer))
+            sent, seconds, stream = sendFile(transferSocket, t, entry.path,
+                                             self._compressLevel)
+            self._stats.count("bytesSent", sent)
+            if stream is not None:
+                self.__compressed(stream, "compress")
+            self._log(stamp, "The file has been sent, {0} bytes at {1}{2}".format(
+                sent, rate(sent, seconds),
+                "" if stream is None else ", " + str(stream)))
+        finally:
             transferSocket.close()
 
-    def __doTransfer(self, req, conn):
-        print("\n ---- Transfer request received! ----")
-        srcPeer = req.getContent()["_nodeID"]
-        filename = req.getContent()["filename"]
-        print("Peer {0} had file {1}".format(srcPeer, filename))
-        print("Receiving File {0} from Peer {1}...".format(filename, srcPeer))
-        filename = "received_" + filename
-        with open(os.getcwd() + "/" + filename, "wb") as file:
+    # the peers a file can be fetched from, this peer first
+    # the owner knows the successors keeping the replicas
+    def __holders(self, filename):
+        holders = [self._nodeID]
+        if filename in self._store:
+            for peer in (self._firstID, self._secondID)[:self._replicaCount]:
+                if peer not in holders:
+                    holders.append(peer)
+        return holders
+
+    # serve the chunks a downloading peer asks for on conn
+    # the peer sends one fetch after the other on the same connection
+    def __doFetch(self, req, conn):
+        decoder = frameDecoder()
+        decoder.feed(req.payload)
+        try:
             while True:
-                fileData = conn.recv(2048)
-                if fileData:
-                    file.write(fileData)
+                content = req.getContent()
+                name = transferName(content)
+                entry = self._store.get(name) or self._replicas.get(name)
+                if entry is None or entry.path is None:
+                    conn.sendall(reqData(
+                        "missing", self._nodeID, req.src,
+                        {"_nodeID": self._nodeID,
+                         "filename": content["filename"]},
+                        req.stamp).toFrame())
                 else:
-                    print("File {0} received".format(filename))
-                    break
-        conn.close()
+                    sent = sendRange(conn, req, entry.path,
+                                     int(content["offset"]),
+                                     int(content["size"]))
+                    self._stats.count("bytesSent", sent)
+                req = decoder.next()
+                while req is None:
+                    data = conn.recv(65536)
+                    if not data:
+                        return
+                    decoder.feed(data)
+                    req = decoder.next()
+        except (OSError, ValueError) as e:
+            print("Fetch from Peer {0} stopped: {1}".format(req.src, e))
+        finally:
+            conn.close()
+
+    # download the file of a manifest in chunks
+    # the chunks verified before an interruption are kept,
+    # and a chunk failing its hash is fetched again from another holder
+    def __doManifest(self, req):
+        content = req.getContent()
+        filename = content["filename"]
+        try:
+            path = receivedPath(self._dataDir, filename)
+        except ValueError as e:
+            self._resolve(req.stamp, error=e)
+            return
+
+        # the same file is downloaded once at a time
+        with self.__lock:
+            running = self.__downloads.get(path)
+            if running is None:
+                self.__downloads[path] = Event()
+        if running is not None:
+            running.wait()
+            if os.path.exists(path):
+                self.__received(req, path, os.path.getsize(path), 0.0)
+            else:
+                self._resolve(req.stamp, error=IOError(
+                    "File {0} is incomplete".format(filename)))
+            return
+        try:
+            self.__download(req, path)
+        finally:
+            with self.__lock:
+                self.__downloads.pop(path).set()
+
+    def __download(self, req, path):
+        content = req.getContent()
+        filename = content["filename"]
+        holders = [int(x) for x in content["holders"].split(",")]
+        target = partialFile(path, int(content["size"]),
+                             int(content["chunk"]),
+                             content["digests"].split(","))
+        print("\n ---- Downloading file {0}, {1} chunks from Peers {2} ----"
+              .format(filename, len(target), content["holders"]))
+        if target.resumed > 0:
+            print("Resuming after {0} verified chunks".format(target.resumed))
+
+        todo = Queue()
+        for index in target.missing():
+            todo.put(index)
+        failures = dict()
+        streams = [Thread(target=self.__fetchStream,
+                          args=(target, filename, transferName(content),
+                                holders, i, todo, failures),
+                          name="download", daemon=True)
+                   for i in range(min(transferStreams, todo.qsize()))]
+        begin = perf_counter()
+        try:
+            for t in streams:
+                t.start()
+            for t in streams:
+                t.join()
+            seconds = perf_counter() - begin
+
+            # holders which failed leave verified chunks behind,
+            # the next download resumes from them
+            if not target.complete():
+                target.close()
+                print("File {0} is incomplete, {1} of {2} chunks "
+                      "verified".format(filename,
+                                        len(target) - len(target.missing()),
+                                        len(target)))
+                self._resolve(req.stamp, error=IOError(
+                    "File {0} is incomplete".format(filename)))
+                return
+            target.commit()
+        except Exception:
+            # anything else may have left chunks nobody verified
+            target.discard()
+            raise
+        self.__received(req, target.path, target.size, seconds,
+                        chunks=len(target), streams=len(streams))
+
+    # fetch chunks from the holders until todo is empty
+    # stream i starts with the i-th holder, and moves to the next one
+    # whenever a holder fails
+    def __fetchStream(self, target, filename, name, holders, i, todo,
+                      failures):
+        sock = None
+        decoder = None
+        while True:
+            try:
+                index = todo.get_nowait()
+            except Empty:
+                break
+            holder = holders[i % len(holders)]
+            offset, length = target.span(index)
+            try:
+                if sock is None:
+                    sock = socket(AF_INET, SOCK_STREAM)
+                    sock.settimeout(30)
+                    sock.connect(toAddr(holder))
+                    decoder = frameDecoder()
+                data = fetchRange(sock, decoder, self._nodeID, holder,
+                                  filename, name, offset, length)
+                if target.write(index, data):
+                    continue
+                print("Chunk {0} of file {1} from Peer {2} is corrupt".format(
+                    index, filename, holder))
+            except (OSError, ValueError, KeyError) as e:
+                print("Peer {0} failed to send chunk {1}: {2}".format(
+                    holder, index, repr(e)))
+            if sock is not None:
+                sock.close()
+                sock = None
+            i += 1
+            # every holder gets two chances at a chunk
+            with self.__lock:
+                failures[index] = failures.get(index, 0) + 1
+                retry = failures[index] < 2 * len(holders)
+            if retry:
+                todo.put(index)
+        if sock is not None:
+            sock.close()
+
+    # store or request the names of a batch for the peer submitting it
+    # names owned here are done here, the rest go on in one batch
+    # per next hop, so that a bulk load costs about owners x hops
+    # requests instead of names x hops
+    # every peer doing a part answers the submitter once
+    def __doBatch(self, req):
+        content = req.getContent()
+        kind = content["kind"]
+        origin = int(content["_nodeID"])
+        hops = int(content.get("hops", 0))
+        names = splitNames(content["names"])
+
+        # a replica on the way serves a request as well as the owner
+        mine, missing, groups = [], [], dict()
+        for name in names:
+            key = self._toHash(name)
+            if key is None:
+                missing.append(name)
+            elif self._isOwner(key, req.src) or \
+                    (kind == "request" and name in self._replicas):
+                mine.append(name)
+            else:
+                groups.setdefault(self._nextHop(key), []).append(name)
+
+        for hop, group in groups.items():
+            part = reqData("batch", self._nodeID, hop,
+                           dict(content, names=joinNames(group)),
+                           req.stamp)
+            hop = self.__route(part, hop=hop)
+            if hop is None:
+                missing.extend(group)
+            else:
+                self._log(req.stamp,
+                          "Batch {0} of {1} files forwarded to "
+                          "Peer {2}".format(kind, len(group), hop))
+
+        done = []
+        if kind == "store" and len(mine) > 0:
+            self._log(req.stamp,
+                      "\n ---- Store {0} files request accepted ----".format(
+                          len(mine)))
+            self._store.putMany(mine)
+            self._replicate(mine)
+            done = mine
+        elif kind == "request":
+            for name in mine:
+                entry = self._store.get(name) or self._replicas.get(name)
+                if entry is None or entry.path is None:
+                    missing.append(name)
+                    continue
+                try:
+                    self.__sendFile(origin, entry, req.stamp, hops=hops)
+                    done.append(name)
+                except OSError:
+                    print("Peer {} is unreachable".format(origin))
+                    missing.append(name)
+
+        if len(done) == 0 and len(missing) == 0:
+            return
+        try:
+            reqData("batched", self._nodeID, origin,
+                    {"_nodeID": self._nodeID, "kind": kind,
+                     "done": joinNames(done),
+                     "missing": joinNames(missing),
+                     "hops": hops}, req.stamp).fulfill(self._pool)
+        except OSError:
+            print("Peer {} is unreachable".format(origin))
+
+    # a peer did its part of a batch submitted here
+    def __doBatched(self, req):
+        content = req.getContent()
+        done = splitNames(content["done"])
+        missing = splitNames(content["missing"])
+        with self.__lock:
+            state = self.__batches.get(req.stamp)
+            if state is None:
+                return
+            waiting = state["waiting"]
+            state["done"] += len([x for x in done if x in waiting])
+            state["missing"].extend(x for x in missing if x in waiting)
+            waiting.difference_update(done)
+            waiting.difference_update(missing)
+            state["peers"].add(int(content["_nodeID"]))
+            state["hops"] = max(state["hops"], int(content.get("hops", 0)))
+            if len(waiting) > 0:
+                return
+            del self.__batches[req.stamp]
+        self._finishBatch(state)
+
+    # find the successor of a finger start for the peer asking
+    def __doLookup(self, req):
+        content = req.getContent()
+        key = int(content["key"])
+
+        if self._isOwner(key, req.src):
+            reqData("found", self._nodeID, int(content["_nodeID"]),
+                    {"_nodeID": self._nodeID, "key": key,
+                     "slot": content["slot"]},
+                    req.stamp).fulfill(self._pool)
+        else:
+            self.__route(req, key)
+
+    # the answer of a lookup sent by _fixFingers
+    def __doFound(self, req):
+        content = req.getContent()
+        self._fingers.update(int(content["slot"]), int(content["_nodeID"]))
+
+    # name the peer owning the key of an iterative lookup on conn,
+    # or the best next hop towards it and our successors
+    def __doHop(self, req, conn):
+        key = int(req.getContent()["key"])
+        content = {"_nodeID": self._nodeID, "_firstID": self._firstID,
+                   "_secondID": self._secondID}
+        pred = self._predecessor()
+        if self._firstID == self._nodeID or \
+                pred is not None and betweenRight(key, pred, self._nodeID):
+            content.update(owner=self._nodeID, backup=self._firstID)
+        elif betweenRight(key, self._nodeID, self._firstID):
+            content.update(owner=self._firstID, backup=self._secondID)
+        else:
+            content.update(next=self._nextHop(key))
+        try:
+            conn.sendall(reqData("hopped", self._nodeID, req.src, content,
+                                 req.stamp).toFrame())
+        except OSError:
+            print("Peer {} is unreachable".format(req.src))
+
+    # a page of our keys for a scan on conn, with our successors,
+    # so that the scan can go on around the ring
+    def __doScan(self, req, conn):
+        content = req.getContent()
+        limit = max(1, min(int(content.get("limit", scanPageSize)),
+                           scanPageMax))
+        try:
+            conn.sendall(reqData("scanned", self._nodeID, req.src,
+                                 self._scanContent(
+                                     int(content.get("lo", 0)),
+                                     int(content.get("hi", 0)), limit,
+                                     content.get("after")),
+                                 req.stamp).toFrame())
+        except OSError:
+            print("Peer {} is unreachable".format(req.src))
+
+    # find the owner of a submitted request hop by hop, then send the
+    # request straight to it, or to its successor if it is gone
+    # a lookup nobody could finish walks the ring as usual
+    def __iterate(self, req):
+        content = req.getContent()
+        filename = content["filename"]
+        key = self._toHash(filename)
+        if key is None:
+            self._resolve(req.stamp, error=ValueError(
+                "Invalid filename {0}".format(filename)))
+            return
+
+        pred = self._predecessor()
+        rounds = 0
+        if self._firstID == self._nodeID or \
+                pred is not None and betweenRight(key, pred, self._nodeID):
+            owner, backup = self._nodeID, None
+        elif betweenRight(key, self._nodeID, self._firstID):
+            owner, backup = self._firstID, self._secondID
+        elif req.opr == "request" and self._cache.owner(key) is not None:
+            owner, backup = self._cache.owner(key), None
+        else:
+            lookup = iterativeLookup(
+                key, [p for p in (self._nextHop(key), self._firstID,
+                                  self._secondID) if p != self._nodeID],
+                lookupParallel, 2 * keySpace.ringBits + 2)
+            peers = lookup.next()
+            while peers:
+                self._stats.count("hopQueries", len(peers))
+                replies = askHops(self._nodeID, peers, key, req.stamp,
+                                  hopTimeout)
+                for peer in peers:
+                    if peer in replies:
+                        lookup.answer(peer, replies[peer])
+                    else:
+                        self._stats.count("hopTimeouts")
+                        self._log(req.stamp, "Peer {0} did not answer the "
+                                  "lookup for file {1}".format(peer, filename))
+                        lookup.fail(peer)
+                        self._fingers.remove(peer)
+                peers = lookup.next()
+            owner, backup, rounds = lookup.owner, lookup.fallback(), \
+                lookup.rounds
+
+        # the request itself is one more hop unless it stays here
+        hops = rounds if owner == self._nodeID else rounds + 1
+        req.setContent(direct=1, hops=hops)
+        for dst in (owner, backup):
+            if dst is None:
+                continue
+            req.dst = dst
+            try:
+                req.fulfill(self._pool)
+                self._log(req.stamp, "Request for file {0} sent straight to "
+                          "Peer {1} after {2} lookup rounds".format(
+                              filename, dst, rounds))
+                return
+            except OSError:
+                print("Peer {} is unreachable".format(dst))
+
+        self._stats.count("lookupFallbacks")
+        self._log(req.stamp, "Lookup for file {0} failed, the request walks "
+                  "the ring".format(filename))
+        req.setContent(direct=0, hops=0)
+        req.dst = self._nodeID
+        try:
+            req.fulfill(self._pool)
+        except OSError as e:
+            self._resolve(req.stamp, error=e)
+
+    # hand the keys in (lo, hi] over to peer
+    # they are kept as replicas if peer precedes this peer
+    # a range with lo == hi stands for every key
+    # returns the number of keys and bytes sent
+    def _handoff(self, peer, lo, hi, keepReplicas=True):
+        names = [e.name for e in self._store.select(
+            lambda k: betweenRight(k, lo, hi))]
+        if len(names) == 0:
+            print("No keys to hand over to Peer {0}".format(peer))
+            return 0, 0
+
+        sent = 0
+        begin = perf_counter()
+        for req in nameBatches("handoff", self._nodeID, peer, names):
+            data = req.toFrame()
+            self._pool.send(peer, data)
+            sent += len(data)
+            content = req.getContent()
+            print("Handoff to Peer {0}: batch {1}/{2}".format(
+                peer, content["batch"], content["batches"]))
+        self._stats.count("handoffBytes", sent)
+        if keepReplicas:
+            self._replicas.putMany(names)
+        self._store.removeMany(names)
+        print("Handed {0} keys over to Peer {1}, {2} bytes at {3}".format(
+            len(names), peer, sent, rate(sent, perf_counter() - begin)))
+        return len(names), sent
+
+    # a new predecessor asks for the keys it owns now
+    def __doPull(self, req):
+        content = req.getContent()
+        joinNode = int(content["_nodeID"])
+        print("\n ---- Peer {0} asks for its keys ----".format(joinNode))
+        # the joining peer is our predecessor now,
+        # even if it has not pinged us yet or we saw it die before
+        self._detector.heartbeat(joinNode)
+        if "incarnation" in content:
+            self._members.apply(joinNode, alive, int(content["incarnation"]))
+        with self.__lock:
+            if self.__closerPred(joinNode):
+                self._predID = joinNode
+        self._saveSnapshot()
+        self._handoff(joinNode, int(content["key"]), joinNode)
+
+    def __doHandoff(self, req):
+        content = req.getContent()
+        names = splitNames(content["names"])
+        count = self._store.putMany(names)
+        self._replicas.removeMany(names)
+        # batches are handled by several workers in any order
+        with self.__lock:
+            done = self.__handoffs.get(req.src, 0) + 1
+            self.__handoffs[req.src] = done
+            if done == content["batches"]:
+                del self.__handoffs[req.src]
+        print("Handoff from Peer {0}: {1}/{2} batches, {3} keys".format(
+            req.src, done, content["batches"], count))
+        if done == content["batches"]:
+            print("Handoff from Peer {0} done, {1} keys kept here".format(
+                req.src, len(self._store)))
+
+        # keys in front of our predecessor arrived after it joined,
+        # they are its own
+        pred = self._predID
+        if pred is not None and pred != req.src and \
+                not self._members.gone(pred) and \
+                any(not betweenRight(toHash(n), pred, self._nodeID)
+                    for n in names):
+            self._handoff(pred, self._nodeID, pred)
+
+        # the successors copied our keys before these arrived
+        self._replicate([n for n in names if n in self._store])
+
+    # copy names to the next replicaCount successors
+    # copy names to ttl successors from dst on, the whole chain by default
+    def _replicate(self, names, dst=None, ttl=None):
+        dst = self._firstID if dst is None else dst
+        ttl = self._replicaCount if ttl is None else ttl
+        if ttl < 1 or dst == self._nodeID or len(names) == 0:
+            return
+        try:
+            for req in nameBatches("replicate", self._nodeID, dst,
+                                   names, ttl=ttl):
+                req.fulfill(self._pool)
+        except OSError:
+            print("Peer {} is unreachable".format(dst))
+
+    # keep a copy of names for their owner and pass them on
+    # until ttl successors have them
+    def __doReplicate(self, req):
+        content = req.getContent()
+        owner = int(content["_nodeID"])
+        if owner == self._nodeID:
+            return
+        names = splitNames(content["names"])
+        self._replicas.putMany(names)
+
+        ttl = int(content["ttl"]) - 1
+        if ttl > 0 and self._firstID not in (owner, self._nodeID):
+            req.setContent(ttl=ttl)
+            self.__route(req, hop=self._firstID)
+
+    # the replicas of a predecessor which left are owned by us now,
+    # and copied to our successors
+    # our keys go to the successors which joined the chain, and the
+    # replicas nobody before us owns any more expire
+    def _repairReplicas(self):
+        pred = self._predecessor()
+        if pred is not None:
+            names = [e.name for e in self._replicas.select(
+                lambda k: betweenRight(k, pred, self._nodeID))]
+            if len(names) > 0:
+                self._store.putMany(names)
+                self._replicas.removeMany(names)
+                print("Promoted {0} replicas, {1} keys kept here".format(
+                    len(names), len(self._store)))
+                self._replicate(names)
+        self._replicateChain()
+        self._expireReplicas()
+
+    # copy our keys to the successors new in the chain,
+    # right away and not a ping interval later
+    # a successor which left the chain lets its copies expire
+    def _replicateChain(self):
+        with self.__lock:
+            old = self.__replicaChain
+            chain = replicaChain(self._nodeID, self._firstID, self._secondID,
+                                 self._replicaCount)
+            if chain == old:
+                return
+            self.__replicaChain = chain
+        added = chainAdditions(old, chain, self._replicaCount)
+        if len(added) > 0:
+            names = [e.name for e in self._store.entries()]
+            for peer, ttl in added:
+                self._replicate(names, peer, ttl)
+
+    # drop the replicas which stayed replicaExpiry seconds outside the
+    # keys of the replicaCount live peers before us
+    def _expireReplicas(self):
+        preds = self._members.predecessors(self._replicaCount + 1)
+        if len(preds) <= self._replicaCount:
+            return
+        now = monotonic()
+        strays = dict((e.name, self.__strays.get(e.name, now))
+                      for e in self._replicas.select(
+                          lambda k: not betweenRight(k, preds[-1],
+                                                     self._nodeID)))
+        expired = [name for name, since in strays.items()
+                   if now - since >= replicaExpiry]
+        for name in expired:
+            del strays[name]
+        self.__strays = strays
+        if len(expired) > 0:
+            self._replicas.removeMany(expired)
+            print("Dropped {0} replicas of keys owned further back".format(
+                len(expired)))
+
+    def __doTransfer(self, req, conn):
+        self._log(req.stamp, "\n ---- Transfer request received! ----")
+        content = req.getContent()
+        srcPeer = content["_nodeID"]
+        filename = content["filename"]
+        size = content.get("size")
+        self._log(req.stamp, "Peer {0} had file {1}".format(srcPeer, filename))
+        self._log(req.stamp,
+                  "Receiving File {0} from Peer {1}...".format(
+                      filename, srcPeer))
+        try:
+            path = receivedPath(self._dataDir, filename)
+        except ValueError as e:
+            conn.close()
+            self._resolve(req.stamp, error=e)
+            return
+        partPath = "{0}.{1}.part".format(path, req.stamp)
+
+        # accept the codec the sender offers if we know it
+        codec = content.get("codec")
+        if codec not in codecs:
+            codec = None
+        sink = None
+        try:
+            # tell the sender to start, old senders never wait for it
+            conn.sendall(reqData("ready", self._nodeID, req.src,
+                                 {} if codec is None else {"codec": codec})
+                         .toFrame())
+            if codec is None:
+                received, seconds = recvFile(
+                    conn, partPath, None if size is None else int(size),
+                    req.payload)
+            else:
+                received, seconds, sink = recvCompressed(
+                    conn, partPath, req.payload)
+        except Exception:
+            # a transfer is never resumed, what arrived of it is useless
+            if os.path.exists(partPath):
+                os.remove(partPath)
+            raise
+        finally:
+            conn.close()
+        if sink is not None:
+            self.__compressed(sink, "decompress")
+            self._log(req.stamp, "File {0} arrived as {1}".format(
+                filename, sink))
+
+        # the file only replaces an older copy once it is complete
+        error = None
+        if size is not None and received < int(size):
+            error = "File {0} is truncated, {1} of {2} bytes received".format(
+                filename, received, size)
+        elif "sha256" in content and \
+                readDigests(partPath, chunkSize)[0] != content["sha256"]:
+            error = "File {0} is corrupt".format(filename)
+        if error is not None:
+            print(error)
+            os.remove(partPath)
+            self._resolve(req.stamp, error=IOError(error))
+            return
+        os.replace(partPath, path)
+        self.__received(req, path, received, seconds)
+
+    # count what a zlib stream or sink saved and cost
+    def __compressed(self, codec, what):
+        self._stats.count("wireBytes" + ("Sent" if what == "compress"
+                                         else "Received"), codec.wire)
+        self._stats.observe(what + "CpuSeconds", codec.cpu)
+        self._stats.observe("compressionRatio", codec.ratio(), ratioBuckets)
+
+    # a file requested here arrived at path
+    def __received(self, req, path, received, seconds, **result):
+        content = req.getContent()
+        srcPeer = int(content["_nodeID"])
+        self._stats.count("bytesReceived", received)
+        self._stats.observe("transferSeconds", seconds)
+        self._log(req.stamp, "File {0} received, {1} bytes at {2}".format(
+            os.path.basename(path), received, rate(received, seconds)))
+        if "lo" in content:
+            self._cache.put(int(content["lo"]), srcPeer, srcPeer)
+        self._cache.putFile(transferName(content), path, received)
+        self._resolve(req.stamp, peer=srcPeer,
+                      hops=int(content.get("hops", 0)),
+                      size=received, transferSeconds=seconds, **result)
@@ -0,0 +1,188 @@
+from threading import Condition, Thread
+from time import monotonic
+from itertools import count
+from random import uniform
+
+import asyncio
+import heapq
+
+# priorities of the operations waiting for a worker, lower goes first
+# routing changes and the answers finishing accepted work beat
+# moving data, which beats new bulk work
+controlPriority = 0
+dataPriority = 1
+bulkPriority = 2
+
+oprPriority = {
+    "exit": controlPriority, "update": controlPriority,
+    "join": controlPriority, "quit": controlPriority,
+    "abrupt": controlPriority, "pull": controlPriority,
+    "stored": controlPriority, "missing": controlPriority,
+    "unrouted": controlPriority,
+    "found": controlPriority, "batched": controlPriority,
+    "hop": controlPriority, "busy": controlPriority,
+    "stabilize": controlPriority, "stabilized": controlPriority,
+    "store": bulkPriority, "request": bulkPriority, "batch": bulkPriority}
+
+# requests waiting beyond the limit are refused with a busy reply,
+# the sender retries busyRetries times, backing off from busyBackoff
+# seconds and doubling the wait every time
+queueLimit = 256
+busyRetries = 5
+busyBackoff = 0.05
+
+# a fetch or a scan holds its connection while it waits, beyond this
+# many of them waiting the connection is answered busy and closed
+heldLimit = 64
+
+
+def priorityOf(opr):
+    return oprPriority.get(opr, dataPriority)
+
+
+# seconds to wait before retry attempt of a refused request,
+# jittered so that the senders refused together do not return together
+def backoff(attempt):
+    return busyBackoff * (2 ** attempt) * uniform(0.5, 1.5)
+
+
+# the operation queue of a threaded peer
+# items come out by priority, in arrival order within a priority
+# only bulk work is refused once limit items are waiting, the rest is
+# accepted work or keeps the ring together and is never dropped
+class admissionQueue(object):
+    def __init__(self, limit=queueLimit, heldLimit=heldLimit):
+        self._limit = limit
+        self._heldLimit = heldLimit
+        self._heap = []
+        self._held = 0
+        self._order = count()
+        self._ready = Condition()
+        self.admitted = 0
+        self.rejected = 0
+
+    # held items hold a connection while they wait
+    # returns False if the item was refused
+    def put(self, item, priority=dataPriority, held=False):
+        with self._ready:
+            if priority >= bulkPriority and len(self._heap) >= self._limit or \
+                    held and self._held >= self._heldLimit:
+                self.rejected += 1
+                return False
+            heapq.heappush(self._heap,
+                           (priority, next(self._order), item, held))
+            self._held += held
+            self.admitted += 1
+            self._ready.notify()
+        return True
+
+    def get(self):
+        with self._ready:
+            while not self._heap:
+                self._ready.wait()
+            entry = heapq.heappop(self._heap)
+            self._held -= entry[3]
+            return entry[2]
+
+    def qsize(self):
+        with self._ready:
+            return len(self._heap)
+
+
+# the same for a peer on an asyncio event loop
+# a task takes one of slots before it runs, the waiting tasks get the
+# free slots by priority, and bulk work is refused once limit tasks wait
+class prioritySlots(object):
+    def __init__(self, slots, limit=queueLimit, heldLimit=heldLimit):
+        self._free = slots
+        self._limit = limit
+        self._heldLimit = heldLimit
+        self._waiters = []
+        self._held = 0
+        self._order = count()
+        self.admitted = 0
+        self.rejected = 0
+
+    # may a task of priority wait for a slot,
+    # held if it holds a connection meanwhile
+    def admit(self, priority, held=False):
+        if priority >= bulkPriority and len(self._waiters) >= self._limit or \
+                held and self._held >= self._heldLimit:
+            self.rejected += 1
+            return False
+        self.admitted += 1
+        return True
+
+    async def acquire(self, priority=dataPriority, held=False):
+        if self._free > 0 and not self._waiters:
+            self._free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        self._held += held
+        try:
+            await future
+        except asyncio.CancelledError:
+            # a slot handed to a cancelled task goes to the next one
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            self._held -= held
+
+    def release(self):
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self._free += 1
+
+    def qsize(self):
+        return len(self._waiters)
+
+
+# runs the busy retries of a threaded peer
+# one thread sleeps until the earliest retry is due, instead of a timer
+# thread for every refused request
+class retryScheduler(object):
+    def __init__(self):
+        self._heap = []
+        self._order = count()
+        self._ready = Condition()
+        self._closed = False
+        self._thread = Thread(target=self.__loop, name="retry", daemon=True)
+        self._thread.start()
+
+    # call fn(*args) in delay seconds
+    def call(self, delay, fn, *args):
+        with self._ready:
+            heapq.heappush(self._heap,
+                           (monotonic() + delay, next(self._order), fn, args))
+            self._ready.notify()
+
+    def __loop(self):
+        while True:
+            with self._ready:
+                while not self._closed and (not self._heap or
+                                            self._heap[0][0] > monotonic()):
+                    self._ready.wait(self._heap[0][0] - monotonic()
+                                     if self._heap else None)
+                if self._closed:
+                    return
+                due, order, fn, args = heapq.heappop(self._heap)
+            # a failing retry must not stop the ones after it
+            try:
+                fn(*args)
+            except Exception as e:
+                print("Retry failed: {}".format(e))
+
+    # the retries still waiting are dropped
+    def close(self):
+        with self._ready:
+            self._closed = True
+            self._ready.notify()
+
+    def qsize(self):
+        with self._ready:
+            return len(self._heap)
@@ -0,0 +1,2319 @@
+from time import time_ns, monotonic, perf_counter
+
+import asyncio
+import json
+import sys
+import os
+
+import DHTNode
+import keySpace
+from DHTNode import reqData, frameDecoder, toPort, toHash, routingOprs, rate, \
+    nameBatches, commandNames, printBatch, printAnswer, controlPath, \
+    resultContent, scanResult, snapshotPath, heldOprs, mergePages, orphanRange, \
+    joinNames, splitNames, receivedPath, replicaChain, chainAdditions, \
+    transferName
+from fingerTable import fingerTable, between, betweenRight, ownsKey
+from keySpace import distance, virtualIDs
+from metrics import opStats, traceLog, writeAtomic, hopBuckets, ratioBuckets
+from objectStore import objectStore
+from lookupCache import lookupCache
+from iterativeLookup import iterativeLookup
+from failureDetector import failureDetector
+from membership import memberList, alive, left
+from chunkedFile import partialFile, fileDigests, readDigests
+from streamCodec import codecs, worthCompressing, zlibStream, zlibSink
+from nodeSnapshot import nodeSnapshot, recordedPeers, rejoinPlace
+from admission import prioritySlots, priorityOf, backoff, queueLimit, \
+    busyRetries
+
+
+# receives the pings of other nodes
+class pingProtocol(asyncio.DatagramProtocol):
+    def __init__(self, node):
+        self._node = node
+
+    def datagram_received(self, data, addr):
+        self._node._onPing(data)
+
+
+# the same peer as DHTNode, running on an asyncio event loop
+# every socket is served by the loop and every request is a task,
+# so one process can host hundreds of peers
+# it speaks the same protocol and interoperates with DHTNode peers
+class asyncDHTNode(object):
+    def __init__(self, ID, pingInterval, *, interactive=True, concurrency=64,
+                 dataDir=None, replicas=DHTNode.replicaFactor, cacheFiles=0,
+                 verbose=True, metricsDir=None, traceSample=0,
+                 compressLevel=0, control=False, queueLimit=queueLimit,
+                 stabilizeInterval=DHTNode.stabilizeInterval):
+        self._nodeID = ID
+
+        # files this peer keeps track of, indexed by name and hash
+        self._dataDir = dataDir if dataDir is not None else os.getcwd()
+        self._store = objectStore(self._dataDir, os.path.join(
+            self._dataDir, ".peer{0}.index".format(ID)), toHash)
+
+        # copies of the keys owned by the peers before this one,
+        # and the successors our own keys were copied to last
+        self._replicaCount = replicas
+        self._replicas = objectStore(self._dataDir, os.path.join(
+            self._dataDir, ".peer{0}.replicas".format(ID)), toHash)
+        self._replicaChain = None
+        self._strays = dict()
+
+        # our successors, predecessor and fingers, read back by a restart
+        self._snapshot = nodeSnapshot(snapshotPath(self._dataDir, ID))
+
+        # owners of the keys we requested, and the last cacheFiles
+        # files we fetched, so that hot keys skip the ring walk
+        self._cache = lookupCache(fileCapacity=cacheFiles)
+
+        # files we send are offered as zlib streams at this level,
+        # 0 sends them as they are
+        self._compressLevel = compressLevel
+
+        self._firstID = 0
+        self._secondID = 0
+        self._pingInterval = int(pingInterval)
+
+        # the predecessor as told by the peers stabilizing with us,
+        # see DHTNode._predID
+        self._predID = None
+        self._stabilizeInterval = stabilizeInterval
+
+        # read commands from the terminal
+        self._interactive = interactive
+
+        # programs connect to the control socket to submit requests
+        self._controlPath = controlPath(self._dataDir, ID) if control \
+            else None
+        self._controlServer = None
+
+        # watches the peers pinging us, the closest one is
+        # our predecessor and a silent one left abruptly
+        self._detector = failureDetector(self._pingInterval)
+        # every peer we heard of, kept up to date by gossip
+        # piggybacked on the pings
+        self._members = memberList(
+            ID, suspectTimeout=max(10, 3 * self._pingInterval))
+        # pings and the handling of every request are printed
+        # when verbose
+        self._verbose = verbose
+
+        # Chord-style fingers used to shortcut lookups
+        self._fingers = fingerTable(ID)
+
+        # long-lived connections to other nodes
+        # peer -> [writer, last time used]
+        self._conns = dict()
+        self._connLocks = dict()
+        self._idleTimeout = 60
+        self._poolCounters = dict.fromkeys(
+            ("hits", "misses", "reconnects", "evictions", "adopted",
+             "messages", "bytes"), 0)
+
+        # stamp -> (future, time submitted) of every store and
+        # request submitted here which is not answered yet
+        self._pending = dict()
+
+        # stamp -> what came back so far of every batch submitted here
+        self._batches = dict()
+
+        # requests changing the routing state are handled in order,
+        # the rest run as tasks, at most concurrency at once
+        # the tasks waiting get the free slots by priority, and new store
+        # and request work is refused once queueLimit are waiting
+        self._concurrency = concurrency
+        self._queueLimit = queueLimit
+        self._routingQueue = None
+        self._slots = None
+
+        # queue depth and latency of every operation, written to
+        # metricsDir/peer<ID>.prom every ping interval
+        self._stats = opStats()
+        self._metricsDir = metricsDir
+        if metricsDir is not None:
+            os.makedirs(metricsDir, exist_ok=True)
+
+        # one request stamp in traceSample is followed through the ring
+        # in metricsDir/trace<ID>.jsonl
+        self._trace = None
+        if metricsDir is not None and traceSample > 0:
+            self._trace = traceLog(os.path.join(
+                metricsDir, "trace{0}.jsonl".format(ID)), traceSample)
+
+        self._server = None
+        self._pingTransport = None
+        self._tasks = set()
+        self._joined = None
+        self._joinPred = None
+        self._joinError = None
+
+        # joining peer -> stamp of the last join of it we placed,
+        # see DHTNode.__doJoin
+        self._joinStamps = dict()
+
+        # peer -> number of handoff batches received from it
+        self._handoffs = dict()
+
+        # path -> Event set once the chunked download to path ended
+        self._downloads = dict()
+        self._stopped = None
+
+    @property
+    def _nodePort(self):
+        return toPort(self._nodeID)
+
+    # start node service
+    # returns once the node is part of the DHT
+    async def start(self, startType, *, knownNode=None, fst=None, snd=None):
+        loop = asyncio.get_running_loop()
+        self._routingQueue = asyncio.Queue()
+        self._slots = prioritySlots(self._concurrency, self._queueLimit)
+        # fetches and downloads hold their slot while the file moves,
+        # they get slots of their own, see DHTNode.fetchWorkers
+        self._fetchSlots = prioritySlots(DHTNode.fetchWorkers,
+                                         heldLimit=DHTNode.fetchWorkers)
+        self._downloadSlots = prioritySlots(DHTNode.downloadWorkers)
+        self._joined = asyncio.Event()
+        self._stopped = asyncio.Event()
+
+        self._server = await asyncio.start_server(
+            self._onConnection, "127.0.0.1", self._nodePort,
+            reuse_address=True)
+        self._spawn(self.__routingLoop())
+
+        # a peer which did not get into the ring closes what it opened
+        try:
+            if startType == "init":
+                self._firstID = fst
+                self._secondID = snd
+                self._joined.set()
+            elif startType == "join":
+                await self.__join(knownNode)
+            elif startType == "restart":
+                await self.__restart(knownNode)
+        except BaseException:
+            await self.close()
+            raise
+
+        self._pingTransport, protocol = await loop.create_datagram_endpoint(
+            lambda: pingProtocol(self),
+            local_addr=("127.0.0.1", DHTNode.basePort + self._nodePort))
+        self._spawn(self.__pingLoop())
+        self._spawn(self.__detectLoop())
+        self._spawn(self.__fingerLoop())
+        self._spawn(self.__stabilizeLoop())
+        if self._interactive:
+            self._spawn(self.__commandLoop())
+        if self._controlPath is not None:
+            if os.path.exists(self._controlPath):
+                os.remove(self._controlPath)
+            self._controlServer = await asyncio.start_unix_server(
+                self._onControl, self._controlPath)
+
+        print("Start peer {0} at port {1}".format(
+            self._nodeID, self._nodePort))
+        print("Peer {0} can find first successor on port ".format(self._nodeID)
+              + "{0} and second successor on port {1}".format(
+            toPort(self._firstID), toPort(self._secondID)))
+
+    async def __join(self, knownNode):
+        begin = monotonic()
+        req = reqData("join", self._nodeID, knownNode,
+                      {"_nodeID": self._nodeID})
+        self._joinStamps[self._nodeID] = req.stamp
+        await self._send(req)
+        try:
+            await asyncio.wait_for(self._joined.wait(), DHTNode.joinTimeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("Nobody placed Peer {0} joining through "
+                               "Peer {1}".format(self._nodeID, knownNode))
+        if self._joinError is not None:
+            raise self._joinError
+        self._stats.observe("joinSeconds", monotonic() - begin)
+        print("\n ---- Join request has been accepted ----")
+
+        # the keys between the predecessor and this peer
+        # are kept by the successor until now
+        if self._joinPred is not None:
+            await self._send(reqData(
+                "pull", self._nodeID, self._firstID,
+                {"_nodeID": self._nodeID, "key": self._joinPred,
+                 "incarnation": self._members.incarnation}))
+
+    # take back the place saved in our snapshot,
+    # see DHTNode.__restart
+    async def __restart(self, knownNode=None):
+        begin = monotonic()
+        state = self._snapshot.load()
+        peers, replies = [], dict()
+        if state is not None:
+            peers = recordedPeers(state, self._nodeID)
+            self._stats.count("hopQueries", len(peers))
+            stamp = time_ns()
+            answers = await asyncio.gather(*[asyncio.wait_for(
+                self._askHop(peer, self._nodeID, stamp), DHTNode.hopTimeout)
+                for peer in peers], return_exceptions=True)
+            replies = dict((peer, answer)
+                           for peer, answer in zip(peers, answers)
+                           if not isinstance(answer, Exception))
+        place = None if state is None else \
+            rejoinPlace(state, self._nodeID, replies)
+
+        if place is None:
+            self._stats.count("coldRestarts")
+            live = [p for p in peers if p in replies]
+            if live:
+                knownNode = live[0]
+            if knownNode is None:
+                raise ConnectionError(
+                    "No peer of the snapshot of Peer {0} answered".format(
+                        self._nodeID))
+            print("Snapshot is stale, join through Peer {0}".format(
+                knownNode))
+            await self.__join(knownNode)
+            return
+
+        pred, first, second = place
+        self._firstID, self._secondID = first, second
+        self._predID = pred
+        self._fingers.restore(state["fingers"])
+        self._detector.heartbeat(pred)
+        self._joined.set()
+
+        incarnation = self._members.incarnation
+        await self._send(reqData("update", self._nodeID, pred,
+                                 {"_firstID": self._nodeID,
+                                  "_secondID": first,
+                                  "incarnation": incarnation}))
+        await self._send(reqData("pull", self._nodeID, first,
+                                 {"_nodeID": self._nodeID, "key": pred,
+                                  "incarnation": incarnation}))
+        self._stats.count("warmRestarts")
+        self._stats.observe("joinSeconds", monotonic() - begin)
+        print("\n ---- Restarted between Peer {0} and Peer {1} ----".format(
+            pred, first))
+        self._spawn(self._replicateChain())
+
+    # write our routing state, see DHTNode._saveSnapshot
+    def _saveSnapshot(self):
+        state = {"_nodeID": self._nodeID, "_firstID": self._firstID,
+                 "_secondID": self._secondID, "pred": self._predecessor(),
+                 "fingers": self._fingers.entries()}
+        try:
+            if self._snapshot.save(state):
+                self._stats.count("snapshotWrites")
+        except OSError as e:
+            print("Cannot write snapshot: {0}".format(e))
+
+    # wait until the node quits, then release every resource
+    async def serve(self):
+        await self._stopped.wait()
+        await self.close()
+
+    # start the node and serve until it quits
+    async def run(self, startType, **kwargs):
+        await self.start(startType, **kwargs)
+        await self.serve()
+
+    # terminate the node
+    def stop(self):
+        if self._stopped is not None and not self._stopped.is_set():
+            print("Depature gracefully :-)")
+            self._stopped.set()
+
+    async def close(self):
+        self._stopped.set()
+        if self._server is not None:
+            self._server.close()
+        if self._pingTransport is not None:
+            self._pingTransport.close()
+        if self._controlServer is not None:
+            self._controlServer.close()
+            os.remove(self._controlPath)
+        for writer, lastUsed in list(self._conns.values()):
+            writer.close()
+        self._conns.clear()
+        self._store.close()
+        self._replicas.close()
+        for stamp in list(self._pending.keys()):
+            self._resolve(stamp, error=ConnectionError("Peer stopped"))
+        for state in list(self._batches.values()):
+            self._finishBatch(state)
+        self._batches.clear()
+        self._dumpMetrics()
+        if self._trace is not None:
+            self._trace.close()
+
+        current = asyncio.current_task()
+        tasks = [t for t in self._tasks if t is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._server is not None:
+            await self._server.wait_closed()
+        if self._controlServer is not None:
+            await self._controlServer.wait_closed()
+
+    # leave the DHT gracefully
+    # the successor keeps our keys from now on
+    # the two peers pinging us and the successor we ping are told
+    # directly, everybody else hears it by gossip
+    async def quit(self):
+        if self._firstID != self._nodeID:
+            await self._handoff(self._firstID, self._nodeID, self._nodeID,
+                                False)
+        self._members.leave()
+        content = {"_nodeID": self._nodeID, "_firstID": self._firstID,
+                   "_secondID": self._secondID,
+                   "incarnation": self._members.incarnation}
+        preds = [p for p in self._detector.peers() if p != self._nodeID]
+        if len(preds) < 2:
+            await self._tell(reqData(
+                "quit", self._nodeID, self._firstID, content))
+            return
+        if self._firstID not in preds:
+            preds.append(self._firstID)
+        for peer in preds + [self._nodeID]:
+            await self._tell(reqData(
+                "quit", self._nodeID, peer, dict(content, relay=0)))
+
+    # store or request filename on behalf of a program
+    # returns the same dict as DHTNode._submit once it is answered
+    # an iterative request finds the owner itself, see DHTNode.__iterate
+    async def _submit(self, opr, filename, iterative=False):
+        future = asyncio.get_running_loop().create_future()
+        req = reqData(opr, self._nodeID, self._nodeID,
+                      {"_nodeID": self._nodeID, "filename": filename,
+                       "ack": 1, "hops": 0})
+        self._pending[req.stamp] = (future, monotonic(), opr)
+        if iterative:
+            self._spawn(self.__iterate(req))
+            return await future
+        try:
+            await self._send(req)
+        except OSError as e:
+            self._resolve(req.stamp, error=e)
+        return await future
+
+    # store or request every name in names at once
+    # returns the same dict as DHTNode._submitBatch once every
+    # peer doing a part answered
+    async def _submitBatch(self, opr, names):
+        return await (await self._startBatch(opr, names))
+
+    # send a batch, returns the future of its result
+    async def _startBatch(self, opr, names):
+        future = asyncio.get_running_loop().create_future()
+        names = sorted(set(names))
+        req = reqData("batch", self._nodeID, self._nodeID,
+                      {"_nodeID": self._nodeID, "kind": opr,
+                       "names": joinNames(names), "hops": 0})
+        state = {"future": future, "submitted": monotonic(),
+                 "waiting": set(names), "done": 0, "missing": [],
+                 "peers": set(), "hops": 0}
+        if len(names) == 0:
+            self._finishBatch(state)
+            return future
+        self._batches[req.stamp] = state
+        try:
+            await self._send(req)
+        except OSError as e:
+            del self._batches[req.stamp]
+            future.set_exception(e)
+        return future
+
+    # list a page of the keys peer keeps, ours if peer is None
+    # returns the same dict as DHTNode._scan
+    async def _scan(self, peer=None, lo=0, hi=0,
+                    limit=DHTNode.scanPageSize, after=None):
+        limit = max(1, min(limit, DHTNode.scanPageMax))
+        if peer is None or peer == self._nodeID:
+            return scanResult(self._scanContent(lo, hi, limit, after))
+        content = {"_nodeID": self._nodeID, "lo": lo, "hi": hi,
+                   "limit": limit}
+        if after is not None:
+            content["after"] = after
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            "127.0.0.1", toPort(peer)), DHTNode.scanTimeout)
+        try:
+            writer.write(reqData("scan", self._nodeID, peer,
+                                 content).toFrame())
+            await writer.drain()
+            decoder = frameDecoder()
+            reply = decoder.next()
+            while reply is None:
+                data = await asyncio.wait_for(reader.read(65536),
+                                              DHTNode.scanTimeout)
+                if not data:
+                    raise ConnectionError(
+                        "Peer {} closed the scan".format(peer))
+                decoder.feed(data)
+                reply = decoder.next()
+        finally:
+            writer.close()
+        if reply.opr == "busy":
+            raise ConnectionRefusedError("Peer {} is busy".format(peer))
+        self._stats.count("scanPages")
+        return scanResult(reply.getContent())
+
+    # the content of a scanned reply, see DHTNode._scanContent
+    def _scanContent(self, lo, hi, limit, after):
+        entries = self._store.page(lo, hi, limit, after)
+        orphans = orphanRange(self._members, self._predID, self._nodeID)
+        if orphans is not None:
+            entries = mergePages(lo, limit, entries, self._replicas.page(
+                lo, hi, limit, after, within=orphans))
+        self._stats.count("scannedKeys", len(entries))
+        return {"_nodeID": self._nodeID, "_firstID": self._firstID,
+                "_secondID": self._secondID,
+                "names": joinNames(e.name for e in entries),
+                "keys": ",".join(str(e.key) for e in entries),
+                "more": int(len(entries) == limit)}
+
+    # resolve the future of a batch with what came back
+    def _finishBatch(self, state):
+        if state["future"].done():
+            return
+        seconds = monotonic() - state["submitted"]
+        self._stats.observe("batchSeconds", seconds)
+        state["future"].set_result({
+            "done": state["done"],
+            "missing": sorted(state["missing"]),
+            "unanswered": sorted(state["waiting"]),
+            "peers": len(state["peers"]),
+            "hops": state["hops"],
+            "seconds": seconds})
+
+    # answer the submitted request with this stamp
+    def _resolve(self, stamp, error=None, **result):
+        entry = self._pending.pop(stamp, None)
+        if entry is None:
+            return
+        future, submitted, opr = entry
+        if future.done():
+            return
+        if error is not None:
+            self._stats.count(opr + "Failed")
+            if self._trace is not None:
+                self._trace.event(stamp, self._nodeID, "failed",
+                                  error=repr(error))
+            future.set_exception(error)
+            return
+        result["seconds"] = monotonic() - submitted
+        self._stats.observe(opr + "Seconds", result["seconds"])
+        if "hops" in result:
+            self._stats.observe("hops", result["hops"], hopBuckets)
+        if self._trace is not None:
+            self._trace.event(stamp, self._nodeID, "answered",
+                              seconds=round(result["seconds"], 6),
+                              hops=result.get("hops"),
+                              holder=result.get("peer"))
+        future.set_result(result)
+
+    # tell the peer which submitted req how it ended
+    # only requests submitted by a program want an answer
+    async def _answer(self, req, opr):
+        content = req.getContent()
+        if int(content.get("ack", 0)) != 1:
+            return
+        await self._tell(reqData(
+            opr, self._nodeID, int(content["_nodeID"]),
+            {"_nodeID": self._nodeID, "filename": content["filename"],
+             "hops": int(content.get("hops", 0))}, req.stamp))
+
+    # counters of the connection pool
+    def poolStats(self):
+        stats = {"open": len(self._conns)}
+        stats.update(self._poolCounters)
+        return stats
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    # send req to req.dst over a pooled connection
+    # a broken connection is reopened once before giving up
+    async def _send(self, req):
+        data = req.toFrame()
+        lock = self._connLocks.setdefault(req.dst, asyncio.Lock())
+        for attempt in range(2):
+            async with lock:
+                entry = self._conns.get(req.dst)
+                if entry is None or entry[0].is_closing():
+                    self._poolCounters["misses"] += 1
+                    reader, writer = await asyncio.open_connection(
+                        "127.0.0.1", toPort(req.dst))
+                    entry = [writer, monotonic()]
+                    self._conns[req.dst] = entry
+                    self._spawn(self._readLoop(reader, writer))
+                else:
+                    self._poolCounters["hits"] += 1
+            try:
+                entry[0].write(data)
+                await entry[0].drain()
+                entry[1] = monotonic()
+                self._poolCounters["messages"] += 1
+                self._poolCounters["bytes"] += len(data)
+                return
+            except OSError:
+                if self._conns.get(req.dst) is entry:
+                    del self._conns[req.dst]
+                entry[0].close()
+                if attempt == 1:
+                    raise
+                self._poolCounters["reconnects"] += 1
+
+    # server callback for every incoming connection
+    # it is tracked like any other task so that close() cancels it
+    async def _onConnection(self, reader, writer):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await self._readLoop(reader, writer)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._tasks.discard(task)
+
+    # read requests from a connection until it is closed
+    async def _readLoop(self, reader, writer):
+        decoder = frameDecoder()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                decoder.feed(data)
+                while True:
+                    req = decoder.next()
+                    if req is None:
+                        break
+
+                    # the connection belongs to this single request
+                    if decoder.legacy or \
+                            req.opr in ("transfer", "fetch", "hop", "scan"):
+                        req.payload = decoder.rest()
+                        slots = self._fetchSlots if req.opr == "fetch" \
+                            else self._slots
+                        if req.opr in heldOprs and not slots.admit(
+                                priorityOf(req.opr), held=True):
+                            await self.__refuseHeld(req, writer)
+                        elif req.opr == "fetch":
+                            # a download keeps fetching on this connection
+                            await self._run(req, monotonic(), reader, writer,
+                                            slots=slots)
+                        else:
+                            await self._run(req, monotonic(), reader, writer)
+                        return
+
+                    # replies to the sender may reuse this connection
+                    if req.src not in self._conns:
+                        self._conns[req.src] = [writer, monotonic()]
+                        self._poolCounters["adopted"] += 1
+                    else:
+                        self._conns[req.src][1] = monotonic()
+                    self._dispatch(req)
+        except ValueError:
+            print("Invalid request!")
+        except OSError:
+            pass
+        finally:
+            for peer, entry in list(self._conns.items()):
+                if entry[0] is writer:
+                    del self._conns[peer]
+            writer.close()
+
+    # queue requests changing the routing state, run the rest
+    def _dispatch(self, req):
+        queued = monotonic()
+        if req.opr == "exit":
+            self.stop()
+        elif req.opr in routingOprs:
+            self._routingQueue.put_nowait((req, queued))
+            self._stats.observeDepth(self._routingQueue.qsize())
+        elif req.opr == "manifest":
+            self._spawn(self._run(req, queued, slots=self._downloadSlots))
+        elif self._slots.admit(priorityOf(req.opr)):
+            self._spawn(self._run(req, queued))
+            self._stats.observeDepth(self._slots.qsize())
+        else:
+            self.__refuse(req)
+
+    async def _run(self, req, queued, reader=None, writer=None, slots=None):
+        slots = self._slots if slots is None else slots
+        await slots.acquire(priorityOf(req.opr), held=req.opr in heldOprs)
+        self._stats.observe("queueWaitSeconds", monotonic() - queued)
+        try:
+            await self._handle(req, reader, writer)
+        finally:
+            slots.release()
+        self._record(req, queued)
+
+    # handle the routing requests one by one
+    async def __routingLoop(self):
+        while True:
+            req, queued = await self._routingQueue.get()
+            await self._handle(req)
+            self._record(req, queued)
+
+    def _record(self, req, queued):
+        seconds = monotonic() - queued
+        self._stats.record(req.opr, seconds)
+        if self._trace is not None:
+            self._trace.event(req.stamp, self._nodeID, req.opr,
+                              src=req.src, seconds=round(seconds, 6))
+
+    # call the handler of a request
+    async def _handle(self, req, reader=None, writer=None):
+        try:
+            if req.opr == "store":
+                await self.__doStore(req)
+            elif req.opr == "request":
+                await self.__doRequest(req)
+            elif req.opr == "join":
+                await self.__doJoin(req)
+            elif req.opr == "quit":
+                await self.__doQuit(req)
+                if self._nodeID == int(req.getContent()["_nodeID"]):
+                    self.stop()
+            elif req.opr == "abrupt":
+                await self.__doAbrupt(req)
+            elif req.opr == "transfer":
+                await self.__doTransfer(req, reader, writer)
+            elif req.opr == "fetch":
+                await self.__doFetch(req, reader, writer)
+            elif req.opr == "update":
+                self.__doUpdate(req)
+            elif req.opr == "stabilize":
+                await self.__doStabilize(req)
+            elif req.opr == "stabilized":
+                self.__doStabilized(req)
+            elif req.opr == "lookup":
+                await self.__doLookup(req)
+            elif req.opr == "hop":
+                await self.__doHop(req, writer)
+            elif req.opr == "scan":
+                await self.__doScan(req, writer)
+            elif req.opr == "found":
+                content = req.getContent()
+                self._fingers.update(int(content["slot"]),
+                                     int(content["_nodeID"]))
+            elif req.opr == "pull":
+                content = req.getContent()
+                joinNode = int(content["_nodeID"])
+                print("\n ---- Peer {0} asks for its keys ----".format(joinNode))
+                self._detector.heartbeat(joinNode)
+                if "incarnation" in content:
+                    self._members.apply(joinNode, alive,
+                                        int(content["incarnation"]))
+                if self._closerPred(joinNode):
+                    self._predID = joinNode
+                self._saveSnapshot()
+                await self._handoff(joinNode, int(content["key"]), joinNode)
+            elif req.opr == "handoff":
+                self.__doHandoff(req)
+            elif req.opr == "replicate":
+                await self.__doReplicate(req)
+            elif req.opr == "stored":
+                content = req.getContent()
+                self._resolve(req.stamp, peer=int(content["_nodeID"]),
+                              hops=int(content.get("hops", 0)))
+            elif req.opr == "missing":
+                self._resolve(req.stamp,
+                              error=KeyError(req.getContent()["filename"]))
+            elif req.opr == "unrouted":
+                self.__doUnrouted(req)
+            elif req.opr == "batch":
+                await self.__doBatch(req)
+            elif req.opr == "busy":
+                self.__doBusy(req)
+            elif req.opr == "batched":
+                self.__doBatched(req)
+            elif req.opr == "manifest":
+                await self.__doManifest(req)
+        except Exception as e:
+            print("Failed to handle {0} request: {1}".format(req.opr, e))
+
+    # the best peer to forward a lookup for key to
+    def _nextHop(self, key):
+        if betweenRight(key, self._nodeID, self._firstID):
+            return self._firstID
+        finger = self._fingers.closestPreceding(key)
+        if finger is None:
+            return self._firstID
+        return finger
+
+    # the predecessor is the last peer which stabilized with us,
+    # or else the closest peer pinging us
+    def _predecessor(self):
+        pred = self._predID
+        if pred is not None and not self._members.gone(pred):
+            return pred
+        peers = [k for k in self._detector.peers() if k != self._nodeID]
+        if len(peers) == 0:
+            return None
+        return min(peers, key=lambda k: distance(k, self._nodeID))
+
+    # forward req to hop, or to the best hop for key
+    # a stale finger falls back to the first then the second successor
+    # returns None once the request was forwarded routeTTL times,
+    # see DHTNode.__route
+    async def _route(self, req, key=None, hop=None):
+        content = req.getContent()
+        left = int(content.get("hopsLeft", DHTNode.routeTTL)) - 1
+        if left < 0:
+            self._stats.count("routeExpired")
+            self._log(req.stamp, "The {0} request was forwarded {1} times, "
+                      "it is dropped".format(req.opr, DHTNode.routeTTL))
+            return None
+        req.setContent(hopsLeft=left)
+
+        if hop is None:
+            hop = self._nextHop(key)
+        candidates = []
+        for dst in (hop, self._firstID, self._secondID):
+            if dst not in candidates:
+                candidates.append(dst)
+
+        # requests submitted by a program count their hops
+        if "hops" in content:
+            req.setContent(hops=int(content["hops"]) + 1)
+
+        req.src = self._nodeID
+        for dst in candidates:
+            req.dst = dst
+            try:
+                await self._send(req)
+                return dst
+            except OSError:
+                print("Peer {} is unreachable".format(dst))
+                self._fingers.remove(dst)
+        return None
+
+    # send a request and only report a failure
+    async def _tell(self, req):
+        try:
+            await self._send(req)
+        except OSError:
+            print("Peer {} is unreachable".format(req.dst))
+
+    # ping loop
+    # ping both successors every ping interval on the ping socket
+    # and gossip to gossipFanout random members, every message
+    # carries the latest membership changes
+    async def __pingLoop(self):
+        while True:
+            for peer in self._members.expire():
+                self._onMember(peer, "dead")
+            targets = [("ping", self._firstID), ("ping", self._secondID)]
+            targets += [("gossip", peer) for peer in
+                        self._members.randomPeers(
+                            DHTNode.gossipFanout,
+                            (self._firstID, self._secondID))]
+            for opr, dst in targets:
+                gossip = self._members.piggyback()
+                content = reqData(opr, self._nodeID, dst,
+                                  {"gossip": gossip} if gossip else "",
+                                  stamp=time_ns()).toString().encode('utf-8')
+                self._pingTransport.sendto(
+                    content, ("127.0.0.1", DHTNode.basePort + toPort(dst)))
+            self._stats.count("pingsSent", len(targets))
+            if self._verbose:
+                print("Ping requests sent to Peers {} and {}".format(
+                    self._firstID, self._secondID))
+            await asyncio.sleep(self._pingInterval)
+
+    def _onPing(self, data):
+        try:
+            req = reqData.fromString(data.decode('utf-8'))
+            gossip = req.getContent().get("gossip", "")
+        except (ValueError, IndexError, UnicodeDecodeError):
+            return
+        # only the peers before us ping, the rest gossip
+        # a ping is answered with a pong carrying its stamp,
+        # so that the pinging peer sees the round trip time
+        self._stats.count("pingsReceived")
+        if req.opr == "ping":
+            if self._verbose:
+                print("Ping response received from Peer {}".format(req.src))
+            self._detector.heartbeat(req.src)
+            pong = reqData("pong", self._nodeID, req.src, "", req.stamp)
+            self._pingTransport.sendto(
+                pong.toString().encode('utf-8'),
+                ("127.0.0.1", DHTNode.basePort + toPort(req.src)))
+        elif req.opr == "pong":
+            self._stats.observe("pingRttSeconds", (time_ns() - req.stamp) / 1e9)
+        if self._members.heard(req.src):
+            self._onMember(req.src, alive)
+        for peer, state in self._members.merge(gossip):
+            self._onMember(peer, state)
+
+    # the membership list learned that peer changed its state
+    def _onMember(self, peer, state):
+        if state == alive:
+            # the keys before a new peer are its own now
+            self._cache.invalidate(peer)
+            return
+        if state in ("dead", left):
+            print("Peer {0} is {1}".format(peer, state))
+            self._detector.remove(peer)
+            self._fingers.remove(peer)
+            self._cache.invalidate(peer)
+
+    # wake up when the next peer would fall silent
+    # a new deadline is always more than a ping interval away,
+    # so sleeping at most a ping interval never misses one
+    async def __detectLoop(self):
+        while True:
+            wait = self._pingInterval
+            deadline = self._detector.nextDeadline()
+            if deadline is not None:
+                wait = min(wait, deadline - monotonic())
+            await asyncio.sleep(max(wait, 0.001))
+            await self._checkLoss()
+
+    # a peer other than the last two pinging us only went away,
+    # the first successor of a peer which left abruptly tells the others
+    async def _checkLoss(self):
+        for removeKey in self._detector.expired():
+            if removeKey == self._predID:
+                self._predID = None
+            rest = self._detector.peers()
+            if len(rest) != 1:
+                continue
+            restKey = max(rest)
+            print("\n ---- Peer {} no longer alive ----".format(removeKey))
+            self._members.suspect(removeKey)
+            # the informer will the first successor of the quit node
+            # the second successor will not send this request
+            if between(removeKey, restKey, self._nodeID):
+                # the other peer pinging us is the predecessor of the
+                # quit node, it hears about it directly and everybody
+                # else by gossip
+                content = {"_nodeID": self._nodeID,
+                           "_firstID": self._firstID,
+                           "_secondID": self._secondID,
+                           "leaveNode": removeKey}
+                try:
+                    await self._send(reqData(
+                        "abrupt", self._nodeID, restKey,
+                        dict(content, relay=0)))
+                except OSError:
+                    await self._tell(reqData(
+                        "abrupt", self._nodeID, self._firstID, content))
+
+    # finger loop
+    # refresh the finger table every ping interval
+    # and close pooled connections nobody used for a while
+    async def __fingerLoop(self):
+        while True:
+            for i in range(len(self._fingers)):
+                await self._tell(reqData(
+                    "lookup", self._nodeID, self._nodeID,
+                    {"_nodeID": self._nodeID, "key": self._fingers.start(i),
+                     "slot": i}))
+            await self._repairSuccessors()
+            await self._repairReplicas()
+            now = monotonic()
+            for stamp, (future, submitted, opr) in \
+                    list(self._pending.items()):
+                if now - submitted > 60:
+                    self._resolve(stamp, error=TimeoutError(
+                        "No answer after 60 seconds"))
+            # a batch ends with the names nobody answered for
+            for stamp, state in list(self._batches.items()):
+                if now - state["submitted"] > 60:
+                    self._finishBatch(self._batches.pop(stamp))
+            for peer, entry in list(self._conns.items()):
+                if now - entry[1] > self._idleTimeout:
+                    del self._conns[peer]
+                    entry[0].close()
+                    self._poolCounters["evictions"] += 1
+            self._saveSnapshot()
+            self._dumpMetrics()
+            await asyncio.sleep(self._pingInterval)
+
+    # ask the first successor for its predecessor every stabilize
+    # interval, see DHTNode.__stabilizeLoop
+    async def __stabilizeLoop(self):
+        while True:
+            await asyncio.sleep(self._stabilizeInterval)
+            if self._firstID == self._nodeID:
+                continue
+            succ = self._firstID
+            try:
+                await self._send(reqData("stabilize", self._nodeID, succ,
+                                         {"_nodeID": self._nodeID}))
+                self._stats.count("stabilizeMessages")
+            except OSError:
+                print("Peer {} is unreachable".format(succ))
+                await self.__skipSuccessor(succ)
+
+    # the second successor takes the place of a first one which did
+    # not take a stabilize, see DHTNode.__skipSuccessor
+    async def __skipSuccessor(self, succ):
+        if succ != self._firstID or self._secondID in (succ, self._nodeID):
+            return
+        self._firstID = self._secondID
+        self._cache.invalidate(succ)
+        self._members.suspect(succ)
+        self._stats.count("stabilizeRepairs")
+        print("My first successor is Peer {0} now".format(self._firstID))
+        try:
+            await self._send(reqData("stabilize", self._nodeID, self._firstID,
+                                     {"_nodeID": self._nodeID}))
+            self._stats.count("stabilizeMessages")
+        except OSError:
+            print("Peer {} is unreachable".format(self._firstID))
+
+    # could peer be a closer predecessor than the one we know
+    # a stabilize a peer sent before it left is late, not closer
+    def _closerPred(self, peer):
+        pred = self._predID
+        return peer != self._nodeID and \
+            not self._members.gone(peer) and (
+                pred is None or self._members.gone(pred) or
+                between(peer, pred, self._nodeID))
+
+    # a peer before us stabilizes, see DHTNode.__doStabilize
+    async def __doStabilize(self, req):
+        if not self._joined.is_set():
+            return
+        peer = int(req.getContent()["_nodeID"])
+        old = self._predID
+        changed = self._closerPred(peer)
+        if changed:
+            self._predID = peer
+        content = {"_nodeID": self._nodeID, "_firstID": self._firstID,
+                   "_secondID": self._secondID}
+        if self._predID is not None:
+            content["pred"] = self._predID
+        await self._tell(reqData("stabilized", self._nodeID, peer, content,
+                                 req.stamp))
+        self._stats.count("stabilizeMessages")
+        if changed:
+            print("Peer {0} is my predecessor now, it was Peer {1}".format(
+                peer, old))
+            self._saveSnapshot()
+            if self._store.select(
+                    lambda k: betweenRight(k, self._nodeID, peer)):
+                await self._handoff(peer, self._nodeID, peer)
+
+    # our successor told us its predecessor and successor,
+    # see DHTNode.__doStabilized
+    def __doStabilized(self, req):
+        content = req.getContent()
+        succ = int(content["_nodeID"])
+        if succ != self._firstID:
+            return
+        first, second = succ, int(content["_firstID"])
+        pred = int(content.get("pred", self._nodeID))
+        if between(pred, self._nodeID, succ) and \
+                not self._members.gone(pred):
+            first, second = pred, succ
+        if (first, second) == (self._firstID, self._secondID):
+            return
+        self._stats.count("stabilizeRepairs")
+        self._firstID, self._secondID = first, second
+        self._cache.invalidate(first)
+        self._cache.invalidate(second)
+        print("Stabilized, my first successor is Peer {0} and my second "
+              "successor is Peer {1}".format(first, second))
+        self._saveSnapshot()
+        self._spawn(self._replicateChain())
+
+        # a new successor may not be the last one, ask it at once
+        if first != succ:
+            self._spawn(self._tell(reqData("stabilize", self._nodeID, first,
+                                           {"_nodeID": self._nodeID})))
+            self._stats.count("stabilizeMessages")
+
+    # a successor the membership list knows is gone is replaced by
+    # the next live members, in case the quit or abrupt notice was lost
+    async def _repairSuccessors(self):
+        if not (self._members.gone(self._firstID) or
+                self._members.gone(self._secondID)):
+            return
+        succ = self._members.successors(2)
+        if len(succ) < 2 or (succ[0], succ[1]) == \
+                (self._firstID, self._secondID):
+            return
+        print("Successors {0} and {1} replaced by {2} and {3}".format(
+            self._firstID, self._secondID, succ[0], succ[1]))
+        await self._tell(reqData(
+            "update", self._nodeID, self._nodeID,
+            {"_firstID": succ[0], "_secondID": succ[1]}))
+
+    # read commands from the terminal without blocking the loop
+    async def __commandLoop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if line == "":
+                return
+            command = [x for x in line.strip().split(" ") if x]
+            if len(command) == 0:
+                continue
+            command[0] = command[0].lower()
+            if command[0] == "quit":
+                await self.quit()
+                return
+            # "store 1 2 3" and "store @manifest" send a batch
+            # "request -i 1234" looks the owner up iteratively
+            elif command[0] in ("store", "request") and len(command) > 1:
+                try:
+                    names = commandNames(x for x in command[1:] if x != "-i")
+                except OSError as e:
+                    print("Invalid manifest: {0}".format(e))
+                    continue
+                if len(names) == 1 and "-i" in command:
+                    self._spawn(self._submit(
+                        command[0], names[0], iterative=True)) \
+                        .add_done_callback(printAnswer(command[0], names[0]))
+                elif len(names) == 1:
+                    await self._tell(reqData(
+                        command[0], self._nodeID, self._nodeID,
+                        {"_nodeID": self._nodeID, "filename": names[0]}))
+                else:
+                    future = await self._startBatch(command[0], names)
+                    future.add_done_callback(printBatch(command[0]))
+            elif command[0] == "stats":
+                print(", ".join("{0}: {1}".format(k, v)
+                                for k, v in self.poolStats().items()))
+                print("keys: {0}, replicas: {1}".format(
+                    len(self._store), len(self._replicas)))
+                print("cache " + ", ".join(
+                    "{0}: {1}".format(k, v)
+                    for k, v in self._cache.stats().items()))
+                print("detector " + ", ".join(
+                    "{0}: {1}".format(k, v)
+                    for k, v in self._detector.stats().items()))
+                print("members " + ", ".join(
+                    "{0}: {1}".format(k, v)
+                    for k, v in self._members.stats().items()))
+                for line in self._stats.summary():
+                    print(line)
+            else:
+                print("Invalid command")
+
+    # what the stats command prints, for programs
+    def stats(self):
+        return {"peer": self._nodeID, "firstID": self._firstID,
+                "secondID": self._secondID, "keys": len(self._store),
+                "replicas": len(self._replicas),
+                "pool": self.poolStats(), "cache": self._cache.stats(),
+                "detector": self._detector.stats(),
+                "members": self._members.stats(),
+                "ops": self._stats.toDict()}
+
+    # server callback for every program connecting to the control
+    # socket, see DHTNode.__serveControl
+    async def _onControl(self, reader, writer):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        decoder = frameDecoder()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                decoder.feed(data)
+                req = decoder.next()
+                while req is not None:
+                    self._control(req, writer)
+                    req = decoder.next()
+        except (OSError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            self._tasks.discard(task)
+            writer.close()
+
+    # handle a request of a program, answered on writer
+    def _control(self, req, writer):
+        def reply(content):
+            if not writer.is_closing():
+                writer.write(reqData("result", self._nodeID, req.src,
+                                     content, req.stamp).toFrame())
+
+        def done(task):
+            if not task.cancelled():
+                reply(resultContent(task))
+
+        content = req.getContent()
+        if req.opr == "submit":
+            if "names" in content:
+                task = self._spawn(self._submitBatch(
+                    content["kind"], splitNames(content["names"])))
+            else:
+                task = self._spawn(self._submit(
+                    content["kind"], content["filename"],
+                    int(content.get("iterative", 0)) == 1))
+            task.add_done_callback(done)
+        elif req.opr == "scan":
+            task = self._spawn(self._scan(
+                int(content["peer"]) if "peer" in content else None,
+                int(content.get("lo", 0)), int(content.get("hi", 0)),
+                int(content.get("limit", DHTNode.scanPageSize)),
+                content.get("after")))
+            task.add_done_callback(done)
+        elif req.opr == "stats":
+            reply({"stats": json.dumps(self.stats())})
+        elif req.opr == "quit":
+            reply({})
+            self._spawn(self.quit())
+        else:
+            reply({"error": "ValueError",
+                   "message": "Unknown operation " + req.opr})
+
+    # a line about the request with stamp, printed when verbose
+    # and kept in the trace if the stamp is traced
+    def _log(self, stamp, text):
+        if self._verbose:
+            print(text)
+        if self._trace is not None:
+            self._trace.event(stamp, self._nodeID, "log", text=text.strip())
+
+    # write the metrics where a Prometheus textfile collector
+    # or anybody else can read them
+    def _dumpMetrics(self):
+        if self._metricsDir is None:
+            return
+        pool = self.poolStats()
+        pool.pop("open")
+        extra = dict(("pool" + k.capitalize(), v) for k, v in pool.items())
+        try:
+            writeAtomic(os.path.join(self._metricsDir, "peer{0}.prom".format(
+                self._nodeID)), self._stats.prometheus(
+                    {"peer": self._nodeID}, extra))
+        except OSError as e:
+            print("Cannot write metrics: {0}".format(e))
+        if self._trace is not None:
+            self._trace.flush()
+
+    # Local hash table that this peer keeps, hash -> set of filenames
+    @property
+    def localHashTable(self):
+        return self._store.hashTable()
+
+    # put data into local hash table
+    def putData(self, filename):
+        self._store.put(filename)
+
+    # find is filename in this peer
+    def fetchData(self, filename):
+        return filename in self._store
+
+    def __doUpdate(self, req):
+        print("\n ---- Update request received! ----")
+        print("Successor Change request received")
+        content = req.getContent()
+        self._firstID = int(content["_firstID"])
+        self._secondID = int(content["_secondID"])
+        print("My first successor ID is {}".format(self._firstID))
+        print("My second successor ID is {}".format(self._secondID))
+        self._cache.invalidate(self._firstID)
+        self._cache.invalidate(self._secondID)
+        # a restarted peer taking its place back
+        if "incarnation" in content and req.src != self._nodeID:
+            self._members.apply(req.src, alive, int(content["incarnation"]))
+        if not self._joined.is_set() and "_nodeID" in content:
+            self._joinPred = int(content["_nodeID"])
+            # it is our predecessor even before it pings us,
+            # while the peer before it may ping us first
+            self._detector.heartbeat(self._joinPred)
+        self._joined.set()
+        self._saveSnapshot()
+        self._spawn(self._replicateChain())
+
+    async def __doJoin(self, req):
+        content = req.getContent()
+        joinNode = int(content["_nodeID"])
+        self._cache.invalidate(joinNode)
+
+        # a copy of a join which succeeded already, or of our own,
+        # nobody would ever find a place for it
+        if self._joinStamps.get(joinNode) == req.stamp:
+            return
+
+        # a peer joining at the same time sent the join here before
+        # we knew our own successors, it is handled once we do
+        if not self._joined.is_set():
+            self._spawn(self.__joinLater(req))
+            return
+
+        # our successor crashed and joins again under the same ID,
+        # see DHTNode.__doJoin
+        if joinNode == self._firstID:
+            print("\n ---- Peer {} joins again ----".format(joinNode))
+            self._joinStamps[joinNode] = req.stamp
+            await self._tell(reqData(
+                "update", self._nodeID, joinNode,
+                {"_nodeID": self._nodeID, "_firstID": self._secondID,
+                 "_secondID": self._secondID}))
+            return
+
+        # a request jumped here through a finger was not sent by
+        # our predecessor, so we have to know the predecessor ourselves
+        viaFinger = int(content.get("viaFinger", 0)) == 1
+        predNode = self._predecessor() if viaFinger else req.src
+
+        # found where to join!
+        if between(joinNode, self._nodeID, self._firstID) and \
+                req.src != joinNode and predNode is not None:
+            print("\n ---- Peer {} join request received! ----".format(joinNode))
+            self._joinStamps[joinNode] = req.stamp
+            self._detector.clear()
+
+            await self._tell(reqData(
+                "update", self._nodeID, joinNode,
+                {"_nodeID": self._nodeID, "_firstID": self._firstID,
+                 "_secondID": self._secondID}))
+            await self._tell(reqData(
+                "update", self._nodeID, self._nodeID,
+                {"_nodeID": self._nodeID, "_firstID": joinNode,
+                 "_secondID": self._firstID}))
+            await self._tell(reqData(
+                "update", self._nodeID, predNode,
+                {"_nodeID": self._nodeID, "_firstID": self._nodeID,
+                 "_secondID": joinNode}))
+        else:
+            hop = self._firstID
+            if not between(joinNode, self._nodeID, self._secondID):
+                finger = self._fingers.closestPreceding(joinNode)
+                if finger is not None:
+                    hop = finger
+            req.setContent(viaFinger=0 if hop == self._firstID else 1)
+            print("Peer {0} join request forward to Peer {1}".format(
+                joinNode, hop))
+            if await self._route(req, hop=hop) is None:
+                # the joining peer stops waiting for its update
+                await self._tell(reqData(
+                    "unrouted", self._nodeID, joinNode,
+                    {"_nodeID": self._nodeID}, req.stamp))
+
+    # a join or a request nobody could route fails,
+    # see DHTNode.__doAnswer
+    def __doUnrouted(self, req):
+        content = req.getContent()
+        if "filename" in content:
+            self._resolve(req.stamp, error=ConnectionError(
+                "Peer {0} could not route file {1}".format(
+                    req.src, content["filename"])))
+        elif not self._joined.is_set():
+            self._joinError = ConnectionError(
+                "Peer {0} could not route the join".format(req.src))
+            self._joined.set()
+
+    # the routing loop goes on meanwhile, the update we wait for
+    # comes through it
+    async def __joinLater(self, req):
+        await self._joined.wait()
+        self._routingQueue.put_nowait((req, monotonic()))
+
+    async def __doQuit(self, req):
+        content = req.getContent()
+        quitNode = int(content["_nodeID"])
+        fstNode = int(content["_firstID"])
+        sndNode = int(content["_secondID"])
+
+        self._detector.remove(quitNode)
+        self._fingers.remove(quitNode)
+        self._cache.invalidate(quitNode)
+        if quitNode == self._predID:
+            self._predID = None
+        if "incarnation" in content:
+            self._members.apply(quitNode, left, int(content["incarnation"]))
+
+        # all nodes know this node is leaving
+        if self._nodeID == quitNode:
+            return
+
+        # a quit sent straight to us is passed on by gossip
+        if int(content.get("relay", 1)) == 1:
+            await self._tell(reqData("quit", self._nodeID, self._firstID,
+                                     req.getContent()))
+
+        # the pre-predecesor and the predecesor of leaving node
+        # update themselves
+        if self._secondID == quitNode:
+            print("\n ---- Peer {0} will depart from network ----".format(quitNode))
+            self._firstID, self._secondID = self._firstID, fstNode
+        elif self._firstID == quitNode:
+            print("\n ---- Peer {0} will depart from network ----".format(quitNode))
+            self._firstID, self._secondID = fstNode, sndNode
+        else:
+            return
+        print("My first successor ID is {}".format(self._firstID))
+        print("My second successor ID is {}".format(self._secondID))
+
+    async def __doAbrupt(self, req):
+        content = req.getContent()
+        quitNode = int(content["leaveNode"])
+        informer = int(content["_nodeID"])
+        self._fingers.remove(quitNode)
+        self._cache.invalidate(quitNode)
+        self._members.suspect(quitNode)
+
+        # the informer will be the first successor of the quit node
+        if informer == self._secondID:
+            await self._tell(reqData(
+                "update", self._nodeID, self._nodeID,
+                {"_firstID": self._secondID,
+                 "_secondID": content["_firstID"]}))
+            # update the other predecessor, an abrupt sent straight
+            # here did not come from it
+            pred = req.src
+            if int(content.get("relay", 1)) == 0:
+                pred = self._predecessor()
+            if pred is not None:
+                await self._tell(reqData(
+                    "update", self._nodeID, pred,
+                    {"_firstID": self._nodeID, "_secondID": informer}))
+        elif informer != self._nodeID and self._firstID != quitNode:
+            req.src = self._nodeID
+            req.dst = self._firstID
+            await self._tell(req)
+
+    async def __doStore(self, req):
+        content = req.getContent()
+        filename = content["filename"]
+        fileHash = toHash(filename)
+        if fileHash is None:
+            return
+
+        owner = ownsKey(fileHash, req.src, self._nodeID)
+        if int(content.get("direct", 0)) == 1:
+            owner = self.__ownsDirect(req, fileHash, filename)
+        if owner:
+            self._log(req.stamp,
+                      "\n ---- Store {0} request accepted ----".format(
+                          filename))
+            self.putData(filename)
+            await self._replicate([filename])
+            await self._answer(req, "stored")
+        else:
+            hop = await self._route(req, fileHash)
+            if hop is None:
+                await self._answer(req, "unrouted")
+                return
+            self._log(req.stamp,
+                      "Store {0} request forwarded to Peer {1}".format(
+                          filename, hop))
+
+    # too many tasks wait for a slot, the sender of req retries later
+    # see DHTNode.__refuse
+    def __refuse(self, req):
+        self._stats.count("rejected" + req.opr.capitalize())
+        self._log(req.stamp, "Too busy for the {0} request of Peer {1}".format(
+            req.opr, req.src))
+        busy = reqData("busy", self._nodeID, req.src,
+                       dict(req.getContent(), rejected=req.opr), req.stamp)
+        if req.src == self._nodeID:
+            self.__doBusy(busy)
+        else:
+            self._spawn(self._tell(busy))
+
+    # answer a fetch or a scan busy on its own connection, see DHTNode.__refuseHeld
+    async def __refuseHeld(self, req, writer):
+        self._stats.count("rejected" + req.opr.capitalize())
+        writer.write(reqData("busy", self._nodeID, req.src,
+                             {"_nodeID": self._nodeID, "rejected": req.opr},
+                             req.stamp).toFrame())
+        await writer.drain()
+
+    # the peer we sent a request to was too busy for it
+    # see DHTNode.__doBusy
+    def __doBusy(self, req):
+        content = dict(req.getContent())
+        opr = content.pop("rejected")
+        attempt = int(content.get("attempt", 0))
+        if attempt >= busyRetries:
+            self._stats.count("busyGaveUp")
+            self._log(req.stamp, "Peer {0} is still busy, the {1} request "
+                      "is dropped".format(req.src, opr))
+            origin = int(content["_nodeID"])
+            if origin != self._nodeID:
+                # the peer which submitted it gives up as well
+                req.src, req.dst = self._nodeID, origin
+                self._spawn(self._tell(req))
+                return
+            self._resolve(req.stamp, error=ConnectionRefusedError(
+                "Peer {0} is busy".format(req.src)))
+            return
+        self._stats.count("busyRetries")
+        content["attempt"] = attempt + 1
+        self._spawn(self.__retry(
+            reqData(opr, self._nodeID, req.src, content, req.stamp),
+            backoff(attempt)))
+
+    async def __retry(self, req, delay):
+        await asyncio.sleep(delay)
+        try:
+            await self._send(req)
+        except OSError as e:
+            print("Peer {} is unreachable".format(req.dst))
+            self._resolve(req.stamp, error=e)
+
+    # a request sent straight here from a cache or an iterative lookup
+    # is checked against our own range, a stale one walks the ring from here
+    # a peer which lost track of its predecessor only owns the ring alone
+    def __ownsDirect(self, req, key, filename):
+        pred = self._predecessor()
+        if pred is None and self._firstID == self._nodeID or \
+                pred is not None and betweenRight(key, pred, self._nodeID):
+            return True
+        self._log(req.stamp, "Peer {0} does not own file {1} any more".format(
+            self._nodeID, filename))
+        req.setContent(direct=0)
+        req.src = self._nodeID
+        return False
+
+    # answer a request of our own from the cache
+    # returns True if the request needs no ring walk
+    async def __requestCached(self, req, filename, fileHash):
+        path = self._cache.getFile(filename)
+        if path is not None:
+            self._log(req.stamp,
+                      "File {0} was fetched recently, it is at {1}".format(
+                          filename, path))
+            self._resolve(req.stamp, peer=self._nodeID, hops=0,
+                          size=os.path.getsize(path))
+            return True
+
+        owner = self._cache.owner(fileHash)
+        if owner is None or owner == self._nodeID:
+            return False
+        req.setContent(direct=1)
+        hop = await self._route(req, hop=owner)
+        if hop != owner:
+            self._cache.invalidate(owner)
+        if hop is None:
+            req.setContent(direct=0)
+            req.src = self._nodeID
+            return False
+        self._log(req.stamp,
+                  "Request for file {0} sent straight to Peer {1}".format(
+                      filename, hop))
+        return True
+
+    async def __doRequest(self, req):
+        content = req.getContent()
+        filename = content["filename"]
+        fileHash = toHash(filename)
+        if fileHash is None:
+            return
+
+        if req.src == self._nodeID and \
+                int(content["_nodeID"]) == self._nodeID and \
+                int(content.get("direct", 0)) == 0 and \
+                await self.__requestCached(req, filename, fileHash):
+            return
+
+        pred = self._predecessor()
+        owner = ownsKey(fileHash, req.src, self._nodeID)
+        if int(content.get("direct", 0)) == 1:
+            owner = self.__ownsDirect(req, fileHash, filename)
+
+        # a replica on the way answers as well as the owner,
+        # and stands in for an owner which left abruptly
+        if not owner:
+            if filename not in self._replicas:
+                hop = await self._route(req, fileHash)
+                if hop is None:
+                    await self._answer(req, "unrouted")
+                    return
+                self._log(req.stamp,
+                          "File is not here, request for file: {0}, "
+                          "request has been sent to Peer {1}".format(
+                              filename, hop))
+                return
+            self._log(req.stamp,
+                      "Request for file {0} served from a replica".format(
+                          filename))
+        elif not self.fetchData(filename) and filename not in self._replicas:
+            await self._answer(req, "missing")
+            return
+
+        entry = self._store.get(filename) or self._replicas.get(filename)
+        if entry is None or entry.path is None:
+            self._log(req.stamp,
+                      "File {0} is not in {1}".format(
+                          filename, self._dataDir))
+            await self._answer(req, "missing")
+            return
+        # a request of our own for a file we keep needs no transfer
+        if int(content["_nodeID"]) == self._nodeID:
+            self._log(req.stamp, "File {0} is stored here, at {1}".format(
+                filename, entry.path))
+            self._resolve(req.stamp, peer=self._nodeID,
+                          hops=int(content.get("hops", 0)),
+                          size=os.path.getsize(entry.path))
+            return
+        fields = dict()
+        if "hops" in content:
+            fields["hops"] = int(content["hops"])
+        # the requester may remember who owns the range
+        if owner and pred is not None:
+            fields["lo"] = pred
+        await self._sendFile(int(content["_nodeID"]), entry, req.stamp,
+                             **fields)
+
+    # send the file of entry to dstPeer on a connection of its own
+    # a file larger than chunkSize is announced with a manifest instead,
+    # see DHTNode.__sendFile
+    # fields are added to the content of the transfer
+    async def _sendFile(self, dstPeer, entry, stamp, **fields):
+        filename = os.path.basename(entry.path)
+        self._log(stamp,
+                  "\n ---- File {0} is stored here! ----".format(filename))
+        digests = await self._blocking(
+            fileDigests, entry.path, DHTNode.chunkSize)
+        if os.path.getsize(entry.path) > DHTNode.chunkSize:
+            self._log(stamp,
+                      "Sending the manifest of file {0} to Peer {1}".format(
+                          filename, dstPeer))
+            await self._send(reqData(
+                "manifest", self._nodeID, dstPeer,
+                dict(fields, _nodeID=self._nodeID, filename=filename,
+                     name=entry.name, size=os.path.getsize(entry.path),
+                     chunk=DHTNode.chunkSize, digests=",".join(digests),
+                     holders=",".join(str(x) for x in
+                                      self._holders(entry.name))),
+                stamp))
+            return
+        self._log(stamp,
+                  "Sending file {0} to Peer {1}...".format(filename, dstPeer))
+        fields["sha256"] = digests[0]
+
+        # a transfer owns its connection, the file follows the request
+        # once the receiver replied ready, compressed if it accepted
+        # the zlib stream we offered, see DHTNode.sendFile
+        path = entry.path
+        reader, writer = await asyncio.open_connection(
+            "127.0.0.1", toPort(dstPeer))
+        t = reqData("transfer", self._nodeID, dstPeer,
+                    {"_nodeID": self._nodeID, "filename": filename,
+                     "name": entry.name, "size": os.path.getsize(path)},
+                    stamp)
+        t.setContent(**fields)
+        if await self._blocking(worthCompressing, path, self._compressLevel):
+            t.setContent(codec="zlib")
+        try:
+            writer.write(t.toFrame())
+            decoder = frameDecoder()
+            ready = None
+            try:
+                ready = decoder.next()
+                while ready is None:
+                    data = await asyncio.wait_for(
+                        reader.read(4096), DHTNode.readyTimeout)
+                    if not data:
+                        raise ConnectionError("Receiver closed the transfer")
+                    decoder.feed(data)
+                    ready = decoder.next()
+            except asyncio.TimeoutError:
+                pass
+
+            begin = perf_counter()
+            stream = None
+            if ready is not None and \
+                    ready.getContent().get("codec") == "zlib":
+                stream = zlibStream(path, self._compressLevel)
+                for block in stream.blocks():
+                    writer.write(block)
+                    await writer.drain()
+                sent = stream.raw
+                self._compressed(stream, "compress")
+            else:
+                with open(path, "rb") as file:
+                    sent = await asyncio.get_running_loop().sendfile(
+                        writer.transport, file)
+                await writer.drain()
+            self._stats.count("bytesSent", sent)
+            self._log(stamp, "The file has been sent, {0} bytes at {1}{2}".format(
+                sent, rate(sent, perf_counter() - begin),
+                "" if stream is None else ", " + str(stream)))
+        finally:
+            writer.close()
+
+    # run fn in the default executor, for hashing and writing files
+    # which would hold up every other request on the loop
+    async def _blocking(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, fn, *args)
+
+    # the peers a file can be fetched from, this peer first
+    def _holders(self, filename):
+        holders = [self._nodeID]
+        if filename in self._store:
+            for peer in (self._firstID, self._secondID)[:self._replicaCount]:
+                if peer not in holders:
+                    holders.append(peer)
+        return holders
+
+    # serve the chunks a downloading peer asks for on one connection
+    async def __doFetch(self, req, reader, writer):
+        decoder = frameDecoder()
+        decoder.feed(req.payload)
+        loop = asyncio.get_running_loop()
+        while True:
+            content = req.getContent()
+            name = transferName(content)
+            entry = self._store.get(name) or self._replicas.get(name)
+            if entry is None or entry.path is None:
+                writer.write(reqData(
+                    "missing", self._nodeID, req.src,
+                    {"_nodeID": self._nodeID,
+                     "filename": content["filename"]}, req.stamp).toFrame())
+            else:
+                offset = int(content["offset"])
+                size = max(0, min(int(content["size"]),
+                                  os.path.getsize(entry.path) - offset))
+                writer.write(reqData(
+                    "chunk", self._nodeID, req.src,
+                    {"offset": offset, "size": size}, req.stamp).toFrame())
+                if size > 0:
+                    with open(entry.path, "rb") as file:
+                        sent = await loop.sendfile(writer.transport, file,
+                                                   offset, size)
+                    self._stats.count("bytesSent", sent)
+            await writer.drain()
+            req = decoder.next()
+            while req is None:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                decoder.feed(data)
+                req = decoder.next()
+
+    # download the file of a manifest in chunks, see DHTNode.__doManifest
+    async def __doManifest(self, req):
+        content = req.getContent()
+        filename = content["filename"]
+        try:
+            path = receivedPath(self._dataDir, filename)
+        except ValueError as e:
+            self._resolve(req.stamp, error=e)
+            return
+
+        # the same file is downloaded once at a time
+        running = self._downloads.get(path)
+        if running is not None:
+            await running.wait()
+            if os.path.exists(path):
+                self._received(req, path, os.path.getsize(path), 0.0)
+            else:
+                self._resolve(req.stamp, error=IOError(
+                    "File {0} is incomplete".format(filename)))
+            return
+        self._downloads[path] = asyncio.Event()
+        try:
+            await self.__download(req, path)
+        finally:
+            self._downloads.pop(path).set()
+
+    async def __download(self, req, path):
+        content = req.getContent()
+        filename = content["filename"]
+        holders = [int(x) for x in content["holders"].split(",")]
+        target = await self._blocking(
+            partialFile, path, int(content["size"]), int(content["chunk"]),
+            content["digests"].split(","))
+        print("\n ---- Downloading file {0}, {1} chunks from Peers {2} ----"
+              .format(filename, len(target), content["holders"]))
+        if target.resumed > 0:
+            print("Resuming after {0} verified chunks".format(target.resumed))
+
+        todo = asyncio.Queue()
+        for index in target.missing():
+            todo.put_nowait(index)
+        failures = dict()
+        streams = min(DHTNode.transferStreams, todo.qsize())
+        begin = perf_counter()
+        try:
+            await asyncio.gather(*(
+                self.__fetchStream(target, filename, transferName(content),
+                                   holders, i, todo, failures)
+                for i in range(streams)))
+            seconds = perf_counter() - begin
+
+            # see DHTNode.__download, an incomplete download resumes
+            if not target.complete():
+                target.close()
+                print("File {0} is incomplete, {1} of {2} chunks "
+                      "verified".format(filename,
+                                        len(target) - len(target.missing()),
+                                        len(target)))
+                self._resolve(req.stamp, error=IOError(
+                    "File {0} is incomplete".format(filename)))
+                return
+            await self._blocking(target.commit)
+        except asyncio.CancelledError:
+            # the peer stops, the chunks verified so far are resumed
+            target.close()
+            raise
+        except Exception:
+            target.discard()
+            raise
+        self._received(req, target.path, target.size, seconds,
+                       chunks=len(target), streams=streams)
+
+    # fetch chunks from the holders until todo is empty,
+    # see DHTNode.__fetchStream
+    async def __fetchStream(self, target, filename, name, holders, i, todo,
+                            failures):
+        writer = None
+        while not todo.empty():
+            index = todo.get_nowait()
+            holder = holders[i % len(holders)]
+            offset, length = target.span(index)
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(
+                        "127.0.0.1", toPort(holder))
+                    decoder = frameDecoder()
+                data = await asyncio.wait_for(self._fetchRange(
+                    reader, writer, decoder, holder, filename, name,
+                    offset, length), 30)
+                if await self._blocking(target.write, index, data):
+                    continue
+                print("Chunk {0} of file {1} from Peer {2} is corrupt".format(
+                    index, filename, holder))
+            except (OSError, ValueError, KeyError,
+                    asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                print("Peer {0} failed to send chunk {1}: {2}".format(
+                    holder, index, repr(e)))
+            if writer is not None:
+                writer.close()
+                writer = None
+            i += 1
+            # every holder gets two chances at a chunk
+            failures[index] = failures.get(index, 0) + 1
+            if failures[index] < 2 * len(holders):
+                todo.put_nowait(index)
+        if writer is not None:
+            writer.close()
+
+    # ask peer for size bytes at offset of filename, see DHTNode.fetchRange
+    async def _fetchRange(self, reader, writer, decoder, peer, filename,
+                          name, offset, size):
+        writer.write(reqData("fetch", self._nodeID, peer,
+                             {"_nodeID": self._nodeID, "filename": filename,
+                              "name": name, "offset": offset,
+                              "size": size}).toFrame())
+        await writer.drain()
+        reply = decoder.next()
+        while reply is None:
+            data = await reader.read(65536)
+            if not data:
+                raise ConnectionError("Peer {} closed the fetch".format(peer))
+            decoder.feed(data)
+            reply = decoder.next()
+        if reply.opr == "busy":
+            raise ConnectionRefusedError("Peer {} is busy".format(peer))
+        if reply.opr != "chunk":
+            raise KeyError(filename)
+
+        size = int(reply.getContent()["size"])
+        payload = decoder.rest()[:size]
+        if len(payload) == size:
+            return payload
+        return payload + await reader.readexactly(size - len(payload))
+
+    # store or request the names of a batch, see DHTNode.__doBatch
+    async def __doBatch(self, req):
+        content = req.getContent()
+        kind = content["kind"]
+        origin = int(content["_nodeID"])
+        hops = int(content.get("hops", 0))
+        names = splitNames(content["names"])
+
+        # a replica on the way serves a request as well as the owner
+        mine, missing, groups = [], [], dict()
+        for name in names:
+            key = toHash(name)
+            if key is None:
+                missing.append(name)
+            elif ownsKey(key, req.src, self._nodeID) or \
+                    (kind == "request" and name in self._replicas):
+                mine.append(name)
+            else:
+                groups.setdefault(self._nextHop(key), []).append(name)
+
+        for hop, group in groups.items():
+            part = reqData("batch", self._nodeID, hop,
+                           dict(content, names=joinNames(group)),
+                           req.stamp)
+            hop = await self._route(part, hop=hop)
+            if hop is None:
+                missing.extend(group)
+            else:
+                self._log(req.stamp,
+                          "Batch {0} of {1} files forwarded to "
+                          "Peer {2}".format(kind, len(group), hop))
+
+        done = []
+        if kind == "store" and len(mine) > 0:
+            self._log(req.stamp,
+                      "\n ---- Store {0} files request accepted ----".format(
+                          len(mine)))
+            self._store.putMany(mine)
+            await self._replicate(mine)
+            done = mine
+        elif kind == "request":
+            for name in mine:
+                entry = self._store.get(name) or self._replicas.get(name)
+                if entry is None or entry.path is None:
+                    missing.append(name)
+                    continue
+                try:
+                    await self._sendFile(origin, entry, req.stamp, hops=hops)
+                    done.append(name)
+                except OSError:
+                    print("Peer {} is unreachable".format(origin))
+                    missing.append(name)
+
+        if len(done) == 0 and len(missing) == 0:
+            return
+        await self._tell(reqData(
+            "batched", self._nodeID, origin,
+            {"_nodeID": self._nodeID, "kind": kind,
+             "done": joinNames(done), "missing": joinNames(missing),
+             "hops": hops}, req.stamp))
+
+    # a peer did its part of a batch submitted here
+    def __doBatched(self, req):
+        content = req.getContent()
+        state = self._batches.get(req.stamp)
+        if state is None:
+            return
+        done = splitNames(content["done"])
+        missing = splitNames(content["missing"])
+        waiting = state["waiting"]
+        state["done"] += len([x for x in done if x in waiting])
+        state["missing"].extend(x for x in missing if x in waiting)
+        waiting.difference_update(done)
+        waiting.difference_update(missing)
+        state["peers"].add(int(content["_nodeID"]))
+        state["hops"] = max(state["hops"], int(content.get("hops", 0)))
+        if len(waiting) == 0:
+            self._finishBatch(self._batches.pop(req.stamp))
+
+    async def __doLookup(self, req):
+        content = req.getContent()
+        key = int(content["key"])
+        if ownsKey(key, req.src, self._nodeID):
+            await self._tell(reqData(
+                "found", self._nodeID, int(content["_nodeID"]),
+                {"_nodeID": self._nodeID, "key": key,
+                 "slot": content["slot"]}, req.stamp))
+        else:
+            await self._route(req, key)
+
+    # name the owner of the key of an iterative lookup on writer,
+    # see DHTNode.__doHop
+    async def __doHop(self, req, writer):
+        key = int(req.getContent()["key"])
+        content = {"_nodeID": self._nodeID, "_firstID": self._firstID,
+                   "_secondID": self._secondID}
+        pred = self._predecessor()
+        if self._firstID == self._nodeID or \
+                pred is not None and betweenRight(key, pred, self._nodeID):
+            content.update(owner=self._nodeID, backup=self._firstID)
+        elif betweenRight(key, self._nodeID, self._firstID):
+            content.update(owner=self._firstID, backup=self._secondID)
+        else:
+            content.update(next=self._nextHop(key))
+        writer.write(reqData("hopped", self._nodeID, req.src, content,
+                             req.stamp).toFrame())
+        await writer.drain()
+
+    # a page of our keys for a scan on writer, see DHTNode.__doScan
+    async def __doScan(self, req, writer):
+        content = req.getContent()
+        limit = max(1, min(int(content.get("limit", DHTNode.scanPageSize)),
+                           DHTNode.scanPageMax))
+        writer.write(reqData("scanned", self._nodeID, req.src,
+                             self._scanContent(
+                                 int(content.get("lo", 0)),
+                                 int(content.get("hi", 0)), limit,
+                                 content.get("after")),
+                             req.stamp).toFrame())
+        await writer.drain()
+
+    # ask peer for its best next hop towards key
+    # returns the content of its hopped reply
+    async def _askHop(self, peer, key, stamp):
+        reader, writer = await asyncio.open_connection(
+            "127.0.0.1", toPort(peer))
+        try:
+            writer.write(reqData("hop", self._nodeID, peer,
+                                 {"_nodeID": self._nodeID, "key": key},
+                                 stamp).toFrame())
+            await writer.drain()
+            decoder = frameDecoder()
+            reply = decoder.next()
+            while reply is None:
+                data = await reader.read(4096)
+                if not data:
+                    raise ConnectionError(
+                        "Peer {} closed the lookup".format(peer))
+                decoder.feed(data)
+                reply = decoder.next()
+            return reply.getContent()
+        finally:
+            writer.close()
+
+    # find the owner of a submitted request hop by hop,
+    # see DHTNode.__iterate
+    async def __iterate(self, req):
+        content = req.getContent()
+        filename = content["filename"]
+        key = toHash(filename)
+        if key is None:
+            self._resolve(req.stamp, error=ValueError(
+                "Invalid filename {0}".format(filename)))
+            return
+
+        pred = self._predecessor()
+        rounds = 0
+        if self._firstID == self._nodeID or \
+                pred is not None and betweenRight(key, pred, self._nodeID):
+            owner, backup = self._nodeID, None
+        elif betweenRight(key, self._nodeID, self._firstID):
+            owner, backup = self._firstID, self._secondID
+        elif req.opr == "request" and self._cache.owner(key) is not None:
+            owner, backup = self._cache.owner(key), None
+        else:
+            lookup = iterativeLookup(
+                key, [p for p in (self._nextHop(key), self._firstID,
+                                  self._secondID) if p != self._nodeID],
+                DHTNode.lookupParallel, 2 * keySpace.ringBits + 2)
+            peers = lookup.next()
+            while peers:
+                self._stats.count("hopQueries", len(peers))
+                replies = await asyncio.gather(*[asyncio.wait_for(
+                    self._askHop(peer, key, req.stamp), DHTNode.hopTimeout)
+                    for peer in peers], return_exceptions=True)
+                for peer, reply in zip(peers, replies):
+                    if not isinstance(reply, Exception):
+                        lookup.answer(peer, reply)
+                        continue
+                    self._stats.count("hopTimeouts")
+                    self._log(req.stamp, "Peer {0} did not answer the "
+                              "lookup for file {1}".format(peer, filename))
+                    lookup.fail(peer)
+                    self._fingers.remove(peer)
+                peers = lookup.next()
+            owner, backup, rounds = lookup.owner, lookup.fallback(), \
+                lookup.rounds
+
+        # the request itself is one more hop unless it stays here
+        hops = rounds if owner == self._nodeID else rounds + 1
+        req.setContent(direct=1, hops=hops)
+        for dst in (owner, backup):
+            if dst is None:
+                continue
+            req.dst = dst
+            try:
+                await self._send(req)
+                self._log(req.stamp, "Request for file {0} sent straight to "
+                          "Peer {1} after {2} lookup rounds".format(
+                              filename, dst, rounds))
+                return
+            except OSError:
+                print("Peer {} is unreachable".format(dst))
+
+        self._stats.count("lookupFallbacks")
+        self._log(req.stamp, "Lookup for file {0} failed, the request walks "
+                  "the ring".format(filename))
+        req.setContent(direct=0, hops=0)
+        req.dst = self._nodeID
+        try:
+            await self._send(req)
+        except OSError as e:
+            self._resolve(req.stamp, error=e)
+
+    # hand the keys in (lo, hi] over to peer
+    # they are kept as replicas if peer precedes this peer
+    # a range with lo == hi stands for every key
+    async def _handoff(self, peer, lo, hi, keepReplicas=True):
+        names = [e.name for e in self._store.select(
+            lambda k: betweenRight(k, lo, hi))]
+        if len(names) == 0:
+            print("No keys to hand over to Peer {0}".format(peer))
+            return 0, 0
+
+        sent = 0
+        begin = perf_counter()
+        for req in nameBatches("handoff", self._nodeID, peer, names):
+            await self._send(req)
+            sent += len(req.toFrame())
+            content = req.getContent()
+            print("Handoff to Peer {0}: batch {1}/{2}".format(
+                peer, content["batch"], content["batches"]))
+        self._stats.count("handoffBytes", sent)
+        if keepReplicas:
+            self._replicas.putMany(names)
+        self._store.removeMany(names)
+        print("Handed {0} keys over to Peer {1}, {2} bytes at {3}".format(
+            len(names), peer, sent, rate(sent, perf_counter() - begin)))
+        return len(names), sent
+
+    def __doHandoff(self, req):
+        content = req.getContent()
+        names = splitNames(content["names"])
+        count = self._store.putMany(names)
+        self._replicas.removeMany(names)
+        done = self._handoffs.get(req.src, 0) + 1
+        self._handoffs[req.src] = done
+        print("Handoff from Peer {0}: {1}/{2} batches, {3} keys".format(
+            req.src, done, content["batches"], count))
+        if done == content["batches"]:
+            del self._handoffs[req.src]
+            print("Handoff from Peer {0} done, {1} keys kept here".format(
+                req.src, len(self._store)))
+
+        # keys in front of our predecessor arrived after it joined,
+        # they are its own
+        pred = self._predID
+        if pred is not None and pred != req.src and \
+                not self._members.gone(pred) and \
+                any(not betweenRight(toHash(n), pred, self._nodeID)
+                    for n in names):
+            self._spawn(self._handoff(pred, self._nodeID, pred))
+
+        # the successors copied our keys before these arrived
+        self._spawn(self._replicate([n for n in names if n in self._store]))
+
+    # copy names to the next replicaCount successors
+    # see DHTNode._replicate
+    async def _replicate(self, names, dst=None, ttl=None):
+        dst = self._firstID if dst is None else dst
+        ttl = self._replicaCount if ttl is None else ttl
+        if ttl < 1 or dst == self._nodeID or len(names) == 0:
+            return
+        try:
+            for req in nameBatches("replicate", self._nodeID, dst,
+                                   names, ttl=ttl):
+                await self._send(req)
+        except OSError:
+            print("Peer {} is unreachable".format(dst))
+
+    # keep a copy of names for their owner and pass them on
+    # until ttl successors have them
+    async def __doReplicate(self, req):
+        content = req.getContent()
+        owner = int(content["_nodeID"])
+        if owner == self._nodeID:
+            return
+        names = splitNames(content["names"])
+        self._replicas.putMany(names)
+
+        ttl = int(content["ttl"]) - 1
+        if ttl > 0 and self._firstID not in (owner, self._nodeID):
+            req.setContent(ttl=ttl)
+            await self._route(req, hop=self._firstID)
+
+    # see DHTNode._repairReplicas
+    async def _repairReplicas(self):
+        pred = self._predecessor()
+        if pred is not None:
+            names = [e.name for e in self._replicas.select(
+                lambda k: betweenRight(k, pred, self._nodeID))]
+            if len(names) > 0:
+                self._store.putMany(names)
+                self._replicas.removeMany(names)
+                print("Promoted {0} replicas, {1} keys kept here".format(
+                    len(names), len(self._store)))
+                await self._replicate(names)
+        await self._replicateChain()
+        self._expireReplicas()
+
+    # see DHTNode._replicateChain
+    async def _replicateChain(self):
+        old = self._replicaChain
+        chain = replicaChain(self._nodeID, self._firstID, self._secondID,
+                             self._replicaCount)
+        if chain == old:
+            return
+        self._replicaChain = chain
+        added = chainAdditions(old, chain, self._replicaCount)
+        if len(added) > 0:
+            names = [e.name for e in self._store.entries()]
+            for peer, ttl in added:
+                await self._replicate(names, peer, ttl)
+
+    # see DHTNode._expireReplicas
+    def _expireReplicas(self):
+        preds = self._members.predecessors(self._replicaCount + 1)
+        if len(preds) <= self._replicaCount:
+            return
+        now = monotonic()
+        strays = dict((e.name, self._strays.get(e.name, now))
+                      for e in self._replicas.select(
+                          lambda k: not betweenRight(k, preds[-1],
+                                                     self._nodeID)))
+        expired = [name for name, since in strays.items()
+                   if now - since >= DHTNode.replicaExpiry]
+        for name in expired:
+            del strays[name]
+        self._strays = strays
+        if len(expired) > 0:
+            self._replicas.removeMany(expired)
+            print("Dropped {0} replicas of keys owned further back".format(
+                len(expired)))
+
+    async def __doTransfer(self, req, reader, writer):
+        self._log(req.stamp, "\n ---- Transfer request received! ----")
+        content = req.getContent()
+        srcPeer = content["_nodeID"]
+        filename = content["filename"]
+        size = content.get("size")
+        size = None if size is None else int(size)
+        self._log(req.stamp, "Peer {0} had file {1}".format(srcPeer, filename))
+        self._log(req.stamp,
+                  "Receiving File {0} from Peer {1}...".format(
+                      filename, srcPeer))
+        try:
+            path = receivedPath(self._dataDir, filename)
+        except ValueError as e:
+            self._resolve(req.stamp, error=e)
+            return
+        partPath = "{0}.{1}.part".format(path, req.stamp)
+
+        # accept the codec the sender offers if we know it
+        codec = content.get("codec")
+        if codec not in codecs:
+            codec = None
+
+        # tell the sender to start, old senders never wait for it
+        writer.write(reqData("ready", self._nodeID, req.src,
+                             {} if codec is None else {"codec": codec})
+                     .toFrame())
+        begin = perf_counter()
+        received = len(req.payload)
+        sink = None
+        try:
+            with open(partPath, "wb") as file:
+                if codec is None:
+                    file.write(req.payload)
+                    while size is None or received < size:
+                        fileData = await reader.read(DHTNode.transferBuffer)
+                        if not fileData:
+                            break
+                        file.write(fileData)
+                        received += len(fileData)
+                else:
+                    sink = zlibSink(file)
+                    sink.feed(req.payload)
+                    while not sink.done:
+                        fileData = await reader.read(DHTNode.transferBuffer)
+                        if not fileData:
+                            break
+                        sink.feed(fileData)
+                    received = sink.raw
+        except BaseException:
+            # a transfer is never resumed, what arrived of it is useless
+            if os.path.exists(partPath):
+                os.remove(partPath)
+            raise
+        seconds = perf_counter() - begin
+        if sink is not None:
+            self._compressed(sink, "decompress")
+            self._log(req.stamp, "File {0} arrived as {1}".format(
+                filename, sink))
+
+        # the file only replaces an older copy once it is complete
+        error = None
+        if size is not None and received < size:
+            error = "File {0} is truncated, {1} of {2} bytes received".format(
+                filename, received, size)
+        elif "sha256" in content and (await self._blocking(
+                readDigests, partPath, DHTNode.chunkSize))[0] != \
+                content["sha256"]:
+            error = "File {0} is corrupt".format(filename)
+        if error is not None:
+            print(error)
+            os.remove(partPath)
+            self._resolve(req.stamp, error=IOError(error))
+            return
+        os.replace(partPath, path)
+        self._received(req, path, received, seconds)
+
+    # count what a zlib stream or sink saved and cost
+    def _compressed(self, codec, what):
+        self._stats.count("wireBytes" + ("Sent" if what == "compress"
+                                         else "Received"), codec.wire)
+        self._stats.observe(what + "CpuSeconds", codec.cpu)
+        self._stats.observe("compressionRatio", codec.ratio(), ratioBuckets)
+
+    # a file requested here arrived at path
+    def _received(self, req, path, received, seconds, **result):
+        content = req.getContent()
+        srcPeer = int(content["_nodeID"])
+        self._stats.count("bytesReceived", received)
+        self._stats.observe("transferSeconds", seconds)
+        self._log(req.stamp, "File {0} received, {1} bytes at {2}".format(
+            os.path.basename(path), received, rate(received, seconds)))
+        if "lo" in content:
+            self._cache.put(int(content["lo"]), srcPeer, srcPeer)
+        self._cache.putFile(transferName(content), path, received)
+        self._resolve(req.stamp, peer=srcPeer,
+                      hops=int(content.get("hops", 0)),
+                      size=received, transferSeconds=seconds, **result)
+
+
+# run a single asyncio peer until it quits
+# the other virtual nodes of node join the DHT through it once
+# it has a predecessor, and leave once it stopped
+async def hostVirtual(node, count, pingInterval, **nodeArgs):
+    while node._predecessor() is None:
+        if node._stopped.is_set():
+            return
+        await asyncio.sleep(1)
+    hosted = []
+    # a position taken by another peer is skipped
+    for vID in virtualIDs(node._nodeID, 4 * count)[1:]:
+        if len(hosted) == count - 1:
+            break
+        vnode = asyncDHTNode(vID, pingInterval, interactive=False,
+                             **nodeArgs)
+        try:
+            await vnode.start("join", knownNode=node._nodeID)
+        except OSError:
+            print("Virtual node {0} is taken".format(vID))
+            continue
+        hosted.append(vnode)
+    print("Peer {0} hosts virtual nodes {1}".format(
+        node._nodeID, ", ".join(str(v._nodeID) for v in hosted)))
+    await node._stopped.wait()
+    for vnode in hosted:
+        await vnode.quit()
+        await vnode.serve()
+
+
+def runNode(ID, pingInterval, startType, replicas=DHTNode.replicaFactor,
+            cacheFiles=0, verbose=True, metricsDir=None, traceSample=0,
+            compressLevel=0, control=False, queueLimit=queueLimit, vnodes=1,
+            stabilizeInterval=DHTNode.stabilizeInterval, **kwargs):
+    nodeArgs = {"replicas": replicas, "cacheFiles": cacheFiles,
+                "verbose": verbose, "metricsDir": metricsDir,
+                "traceSample": traceSample, "compressLevel": compressLevel,
+                "control": control, "queueLimit": queueLimit,
+                "stabilizeInterval": stabilizeInterval}
+    node = asyncDHTNode(ID, pingInterval, **nodeArgs)
+
+    async def main():
+        await node.start(startType, **kwargs)
+        if vnodes > 1:
+            await asyncio.gather(node.serve(), hostVirtual(
+                node, vnodes, pingInterval, **nodeArgs))
+        else:
+            await node.serve()
+
+    asyncio.run(main())
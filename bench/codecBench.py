@@ -0,0 +1,104 @@
+# micro-benchmark of the reqData wire formats
+# compares the text format with the binary frames on
+# encoding, decoding one request per read and
+# decoding a stream cut into random reads
+#
+# python3 bench/codecBench.py [number of requests]
+
+from time import perf_counter
+from random import Random
+
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DHTNode import reqData, frameDecoder, frameText, frameBinary  # noqa: E402
+
+
+# a mix of the requests a busy ring sends
+def sampleRequests(count):
+    rand = Random(9331)
+    reqs = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            reqs.append(reqData("store", rand.randrange(256), rand.randrange(256),
+                                {"_nodeID": rand.randrange(256),
+                                 "filename": str(rand.randrange(10000))}))
+        elif kind == 1:
+            reqs.append(reqData("request", rand.randrange(256), rand.randrange(256),
+                                {"_nodeID": rand.randrange(256),
+                                 "filename": str(rand.randrange(10000))}))
+        elif kind == 2:
+            reqs.append(reqData("update", rand.randrange(256), rand.randrange(256),
+                                {"_nodeID": rand.randrange(256),
+                                 "_firstID": rand.randrange(256),
+                                 "_secondID": rand.randrange(256)}))
+        else:
+            reqs.append(reqData("abrupt", rand.randrange(256), rand.randrange(256),
+                                {"_nodeID": rand.randrange(256),
+                                 "_firstID": rand.randrange(256),
+                                 "_secondID": rand.randrange(256),
+                                 "leaveNode": rand.randrange(256)}))
+    return reqs
+
+
+# encode every request, then decode every request as if it
+# arrived in its own read and read its content three times,
+# like __doAbrupt does
+def roundTrip(reqs, version):
+    begin = perf_counter()
+    frames = [r.toFrame(version) for r in reqs]
+    encoded = perf_counter() - begin
+
+    begin = perf_counter()
+    for frame in frames:
+        decoder = frameDecoder()
+        decoder.feed(frame)
+        req = decoder.next()
+        for i in range(3):
+            req.getContent()
+    decoded = perf_counter() - begin
+
+    size = sum(len(f) for f in frames) / len(frames)
+    return encoded, decoded, size, b"".join(frames)
+
+
+# feed the concatenated frames in random sized reads
+# and read the content of every request once
+def streamDecode(stream, count):
+    rand = Random(3331)
+    decoder = frameDecoder()
+    found = 0
+    pos = 0
+    begin = perf_counter()
+    while pos < len(stream):
+        step = rand.randint(1, 8192)
+        decoder.feed(stream[pos:pos + step])
+        pos += step
+        req = decoder.next()
+        while req is not None:
+            req.getContent()
+            found += 1
+            req = decoder.next()
+    assert found == count
+    return perf_counter() - begin
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    reqs = sampleRequests(count)
+
+    print("{0} requests".format(count))
+    print("{0:<8}{1:>14}{2:>14}{3:>14}{4:>12}".format(
+        "format", "encode req/s", "decode req/s", "stream req/s", "bytes/req"))
+    for name, version in (("text", frameText), ("binary", frameBinary)):
+        encoded, decoded, size, stream = roundTrip(reqs, version)
+        streamed = streamDecode(stream, count)
+        print("{0:<8}{1:>14.0f}{2:>14.0f}{3:>14.0f}{4:>12.1f}".format(
+            name, count / encoded, count / decoded, count / streamed, size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# convergence benchmark of peers joining at the same time
+# starts a ring, stores files, joins many peers at once through
+# random members and measures how long it takes until every peer has
+# the right successors and predecessor, then requests every file
+# exits with 1 if the ring did not converge or a file was lost
+#
+# python3 bench/joinBench.py [--engine thread|async] [--nodes 8] [--joins 32]
+#                            [--ring-bits 8] [--hash digits]
+
+from random import Random
+from time import monotonic
+
+import argparse
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from harness import ringHarness, workload  # noqa: E402
+import DHTNode  # noqa: E402
+import keySpace  # noqa: E402
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Parallel join benchmark")
+    parser.add_argument("--engine", choices=("thread", "async"),
+                        default="thread")
+    parser.add_argument("--nodes", type=int, default=8,
+                        help="peers of the ring before the joins")
+    parser.add_argument("--joins", type=int, default=32,
+                        help="peers joining at once")
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--ring-bits", type=int, default=keySpace.ringBits)
+    parser.add_argument("--hash", choices=sorted(keySpace.hashFunctions),
+                        default=keySpace.hashName)
+    parser.add_argument("--base-port", type=int, default=20000)
+    parser.add_argument("--ping", type=int, default=2,
+                        help="ping interval in seconds")
+    parser.add_argument("--stabilize", type=float,
+                        default=DHTNode.stabilizeInterval,
+                        help="stabilize interval in seconds")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="seconds the ring may take to converge")
+    parser.add_argument("--seed", type=int, default=9331)
+    parser.add_argument("--log", help="file receiving the peer output")
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    keySpace.configure(args.ring_bits, args.hash)
+    harness = ringHarness(engine=args.engine, basePort=args.base_port,
+                          pingInterval=args.ping, log=args.log,
+                          stabilizeInterval=args.stabilize)
+    out = harness._stdout
+    try:
+        ids = Random(args.seed).sample(range(keySpace.ringSize), args.nodes)
+        harness.start(ids)
+        load = workload(harness, seed=args.seed,
+                        convergeTimeout=args.timeout)
+        stored = load.runStep("store:{0}".format(args.files))
+
+        begin = monotonic()
+        joined = load.runStep("joinParallel:{0}".format(args.joins))
+        seconds = monotonic() - begin
+        repairs = sum(n._stats.toDict()["counters"].get(
+            "stabilizeRepairs", 0) for n in harness._nodes.values())
+
+        requested = load.runStep("request:{0}".format(len(load.stored)))
+        requested.failed += args.files - stored.ok
+
+        print("{0} peers ({1}) joined by {2} at once".format(
+            args.nodes, args.engine, args.joins), file=out)
+        print("joined: {0}/{1}, converged: {2}, after {3:.2f} s, "
+              "{4} stabilize repairs".format(
+                  joined.ok, args.joins, joined.timeouts == 0, seconds,
+                  repairs), file=out)
+        print("files: {0} stored, {1} found, {2} lost".format(
+            stored.ok, requested.ok,
+            requested.failed + requested.timeouts), file=out)
+        failed = joined.failed or joined.timeouts or \
+            requested.failed or requested.timeouts
+    finally:
+        harness.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
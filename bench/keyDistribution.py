@@ -0,0 +1,152 @@
+# how the keys and the requests are spread over the peers of a ring
+# every key is owned by the first ring position at or after it,
+# a peer owns the keys of all its virtual positions
+# prints the spread of every --vnodes setting and, with --per-node,
+# the share of every peer
+#
+# python3 bench/keyDistribution.py [options]
+# python3 bench/keyDistribution.py --nodes 32 --vnodes 1,4,16,64 \
+#     --ring-bits 14 --hash blake2b
+
+from random import Random
+
+import argparse
+import json
+import math
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import keySpace  # noqa: E402
+from DHTNode import readManifest  # noqa: E402
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Key distribution report")
+    parser.add_argument("--nodes", type=int, default=32,
+                        help="number of random peer IDs")
+    parser.add_argument("--ids", help="comma separated peer IDs instead")
+    parser.add_argument("--vnodes", default="1",
+                        help="comma separated positions per peer")
+    parser.add_argument("--ring-bits", type=int, default=keySpace.ringBits)
+    parser.add_argument("--hash", choices=sorted(keySpace.hashFunctions),
+                        default=keySpace.hashName)
+    parser.add_argument("--keys", type=int, default=10000,
+                        help="names 0000 to keys - 1")
+    parser.add_argument("--manifest", help="file listing the names instead")
+    parser.add_argument("--skew", type=float, default=1.0,
+                        help="zipf exponent of the requested names")
+    parser.add_argument("--seed", type=int, default=9331)
+    parser.add_argument("--per-node", action="store_true")
+    parser.add_argument("--json", help="write the report to this file")
+    return parser.parse_args()
+
+
+# peer -> its ring positions
+def placePeers(ids, vnodes):
+    positions = dict()
+    taken = set()
+    for ID in ids:
+        positions[ID] = keySpace.virtualIDs(ID, vnodes, taken)
+        taken.update(positions[ID])
+    return positions
+
+
+# keys and request weight owned by every peer
+def distribute(positions, keys, weights):
+    owners = dict()
+    for ID, vIDs in positions.items():
+        for vID in vIDs:
+            owners[vID] = ID
+    ring = sorted(owners)
+    counts = dict.fromkeys(positions, 0)
+    load = dict.fromkeys(positions, 0.0)
+    for key, weight in zip(keys, weights):
+        owner = owners[keySpace.successor(key, ring)]
+        counts[owner] += 1
+        load[owner] += weight
+    return counts, load
+
+
+# min, mean, max, max / mean and the coefficient of variation
+def spread(values):
+    values = list(values)
+    mean = sum(values) / len(values)
+    std = math.sqrt(sum((v - mean) ** 2 for v in values) / len(values))
+    return {"min": min(values), "mean": round(mean, 2), "max": max(values),
+            "maxOverMean": round(max(values) / mean, 2) if mean else 0.0,
+            "cv": round(std / mean, 3) if mean else 0.0}
+
+
+def printRows(columns, rows):
+    print("".join("{0:>16}".format(c) for c in columns))
+    for row in rows:
+        print("".join("{0:>16}".format(row[c]) for c in columns))
+
+
+def main():
+    args = parseArgs()
+    keySpace.configure(args.ring_bits, args.hash)
+    rand = Random(args.seed)
+
+    if args.ids:
+        ids = [int(x) for x in args.ids.split(",")]
+    else:
+        ids = rand.sample(range(keySpace.ringSize), args.nodes)
+
+    names = readManifest(args.manifest) if args.manifest else \
+        ["{0:04d}".format(i) for i in range(args.keys)]
+    keys = [keySpace.toKey(name) for name in names]
+    invalid = [n for n, k in zip(names, keys) if k is None]
+    if invalid:
+        print("{0} names are not valid for {1}, e.g. {2}".format(
+            len(invalid), args.hash, invalid[0]))
+        sys.exit(1)
+
+    # the i-th most popular name is requested with weight 1 / i ** skew
+    order = list(range(len(names)))
+    rand.shuffle(order)
+    weights = [0.0] * len(names)
+    for rank, i in enumerate(order):
+        weights[i] = 1.0 / (rank + 1) ** args.skew
+    total = sum(weights)
+
+    print("{0} peers, {1} names, {2}-bit ring, {3}, skew {4}".format(
+        len(ids), len(names), args.ring_bits, args.hash, args.skew))
+    report = []
+    for vnodes in [int(v) for v in args.vnodes.split(",")]:
+        positions = placePeers(ids, vnodes)
+        counts, load = distribute(positions, keys, weights)
+        share = dict((ID, round(100 * w / total, 2)) for ID, w in load.items())
+        keyStats = spread(counts.values())
+        loadStats = spread(share.values())
+        report.append({
+            "vnodes": vnodes,
+            "positions": sum(len(v) for v in positions.values()),
+            "keysMin": keyStats["min"], "keysMean": keyStats["mean"],
+            "keysMax": keyStats["max"],
+            "keysMaxOverMean": keyStats["maxOverMean"],
+            "keysCv": keyStats["cv"],
+            "loadMaxPct": loadStats["max"],
+            "loadMaxOverMean": loadStats["maxOverMean"],
+            "peers": [{"id": ID, "positions": len(positions[ID]),
+                       "keys": counts[ID], "loadPct": share[ID]}
+                      for ID in sorted(ids, key=lambda i: -counts[i])]})
+
+    printRows(["vnodes", "positions", "keysMin", "keysMean", "keysMax",
+               "keysMaxOverMean", "keysCv", "loadMaxPct", "loadMaxOverMean"],
+              report)
+    if args.per_node:
+        for row in report:
+            print("\nvnodes {0}".format(row["vnodes"]))
+            printRows(["id", "positions", "keys", "loadPct"], row["peers"])
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"nodes": ids, "names": len(names),
+                       "ringBits": args.ring_bits, "hash": args.hash,
+                       "skew": args.skew, "settings": report}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# rolling restart benchmark
+# starts a ring, stores files, then kills and restarts every peer one
+# after the other, either from its snapshot or with a plain join, and
+# counts the messages every restart took, then requests every file
+# a cold restart waits for the ring to repair itself first
+# exits with 1 if a restart failed, the ring did not converge
+# or a file was lost
+#
+# python3 bench/restartBench.py [--engine thread|async] [--nodes 16]
+#                               [--mode warm|cold] [--down 0]
+#                               [--ring-bits 8] [--hash digits]
+
+from random import Random
+from time import monotonic, sleep
+
+import argparse
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from harness import ringHarness, workload  # noqa: E402
+import DHTNode  # noqa: E402
+import keySpace  # noqa: E402
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Rolling restart benchmark")
+    parser.add_argument("--engine", choices=("thread", "async"),
+                        default="thread")
+    parser.add_argument("--nodes", type=int, default=16)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--ring-bits", type=int, default=keySpace.ringBits)
+    parser.add_argument("--hash", choices=sorted(keySpace.hashFunctions),
+                        default=keySpace.hashName)
+    parser.add_argument("--mode", choices=("warm", "cold"), default="warm",
+                        help="restart from the snapshot, or join again")
+    parser.add_argument("--down", type=float, default=0,
+                        help="seconds every peer stays down")
+    parser.add_argument("--base-port", type=int, default=20000)
+    parser.add_argument("--ping", type=int, default=2,
+                        help="ping interval in seconds")
+    parser.add_argument("--stabilize", type=float,
+                        default=DHTNode.stabilizeInterval,
+                        help="stabilize interval in seconds")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="seconds the ring may take to converge")
+    parser.add_argument("--seed", type=int, default=9331)
+    parser.add_argument("--log", help="file receiving the peer output")
+    return parser.parse_args()
+
+
+def counter(harness, name):
+    nodes = list(harness._nodes.values()) + harness._gone
+    return sum(n._stats.toDict()["counters"].get(name, 0) for n in nodes)
+
+
+def main():
+    args = parseArgs()
+    keySpace.configure(args.ring_bits, args.hash)
+    harness = ringHarness(engine=args.engine, basePort=args.base_port,
+                          pingInterval=args.ping, log=args.log,
+                          stabilizeInterval=args.stabilize)
+    out = harness._stdout
+    rand = Random(args.seed)
+    try:
+        ids = rand.sample(range(keySpace.ringSize), args.nodes)
+        harness.start(ids)
+        load = workload(harness, seed=args.seed)
+        stored = load.runStep("store:{0}".format(args.files))
+        # every peer wrote its snapshot once
+        sleep(args.ping + 1)
+
+        failed = 0
+        messages = []
+        seconds = []
+        begin = monotonic()
+        for ID in sorted(ids):
+            harness.kill(ID)
+            sleep(args.down)
+            sent = harness.messages()
+            started = monotonic()
+            if args.mode == "warm":
+                ok = harness.restart(ID)
+            else:
+                # a join is taken for a copy of an earlier one until
+                # the ring repaired itself around the peer
+                ok = harness.converge(args.timeout) is not None and \
+                    harness.join(ID, rand.choice(harness.ids()))
+            if not ok:
+                failed += 1
+                continue
+            seconds.append(monotonic() - started)
+            messages.append(harness.messages() - sent)
+            # the next peer goes down once this one is back in place
+            if harness.converge(args.timeout) is None:
+                failed += 1
+        total = monotonic() - begin
+
+        requested = load.runStep("request:{0}".format(len(load.stored)))
+        requested.failed += args.files - stored.ok
+
+        print("{0} peers ({1}) restarted one by one, {2}, down {3} s".format(
+            args.nodes, args.engine, args.mode, args.down), file=out)
+        print("restarts: {0}/{1} in {2:.2f} s, {3:.1f} ms and {4:.1f} "
+              "messages per restart, {5} warm, {6} cold".format(
+                  len(seconds), args.nodes, total,
+                  1000 * sum(seconds) / max(1, len(seconds)),
+                  sum(messages) / max(1, len(messages)),
+                  counter(harness, "warmRestarts"),
+                  counter(harness, "coldRestarts")), file=out)
+        print("files: {0} stored, {1} found, {2} lost".format(
+            stored.ok, requested.ok,
+            requested.failed + requested.timeouts), file=out)
+        failed = failed or requested.failed or requested.timeouts
+    finally:
+        harness.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# load benchmark of a whole ring running in this process
+# starts the peers, runs a workload against them and prints the
+# latency percentiles, hops, requests per operation and transfer rate
+# of every step
+# exits with 1 if a limit is exceeded, so that CI catches regressions
+#
+# python3 bench/ringBench.py [options] [step ...]
+# steps are described in harness.workload, the default is
+# store:200 request:1000 join:4 request:500 quit:2 kill:2 request:500
+
+from random import Random
+
+import argparse
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from harness import ringHarness, workload, parseSize  # noqa: E402
+import keySpace  # noqa: E402
+from admission import queueLimit  # noqa: E402
+
+defaultSteps = ["store:200", "request:1000", "join:4", "request:500",
+                "quit:2", "kill:2", "request:500"]
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Ring load benchmark")
+    parser.add_argument("steps", nargs="*", default=defaultSteps)
+    parser.add_argument("--nodes", type=int, default=16)
+    parser.add_argument("--engine", choices=("thread", "async"),
+                        default="thread")
+    parser.add_argument("--base-port", type=int, default=20000)
+    parser.add_argument("--ping", type=int, default=2,
+                        help="ping interval in seconds")
+    parser.add_argument("--replicas", type=int, default=2)
+    parser.add_argument("--ring-bits", type=int, default=keySpace.ringBits)
+    parser.add_argument("--hash", choices=sorted(keySpace.hashFunctions),
+                        default=keySpace.hashName)
+    parser.add_argument("--vnodes", type=int, default=1,
+                        help="ring positions of every peer")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="seconds before an operation times out")
+    parser.add_argument("--batch", type=int, default=100,
+                        help="names per storeBatch or requestBatch")
+    parser.add_argument("--file-size", default="1K")
+    parser.add_argument("--skew", type=float, default=0.0,
+                        help="zipf exponent of the requested files")
+    parser.add_argument("--seed", type=int, default=9331)
+    parser.add_argument("--log", help="file receiving the peer output")
+    parser.add_argument("--compress", type=int, default=0,
+                        help="zlib level of transfers, 0 sends them raw")
+    parser.add_argument("--queue-limit", type=int, default=queueLimit,
+                        help="store and request work a peer lets wait")
+    parser.add_argument("--text", action="store_true",
+                        help="files of numbers instead of random bytes")
+    parser.add_argument("--metrics",
+                        help="directory receiving peer<ID>.prom of every peer")
+    parser.add_argument("--trace", type=int, default=0,
+                        help="trace one request in N into --metrics")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--max-p99", type=float,
+                        help="fail if a step has a larger p99 in ms")
+    parser.add_argument("--max-hops", type=float,
+                        help="fail if a step has more hops on average")
+    parser.add_argument("--max-failures", type=int, default=0,
+                        help="fail if a step has more failed operations")
+    return parser.parse_args()
+
+
+def printReport(rows):
+    columns = ["step", "ops", "ok", "failed", "timeouts", "rejected",
+               "opsPerSecond",
+               "p50Ms", "p90Ms", "p99Ms", "maxMs", "meanHops", "maxHops",
+               "messagesPerOp", "messagesPerKey", "transferMBps"]
+    print("".join("{0:>16}".format(c) for c in columns))
+    for row in rows:
+        print("".join("{0:>16}".format(row[c]) for c in columns))
+
+
+# the reasons the report breaks the limits
+def violations(args, rows):
+    found = []
+    for row in rows:
+        if args.max_p99 is not None and row["p99Ms"] > args.max_p99:
+            found.append("{0}: p99 {1} ms > {2} ms".format(
+                row["step"], row["p99Ms"], args.max_p99))
+        if args.max_hops is not None and row["meanHops"] > args.max_hops:
+            found.append("{0}: {1} hops > {2}".format(
+                row["step"], row["meanHops"], args.max_hops))
+        if row["failed"] + row["timeouts"] > args.max_failures:
+            found.append("{0}: {1} failed, {2} timed out".format(
+                row["step"], row["failed"], row["timeouts"]))
+    return found
+
+
+def main():
+    args = parseArgs()
+    keySpace.configure(args.ring_bits, args.hash)
+    ids = []
+    for ID in Random(args.seed).sample(range(keySpace.ringSize), args.nodes):
+        ids.extend(keySpace.virtualIDs(ID, args.vnodes, set(ids)))
+
+    harness = ringHarness(engine=args.engine, basePort=args.base_port,
+                          pingInterval=args.ping, log=args.log,
+                          replicas=args.replicas, metricsDir=args.metrics,
+                          traceSample=args.trace,
+                          compressLevel=args.compress,
+                          queueLimit=args.queue_limit)
+    try:
+        harness.start(ids)
+        load = workload(harness, concurrency=args.concurrency,
+                        timeout=args.timeout,
+                        fileSize=parseSize(args.file_size),
+                        skew=args.skew, seed=args.seed,
+                        batchSize=args.batch, text=args.text)
+        rows = [r.toDict() for r in load.run(args.steps)]
+    finally:
+        harness.close()
+
+    print("{0} peers x {1} vnodes ({2}), {3} files of {4}, "
+          "{5}-bit ring, {6}".format(
+              args.nodes, args.vnodes, args.engine, len(load.stored),
+              args.file_size, args.ring_bits, args.hash))
+    printReport(rows)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"nodes": args.nodes, "engine": args.engine,
+                       "vnodes": args.vnodes, "ringBits": args.ring_bits,
+                       "hash": args.hash,
+                       "steps": rows}, file, indent=2)
+
+    found = violations(args, rows)
+    for line in found:
+        print(line)
+    sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# the path of traced requests through the ring
+# merges the trace<ID>.jsonl files written by peers started with
+# --metrics DIR --trace N and prints every event of a stamp in time order
+#
+# python3 bench/traceView.py DIR [stamp ...]
+# python3 bench/traceView.py DIR --slowest 5
+
+import argparse
+import glob
+import json
+import os
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Request trace viewer")
+    parser.add_argument("dir", help="directory holding trace<ID>.jsonl")
+    parser.add_argument("stamps", nargs="*", type=int,
+                        help="stamps to print, all of them by default")
+    parser.add_argument("--slowest", type=int,
+                        help="print only the N stamps taking longest")
+    return parser.parse_args()
+
+
+# stamp -> events of every peer, in time order
+def readTraces(directory):
+    traces = dict()
+    for path in glob.glob(os.path.join(directory, "trace*.jsonl")):
+        with open(path) as file:
+            for line in file:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # the last line of a peer killed while writing
+                    continue
+                traces.setdefault(event["stamp"], []).append(event)
+    for events in traces.values():
+        events.sort(key=lambda e: e["time"])
+    return traces
+
+
+def duration(events):
+    return events[-1]["time"] - events[0]["time"]
+
+
+def printTrace(stamp, events):
+    start = events[0]["time"]
+    peers = []
+    for event in events:
+        if event["peer"] not in peers:
+            peers.append(event["peer"])
+    print("stamp {0}: {1:.2f} ms, peers {2}".format(
+        stamp, duration(events) * 1000, " -> ".join(map(str, peers))))
+    for event in events:
+        fields = dict((k, v) for k, v in event.items()
+                      if k not in ("stamp", "peer", "what", "time"))
+        text = fields.pop("text", "")
+        extra = " ".join("{0}={1}".format(k, v)
+                         for k, v in sorted(fields.items()))
+        print("  {0:>9.2f} ms  peer {1:<5} {2:<10} {3}".format(
+            (event["time"] - start) * 1000, event["peer"], event["what"],
+            " ".join(x for x in (text, extra) if x)))
+
+
+def main():
+    args = parseArgs()
+    traces = readTraces(args.dir)
+    stamps = args.stamps or sorted(traces, key=lambda s: traces[s][0]["time"])
+    if args.slowest:
+        stamps = sorted(stamps, key=lambda s: -duration(traces[s]))
+        stamps = stamps[:args.slowest]
+    for stamp in stamps:
+        if stamp not in traces:
+            print("stamp {0}: not traced".format(stamp))
+            continue
+        printTrace(stamp, traces[stamp])
+
+
+if __name__ == "__main__":
+    main()
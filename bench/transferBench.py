@@ -0,0 +1,160 @@
+# throughput of the transfer path over loopback
+# compares the old copy loop (2048 byte reads, sends and writes)
+# with sendFile/recvFile (sendfile on the sender and recv_into a
+# preallocated buffer on the receiver), and with zlib streams at
+# every --compress level, printing their ratio and the CPU time
+# spent compressing per run
+#
+# python3 bench/transferBench.py [--text] [--compress 1,6,9] [size ...]
+# sizes are bytes with an optional K, M or G suffix,
+# the default is 1K 1M 500M
+# --text sends files of numbers like run.sh writes instead of random bytes
+
+from threading import Thread
+from time import perf_counter
+from socket import socket, AF_INET, SOCK_STREAM
+
+import argparse
+import tempfile
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DHTNode import reqData, frameDecoder, sendFile, recvFile, \
+    recvCompressed  # noqa: E402
+from harness import numberText, parseSize  # noqa: E402
+
+
+# write size random-ish bytes, or numbers, to path
+def makeFile(path, size, text=False):
+    block = numberText(1 << 20) if text else os.urandom(1 << 20)
+    with open(path, "wb") as file:
+        while size > 0:
+            file.write(block[:min(size, len(block))])
+            size -= len(block)
+
+
+# the old way, copying 2048 bytes at a time through python
+def copySend(sock, req, path):
+    sock.sendall(req.toFrame())
+    with open(path, "rb") as file:
+        while True:
+            data = file.read(2048)
+            if not data:
+                break
+            sock.send(data)
+
+
+def copyRecv(sock, path, payload):
+    with open(path, "wb") as file:
+        file.write(payload)
+        while True:
+            data = sock.recv(2048)
+            if not data:
+                break
+            file.write(data)
+
+
+# accept one transfer on listener and receive it into path
+def receiver(listener, path, zeroCopy, result):
+    conn, addr = listener.accept()
+    decoder = frameDecoder()
+    req = None
+    while req is None:
+        decoder.feed(conn.recv(4096))
+        req = decoder.next()
+    if zeroCopy and "codec" in req.getContent():
+        conn.sendall(reqData("ready", 1, req.src,
+                             {"codec": req.getContent()["codec"]}).toFrame())
+        recvCompressed(conn, path, decoder.rest())
+    elif zeroCopy:
+        conn.sendall(reqData("ready", 1, req.src).toFrame())
+        size = req.getContent()["size"]
+        recvFile(conn, path, size, decoder.rest())
+    else:
+        copyRecv(conn, path, decoder.rest())
+    conn.close()
+    result.append(perf_counter())
+
+
+# send the file at src over loopback, repeat times in a row
+# level > 0 offers a zlib stream
+# returns the MB/s from the first connect to the last byte written
+# and the last zlibStream, None if the file was sent raw
+def transfer(src, dst, zeroCopy, repeat, level=0):
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    size = os.path.getsize(src)
+
+    stream = None
+    begin = perf_counter()
+    for i in range(repeat):
+        result = []
+        thread = Thread(target=receiver,
+                        args=(listener, dst, zeroCopy, result))
+        thread.start()
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.connect(listener.getsockname())
+        req = reqData("transfer", 0, 1, {"_nodeID": 0, "filename": "bench"})
+        if zeroCopy:
+            stream = sendFile(sock, req, src, level)[2]
+        else:
+            copySend(sock, req, src)
+        sock.close()
+        thread.join()
+    elapsed = result[0] - begin
+
+    listener.close()
+    assert os.path.getsize(dst) == size
+    return size * repeat / elapsed / 1e6, stream
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Transfer benchmark")
+    parser.add_argument("sizes", nargs="*",
+                        default=["1K", "1M", "500M"])
+    parser.add_argument("--text", action="store_true",
+                        help="files of numbers instead of random bytes")
+    parser.add_argument("--compress", default="",
+                        help="comma separated zlib levels to compare")
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    sizes = [parseSize(x) for x in args.sizes]
+    levels = [int(x) for x in args.compress.split(",") if x]
+
+    columns = ["size", "runs", "copy MB/s", "zero-copy MB/s"]
+    for level in levels:
+        columns.extend(["zlib{0} MB/s".format(level),
+                        "zlib{0} ratio".format(level),
+                        "zlib{0} CPU ms".format(level)])
+    print("".join("{0:>16}".format(c) for c in columns))
+    with tempfile.TemporaryDirectory() as workDir:
+        src = os.path.join(workDir, "src")
+        dst = os.path.join(workDir, "dst")
+        for size in sizes:
+            makeFile(src, size, args.text)
+            # small files are sent many times to get a stable number
+            repeat = max(1, min(200, (64 << 20) // max(size, 1)))
+            row = [size, repeat, "{0:.1f}".format(
+                transfer(src, dst, False, repeat)[0])]
+            row.append("{0:.1f}".format(transfer(src, dst, True, repeat)[0]))
+            for level in levels:
+                mbps, stream = transfer(src, dst, True, repeat, level)
+                # a file not worth compressing was sent raw
+                row.extend(["{0:.1f}".format(mbps),
+                            "-" if stream is None
+                            else "{0:.2f}".format(stream.ratio()),
+                            "-" if stream is None
+                            else "{0:.1f}".format(stream.cpu * 1000)])
+            print("".join("{0:>16}".format(c) for c in row))
+            os.remove(src)
+            os.remove(dst)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+from threading import Lock
+from functools import lru_cache
+
+import hashlib
+import json
+import os
+
+
+# sha256 of every chunkSize bytes of the file at path, in hex
+def readDigests(path, chunkSize):
+    digests = []
+    with open(path, "rb") as file:
+        while True:
+            h = hashlib.sha256()
+            left = chunkSize
+            while left > 0:
+                data = file.read(min(left, 1 << 20))
+                if not data:
+                    break
+                h.update(data)
+                left -= len(data)
+            if left == chunkSize and digests:
+                break
+            digests.append(h.hexdigest())
+            if left > 0:
+                break
+    return tuple(digests)
+
+
+# the same, remembered for the files served most
+# size and mtime tell the versions of a file apart,
+# so a file is only read again once it changed
+@lru_cache(maxsize=256)
+def chunkDigests(path, size, mtime, chunkSize):
+    return readDigests(path, chunkSize)
+
+
+# the digests of the file at path as it is now
+def fileDigests(path, chunkSize):
+    st = os.stat(path)
+    return chunkDigests(path, st.st_size, st.st_mtime_ns, chunkSize)
+
+
+# a file received in chunks, from several peers at once
+# every chunk is written at its offset into path.part and its index
+# appended to path.part.json once its hash matches the manifest, so that
+# an interrupted download resumes from the chunks it verified
+# the state file is a JSON line describing the file followed by a line
+# per verified chunk, a chunk costs a short append instead of a rewrite
+# of every digest
+# the finished file replaces path in one rename
+class partialFile(object):
+    def __init__(self, path, size, chunkSize, digests):
+        self.path = path
+        self.size = size
+        self.chunkSize = chunkSize
+        self.digests = list(digests)
+
+        self._partPath = path + ".part"
+        self._statePath = path + ".part.json"
+        self._lock = Lock()
+
+        # indices of the verified chunks
+        self._done = set()
+        # chunks which were already verified by an earlier download
+        self.resumed = 0
+        self._state = None
+
+        if self._loadState():
+            self._fd = os.open(self._partPath, os.O_RDWR)
+            self._recheck()
+        else:
+            self._fd = os.open(self._partPath,
+                               os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self._fd, size)
+        self.resumed = len(self._done)
+        self._saveState()
+
+    def __len__(self):
+        return len(self.digests)
+
+    # offset and length of chunk index
+    def span(self, index):
+        offset = index * self.chunkSize
+        return offset, min(self.chunkSize, self.size - offset)
+
+    # indices of the chunks still to be fetched
+    def missing(self):
+        with self._lock:
+            return [i for i in range(len(self.digests))
+                    if i not in self._done]
+
+    def complete(self):
+        with self._lock:
+            return len(self._done) == len(self.digests)
+
+    # write the data of chunk index if it matches the manifest
+    # returns False if it does not
+    def write(self, index, data):
+        if hashlib.sha256(data).hexdigest() != self.digests[index]:
+            return False
+        offset, length = self.span(index)
+        os.pwrite(self._fd, data, offset)
+        with self._lock:
+            self._done.add(index)
+            self._state.write("{}\n".format(index))
+            self._state.flush()
+        return True
+
+    # move the finished file into place
+    def commit(self):
+        os.fsync(self._fd)
+        self.close()
+        os.replace(self._partPath, self.path)
+        try:
+            os.remove(self._statePath)
+        except OSError:
+            pass
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self._state is not None:
+            self._state.close()
+            self._state = None
+
+    # drop the part file and its state, the download is not resumed
+    def discard(self):
+        self.close()
+        for path in (self._partPath, self._statePath):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # returns True if an earlier download of the same file was found
+    # a line cut short by a crash is ignored, its chunk is fetched again
+    def _loadState(self):
+        try:
+            with open(self._statePath, "r") as file:
+                state = json.loads(file.readline())
+                done = set(state.get("done", []))
+                for line in file:
+                    if line.endswith("\n"):
+                        done.add(int(line))
+        except (OSError, ValueError, AttributeError):
+            return False
+        if state.get("size") != self.size or \
+                state.get("chunk") != self.chunkSize or \
+                state.get("digests") != self.digests or \
+                not os.path.exists(self._partPath):
+            return False
+        self._done = set(i for i in done if 0 <= i < len(self.digests))
+        return True
+
+    # write the state of the chunks verified so far, and keep the file
+    # open to append the next ones
+    def _saveState(self):
+        tmpPath = self._statePath + ".tmp"
+        with open(tmpPath, "w") as file:
+            file.write(json.dumps({"size": self.size,
+                                   "chunk": self.chunkSize,
+                                   "digests": self.digests}) + "\n")
+            for index in sorted(self._done):
+                file.write("{}\n".format(index))
+        os.replace(tmpPath, self._statePath)
+        self._state = open(self._statePath, "a")
+
+    # keep only the chunks of an earlier download which made it to disk
+    def _recheck(self):
+        for index in list(self._done):
+            offset, length = self.span(index)
+            data = os.pread(self._fd, length, offset)
+            if hashlib.sha256(data).hexdigest() != self.digests[index]:
+                self._done.discard(index)
@@ -0,0 +1,166 @@
+from time import monotonic
+from threading import RLock
+from socket import socket, AF_INET, SOCK_STREAM, SHUT_RDWR, \
+    IPPROTO_TCP, TCP_NODELAY
+
+
+# a long-lived connection kept by connPool
+# requests and replies are small frames which must go out at once,
+# not wait for the ACK of the previous one
+class pooledConn(object):
+    def __init__(self, peer, sock):
+        self.peer = peer
+        self.sock = sock
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+
+        # messages from different threads must not interleave
+        self.lock = RLock()
+
+        # last time this connection sent or received something
+        self.lastUsed = monotonic()
+
+
+# a pool of long-lived connections, one per peer
+# every request to the same peer is multiplexed over a single
+# TCP connection instead of connecting once per request
+class connPool(object):
+    def __init__(self, addrOf, idleTimeout=60, onConnect=None):
+        # maps a peer ID to its (ip, port)
+        self._addrOf = addrOf
+
+        # connections unused for idleTimeout seconds are closed
+        self._idleTimeout = idleTimeout
+
+        # called with every new outgoing socket, so that the owner
+        # can read the requests the peer sends back on it
+        self._onConnect = onConnect
+
+        self._conns = dict()
+        self._lock = RLock()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.evictions = 0
+        self.adopted = 0
+        self.messages = 0
+        self.bytes = 0
+
+    # send data to peer over a pooled connection
+    # a broken connection is reopened once before giving up
+    def send(self, peer, data):
+        conn = self._acquire(peer)
+        try:
+            with conn.lock:
+                conn.sock.sendall(data)
+                conn.lastUsed = monotonic()
+        except OSError:
+            self._drop(conn)
+            with self._lock:
+                self.reconnects += 1
+            conn = self._acquire(peer)
+            with conn.lock:
+                conn.sock.sendall(data)
+                conn.lastUsed = monotonic()
+        with self._lock:
+            self.messages += 1
+            self.bytes += len(data)
+
+    # reuse an incoming connection from peer for requests to peer
+    # returns False if there is a connection to peer already
+    def adopt(self, peer, sock):
+        with self._lock:
+            if peer in self._conns:
+                return False
+            self._conns[peer] = pooledConn(peer, sock)
+            self.adopted += 1
+            return True
+
+    # mark the connection wrapping sock as used
+    def touch(self, sock):
+        with self._lock:
+            for conn in self._conns.values():
+                if conn.sock is sock:
+                    conn.lastUsed = monotonic()
+                    return
+
+    # forget the connection wrapping sock, the peer closed it
+    def discard(self, sock):
+        with self._lock:
+            for peer, conn in list(self._conns.items()):
+                if conn.sock is sock:
+                    del self._conns[peer]
+
+    # close every connection idle for too long
+    def evictIdle(self):
+        now = monotonic()
+        with self._lock:
+            idle = [c for c in self._conns.values()
+                    if now - c.lastUsed > self._idleTimeout]
+            for conn in idle:
+                self.evictions += 1
+                self._drop(conn)
+
+    # counters for the stats command
+    def stats(self):
+        with self._lock:
+            return {
+                "open": len(self._conns),
+                "hits": self.hits,
+                "misses": self.misses,
+                "reconnects": self.reconnects,
+                "evictions": self.evictions,
+                "adopted": self.adopted,
+                "messages": self.messages,
+                "bytes": self.bytes,
+            }
+
+    def close(self):
+        with self._lock:
+            for conn in list(self._conns.values()):
+                self._drop(conn, True)
+
+    # a peer which does not answer only holds up the requests to it,
+    # the connect happens outside the lock
+    # of two threads connecting to peer at once, the first one wins
+    def _acquire(self, peer):
+        with self._lock:
+            conn = self._conns.get(peer)
+            if conn is not None:
+                self.hits += 1
+                return conn
+            self.misses += 1
+
+        sock = socket(AF_INET, SOCK_STREAM)
+        try:
+            sock.connect(self._addrOf(peer))
+        except OSError:
+            sock.close()
+            raise
+
+        with self._lock:
+            conn = self._conns.get(peer)
+            if conn is not None:
+                sock.close()
+                return conn
+            conn = pooledConn(peer, sock)
+            self._conns[peer] = conn
+
+        if self._onConnect is not None:
+            self._onConnect(sock)
+        return conn
+
+    # a socket watched by the owner is only shut down,
+    # the owner closes it once it reads the end of stream
+    def _drop(self, conn, close=False):
+        with self._lock:
+            if self._conns.get(conn.peer) is conn:
+                del self._conns[conn.peer]
+        try:
+            if close or self._onConnect is None:
+                conn.sock.close()
+            else:
+                conn.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
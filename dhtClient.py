@@ -0,0 +1,444 @@
+from concurrent.futures import Future, as_completed, wait, FIRST_COMPLETED
+from threading import Thread, Lock
+from itertools import count
+from socket import socket, AF_UNIX, SOCK_STREAM, SHUT_RDWR
+
+import asyncio
+import json
+import sys
+import os
+
+from DHTNode import reqData, frameDecoder, controlPath, scanPageSize, \
+    joinNames, splitNames
+
+# result fields holding seconds, holding names joined by joinNames
+# and holding numbers joined with ","
+floatFields = {"seconds", "transferSeconds"}
+listFields = {"missing", "unanswered", "names"}
+intListFields = {"keys"}
+
+# exceptions a peer reports by name
+errorTypes = {"KeyError": KeyError, "ValueError": ValueError,
+              "TimeoutError": TimeoutError, "ConnectionError": ConnectionError,
+              "ConnectionRefusedError": ConnectionRefusedError,
+              "IOError": IOError, "OSError": OSError}
+
+
+# the dict a result request stands for, as DHTNode._submit returns it
+# raises the exception the peer reported instead
+def parseResult(req):
+    content = dict(req.getContent())
+    if "error" in content:
+        raise errorTypes.get(content["error"], RuntimeError)(
+            content.get("message", ""))
+    for k in floatFields & content.keys():
+        content[k] = float(content[k])
+    for k in listFields & content.keys():
+        content[k] = splitNames(content[k])
+    for k in intListFields & content.keys():
+        content[k] = [int(x) for x in content[k].split(",")] \
+            if content[k] else []
+    if "stats" in content:
+        return json.loads(content["stats"])
+    return content
+
+
+# the request a program sends for opr on names
+def submitRequest(opr, names, iterative):
+    content = {"kind": opr}
+    if isinstance(names, str):
+        content.update(filename=names, iterative=int(iterative))
+    else:
+        content.update(names=joinNames(names))
+    return content
+
+
+# the request a program sends for a page of the keys of peer
+def scanRequest(peer, lo, hi, limit, after):
+    content = {"lo": lo, "hi": hi, "limit": limit}
+    if peer is not None:
+        content["peer"] = peer
+    if after is not None:
+        content["after"] = after
+    return content
+
+
+# walk the ring from start, listing the keys of every peer page by page
+# page(peer, after) returns a concurrent.futures.Future of the page
+# following the name after, see DHTNode._scan
+# up to parallel peers are listed at once, the successor of a peer is
+# known from its first page, so only one page per peer is kept at a time
+# a peer which cannot be listed is skipped for the second successor of
+# the peer before it, and its error is raised once the others are done
+# yields a dict holding the name, its key and the peer keeping it
+def walkRing(page, start, parallel=1):
+    walk = ringWalk(start)
+    pages = dict()
+    while walk.ahead or pages:
+        while walk.ahead and len(pages) < parallel:
+            peer = walk.ahead.pop(0)
+            pages[page(peer, None)] = peer
+        done, notDone = wait(list(pages), return_when=FIRST_COMPLETED)
+        for future in done:
+            peer = pages.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                walk.fail(peer, e)
+                continue
+            after = walk.listed(peer, result)
+            if after is not None:
+                pages[page(peer, after)] = peer
+            for name, key in zip(result["names"], result["keys"]):
+                yield {"name": name, "key": key, "peer": peer}
+    walk.finish()
+
+
+# the peers a scan still has to list, in ring order
+class ringWalk(object):
+    def __init__(self, start):
+        self.ahead = [start]
+        self._seen = {start}
+
+        # peer -> the peer after it, if it cannot be listed
+        self._skip = dict()
+        self._errors = []
+
+    def _add(self, peer):
+        if peer not in self._seen:
+            self._seen.add(peer)
+            self.ahead.append(peer)
+
+    # a page of peer came back
+    # returns the name the next page of peer follows, None if it was
+    # the last one
+    def listed(self, peer, result):
+        self._skip.setdefault(result["next"], result["second"])
+        self._add(result["next"])
+        if result["more"] and result["names"]:
+            return result["names"][-1]
+        return None
+
+    def fail(self, peer, error):
+        self._errors.append(error)
+        if peer in self._skip:
+            self._add(self._skip[peer])
+
+    # raise the error of the first peer which could not be listed
+    def finish(self):
+        if self._errors:
+            raise self._errors[0]
+
+
+# a program's handle on a running peer, through its control socket
+# every call returns a concurrent.futures.Future at once, so that
+# many requests can be in flight from one client
+# a store or request resolves with the dict DHTNode._submit returns:
+# the peer which answered, the hops and the seconds it took
+#
+# with DHTClient(12) as client:
+#     client.store("1234").result()["peer"]
+class DHTClient(object):
+    def __init__(self, ID, dataDir=None, path=None):
+        self._sock = socket(AF_UNIX, SOCK_STREAM)
+        self._sock.connect(path or controlPath(
+            dataDir if dataDir is not None else os.getcwd(), ID))
+        self._nodeID = ID
+        self._stamps = count(1)
+        self._lock = Lock()
+
+        # stamp -> future of every request not answered yet
+        self._pending = dict()
+        self._reader = Thread(target=self._readLoop, name="client reader",
+                              daemon=True)
+        self._reader.start()
+
+    def store(self, filename, iterative=False):
+        return self._call("submit",
+                          submitRequest("store", filename, iterative))
+
+    def request(self, filename, iterative=False):
+        return self._call("submit",
+                          submitRequest("request", filename, iterative))
+
+    # resolves with the dict DHTNode._submitBatch returns
+    def storeBatch(self, names):
+        return self._call("submit", submitRequest("store", names, False))
+
+    def requestBatch(self, names):
+        return self._call("submit", submitRequest("request", names, False))
+
+    # resolves with a page of the keys peer keeps, ours if peer is None,
+    # see DHTNode._scan
+    def scanPage(self, peer=None, lo=0, hi=0, limit=scanPageSize,
+                 after=None):
+        return self._call("scan", scanRequest(peer, lo, hi, limit, after))
+
+    # every name the DHT keeps with a key in (lo, hi], lo == hi for all,
+    # yielded with its key and peer as the pages of parallel peers
+    # come back, starting with this peer and going round the ring
+    # a key moved to another peer during the scan may be listed twice,
+    # a peer which cannot be reached is skipped, see walkRing
+    def scan(self, lo=0, hi=0, pageSize=scanPageSize, parallel=1):
+        return walkRing(
+            lambda peer, after: self.scanPage(peer, lo, hi, pageSize, after),
+            self._nodeID, parallel)
+
+    # resolves with the dict DHTNode.stats returns
+    def stats(self):
+        return self._call("stats", {})
+
+    # the peer leaves the DHT gracefully
+    def quit(self):
+        return self._call("quit", {})
+
+    def close(self):
+        try:
+            self._sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self._reader.join()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _call(self, opr, content):
+        future = Future()
+        with self._lock:
+            stamp = next(self._stamps)
+            self._pending[stamp] = future
+            self._sock.sendall(reqData(opr, 0, self._nodeID, content,
+                                       stamp).toFrame())
+        return future
+
+    # resolve futures as their results arrive, in any order
+    # every future still waiting fails once the peer is gone
+    def _readLoop(self):
+        decoder = frameDecoder()
+        try:
+            while True:
+                data = self._sock.recv(65536)
+                if not data:
+                    break
+                decoder.feed(data)
+                req = decoder.next()
+                while req is not None:
+                    with self._lock:
+                        future = self._pending.pop(req.stamp, None)
+                    if future is not None:
+                        try:
+                            future.set_result(parseResult(req))
+                        except Exception as e:
+                            future.set_exception(e)
+                    req = decoder.next()
+        except (OSError, ValueError):
+            pass
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future in pending:
+            future.set_exception(ConnectionError("Peer closed the control"))
+
+
+# the same on an asyncio event loop, every call is a coroutine
+#
+# client = await asyncDHTClient.connect(12)
+# result = await client.request("1234")
+class asyncDHTClient(object):
+    def __init__(self, ID, reader, writer):
+        self._nodeID = ID
+        self._reader = reader
+        self._writer = writer
+        self._stamps = count(1)
+        self._pending = dict()
+        self._readTask = asyncio.ensure_future(self._readLoop())
+
+    @classmethod
+    async def connect(cls, ID, dataDir=None, path=None):
+        reader, writer = await asyncio.open_unix_connection(
+            path or controlPath(
+                dataDir if dataDir is not None else os.getcwd(), ID))
+        return cls(ID, reader, writer)
+
+    async def store(self, filename, iterative=False):
+        return await self._call("submit",
+                                submitRequest("store", filename, iterative))
+
+    async def request(self, filename, iterative=False):
+        return await self._call("submit",
+                                submitRequest("request", filename, iterative))
+
+    async def storeBatch(self, names):
+        return await self._call("submit", submitRequest("store", names, False))
+
+    async def requestBatch(self, names):
+        return await self._call("submit",
+                                submitRequest("request", names, False))
+
+    async def scanPage(self, peer=None, lo=0, hi=0, limit=scanPageSize,
+                       after=None):
+        return await self._call("scan",
+                                scanRequest(peer, lo, hi, limit, after))
+
+    # an asynchronous generator, see DHTClient.scan
+    #
+    # async for item in client.scan(parallel=4):
+    #     print(item["name"])
+    async def scan(self, lo=0, hi=0, pageSize=scanPageSize, parallel=1):
+        walk = ringWalk(self._nodeID)
+        pages = dict()
+        try:
+            while walk.ahead or pages:
+                while walk.ahead and len(pages) < parallel:
+                    peer = walk.ahead.pop(0)
+                    pages[asyncio.ensure_future(
+                        self.scanPage(peer, lo, hi, pageSize))] = peer
+                done, notDone = await asyncio.wait(
+                    list(pages), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    peer = pages.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        walk.fail(peer, e)
+                        continue
+                    after = walk.listed(peer, result)
+                    if after is not None:
+                        pages[asyncio.ensure_future(self.scanPage(
+                            peer, lo, hi, pageSize, after))] = peer
+                    for name, key in zip(result["names"], result["keys"]):
+                        yield {"name": name, "key": key, "peer": peer}
+            walk.finish()
+        finally:
+            # the program stopped reading early
+            for task in pages:
+                task.cancel()
+
+    async def stats(self):
+        return await self._call("stats", {})
+
+    async def quit(self):
+        return await self._call("quit", {})
+
+    async def close(self):
+        self._writer.close()
+        await self._readTask
+
+    async def _call(self, opr, content):
+        future = asyncio.get_running_loop().create_future()
+        stamp = next(self._stamps)
+        self._pending[stamp] = future
+        try:
+            self._writer.write(reqData(opr, 0, self._nodeID, content,
+                                       stamp).toFrame())
+            await self._writer.drain()
+            return await future
+        finally:
+            # a call cancelled by its program is not waited for
+            self._pending.pop(stamp, None)
+
+    async def _readLoop(self):
+        decoder = frameDecoder()
+        try:
+            while True:
+                data = await self._reader.read(65536)
+                if not data:
+                    break
+                decoder.feed(data)
+                req = decoder.next()
+                while req is not None:
+                    future = self._pending.pop(req.stamp, None)
+                    if future is not None and not future.done():
+                        try:
+                            future.set_result(parseResult(req))
+                        except Exception as e:
+                            future.set_exception(e)
+                    req = decoder.next()
+        except (OSError, ValueError):
+            pass
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(
+                    ConnectionError("Peer closed the control"))
+        self._pending.clear()
+
+
+# export every name the DHT keeps as JSON lines,
+# see DHTClient.scan for the arguments
+def export(client, lo, hi, pageSize, parallel, out=sys.stdout):
+    count = 0
+    for item in client.scan(lo, hi, pageSize, parallel):
+        out.write(json.dumps(item, sort_keys=True) + "\n")
+        count += 1
+    return count
+
+
+# python3 dhtClient.py <Peer ID> store|request [-i] <name> ...
+# python3 dhtClient.py <Peer ID> stats|quit
+# every name is submitted at once, results are printed as JSON lines
+# as they come back
+# python3 dhtClient.py <Peer ID> scan [LO:HI] [--page N] [--parallel N]
+# prints every name the DHT keeps with a key in (LO, HI] as a JSON line
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: python3 dhtClient.py <Peer ID> "
+              "store|request [-i] <name> ... | stats | quit | "
+              "scan [LO:HI] [--page N] [--parallel N]")
+        sys.exit(2)
+    ID, opr = int(sys.argv[1]), sys.argv[2].lower()
+    iterative = "-i" in sys.argv[3:]
+    names = [x for x in sys.argv[3:] if x != "-i"]
+
+    if opr == "scan":
+        pageSize, parallel = scanPageSize, 1
+        if "--page" in names:
+            i = names.index("--page")
+            pageSize = int(names[i + 1])
+            del names[i:i + 2]
+        if "--parallel" in names:
+            i = names.index("--parallel")
+            parallel = int(names[i + 1])
+            del names[i:i + 2]
+        lo, hi = (int(x) for x in names[0].split(":")) if names else (0, 0)
+        with DHTClient(ID) as client:
+            try:
+                export(client, lo, hi, pageSize, parallel)
+            except Exception as e:
+                print(json.dumps({"error": type(e).__name__,
+                                  "message": str(e.args[0]) if e.args
+                                  else ""}, sort_keys=True))
+                sys.exit(1)
+        sys.exit(0)
+
+    with DHTClient(ID) as client:
+        if opr in ("store", "request"):
+            call = client.store if opr == "store" else client.request
+            futures = dict((call(name, iterative), name) for name in names)
+        elif opr == "stats":
+            futures = {client.stats(): None}
+        elif opr == "quit":
+            futures = {client.quit(): None}
+        else:
+            print("Invalid command")
+            sys.exit(2)
+        failed = 0
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                result = {"error": type(e).__name__,
+                          "message": str(e.args[0]) if e.args else ""}
+            if name is not None:
+                result["filename"] = name
+            print(json.dumps(result, sort_keys=True))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+from statistics import NormalDist
+from collections import deque
+from heapq import heappush, heappop
+from threading import RLock
+from time import monotonic
+
+import math
+
+
+# phi accrual failure detector for the peers pinging us
+# the gaps between the pings of every peer are kept in a window,
+# phi of a peer is how unlikely it is that its next ping is still
+# on the way after it has been silent for a while
+# a peer is suspected once phi exceeds threshold, so a peer pinging
+# like clockwork is suspected soon and a jittery one is given time
+# the moment every peer crosses the threshold is kept in a heap,
+# so a silent peer is found on time without looking at every peer
+class failureDetector(object):
+    def __init__(self, interval, threshold=8.0, window=64,
+                 acceptablePause=None, maxSilence=None):
+        self._interval = interval
+        self._threshold = threshold
+        self._window = window
+
+        # a late ping is only suspicious after this pause
+        self._pause = interval if acceptablePause is None \
+            else acceptablePause
+        # a peer is never given longer than the old fixed timeout
+        self._maxSilence = 15 + 2 * interval if maxSilence is None \
+            else maxSilence
+        self._minStd = max(0.05, interval / 4)
+
+        # how many standard deviations past the mean gap phi
+        # reaches threshold
+        self._z = NormalDist().inv_cdf(1 - 10 ** -threshold)
+
+        # peer -> [last ping, gaps, deadline]
+        self._peers = dict()
+        # (deadline, peer), entries of forgotten or
+        # newer deadlines are skipped when they come up
+        self._heap = []
+
+        self._lock = RLock()
+
+        # counters
+        self.suspected = 0
+        self.pings = 0
+
+    def __contains__(self, peer):
+        return peer in self._peers
+
+    def __len__(self):
+        return len(self._peers)
+
+    def peers(self):
+        with self._lock:
+            return list(self._peers.keys())
+
+    # peer pinged us at now
+    def heartbeat(self, peer, now=None):
+        now = monotonic() if now is None else now
+        with self._lock:
+            self.pings += 1
+            entry = self._peers.get(peer)
+            if entry is None:
+                entry = [now, deque(maxlen=self._window), None]
+                self._peers[peer] = entry
+            else:
+                entry[1].append(now - entry[0])
+                entry[0] = now
+            entry[2] = now + self._silence(entry[1])
+            heappush(self._heap, (entry[2], peer))
+
+    # stop watching peer
+    def remove(self, peer):
+        with self._lock:
+            self._peers.pop(peer, None)
+
+    def clear(self):
+        with self._lock:
+            self._peers.clear()
+            self._heap = []
+
+    # the suspicion level of peer, 0 for a peer we do not watch
+    def phi(self, peer, now=None):
+        now = monotonic() if now is None else now
+        with self._lock:
+            entry = self._peers.get(peer)
+            if entry is None:
+                return 0.0
+            mean, std = self._estimate(entry[1])
+            left = 1 - NormalDist(mean + self._pause, std).cdf(now - entry[0])
+            return math.inf if left <= 0 else -math.log10(left)
+
+    # when the next peer will be suspected, None if nobody is watched
+    def nextDeadline(self):
+        with self._lock:
+            self._skipStale()
+            return self._heap[0][0] if self._heap else None
+
+    # the peers suspected at now, they are not watched any more
+    def expired(self, now=None):
+        now = monotonic() if now is None else now
+        found = []
+        with self._lock:
+            self._skipStale()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, peer = heappop(self._heap)
+                del self._peers[peer]
+                found.append(peer)
+                self._skipStale()
+            self.suspected += len(found)
+        return found
+
+    # counters for the stats command
+    def stats(self):
+        now = monotonic()
+        with self._lock:
+            return {
+                "watched": ", ".join(
+                    "{0} (phi {1:.2f})".format(peer, self.phi(peer, now))
+                    for peer in sorted(self._peers)),
+                "pings": self.pings,
+                "suspected": self.suspected,
+            }
+
+    # mean and standard deviation of the gaps
+    # until there are a few gaps the ping interval stands in
+    def _estimate(self, gaps):
+        if len(gaps) < 2:
+            return self._interval, self._interval / 2
+        mean = sum(gaps) / len(gaps)
+        var = sum((g - mean) ** 2 for g in gaps) / (len(gaps) - 1)
+        return mean, max(math.sqrt(var), self._minStd)
+
+    # how long a peer may be silent before phi reaches threshold
+    def _silence(self, gaps):
+        mean, std = self._estimate(gaps)
+        return min(mean + self._pause + self._z * std, self._maxSilence)
+
+    def _skipStale(self):
+        while self._heap:
+            deadline, peer = self._heap[0]
+            entry = self._peers.get(peer)
+            if entry is not None and entry[2] == deadline:
+                return
+            heappop(self._heap)
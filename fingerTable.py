@@ -0,0 +1,101 @@
+from threading import RLock
+
+import keySpace
+
+
+# is x inside the open interval (a, b) on the ring
+# (a, a) stands for the whole ring except a itself
+def between(x, a, b):
+    if a < b:
+        return a < x < b
+    if a > b:
+        return x > a or x < b
+    return x != a
+
+
+# is x inside the half-open interval (a, b] on the ring
+def betweenRight(x, a, b):
+    return x == b or between(x, a, b)
+
+
+# does nodeID own key when a lookup for key came from src
+# src is the peer which forwarded the lookup to nodeID,
+# lookups never jump over the owner so src always precedes key
+def ownsKey(key, src, nodeID):
+    if src == nodeID:
+        return key == nodeID
+    return key == src or betweenRight(key, src, nodeID)
+
+
+# a Chord-style finger table
+# the i-th finger is the first peer that succeeds (nodeID + 2 ** i)
+class fingerTable(object):
+    def __init__(self, nodeID, bits=None):
+        if bits is None:
+            bits = keySpace.ringBits
+        self._nodeID = nodeID
+        self._bits = bits
+        self._size = 1 << bits
+
+        # peer ID of every finger, None if unknown
+        self._entries = [None] * bits
+
+        # fingers are written by the consumer and read by every lookup
+        self._lock = RLock()
+
+    def __len__(self):
+        return self._bits
+
+    # the identifier the i-th finger should succeed
+    def start(self, i):
+        return (self._nodeID + (1 << i)) % self._size
+
+    def get(self, i):
+        with self._lock:
+            return self._entries[i]
+
+    def update(self, i, nodeID):
+        with self._lock:
+            self._entries[i] = nodeID
+
+    # forget every finger pointing to a peer which is gone
+    def remove(self, nodeID):
+        with self._lock:
+            for i, f in enumerate(self._entries):
+                if f == nodeID:
+                    self._entries[i] = None
+
+    # the farthest known peer strictly between this node and key,
+    # which never overshoots the owner of key
+    def closestPreceding(self, key):
+        with self._lock:
+            for f in reversed(self._entries):
+                if f is not None and f != self._nodeID and \
+                        between(f, self._nodeID, key):
+                    return f
+        return None
+
+    # every finger in slot order, None where unknown
+    def entries(self):
+        with self._lock:
+            return list(self._entries)
+
+    # fingers saved by entries(), ignored if the ring is of another size
+    def restore(self, entries):
+        with self._lock:
+            if len(entries) == self._bits:
+                self._entries = list(entries)
+
+    # distinct peers in the table, nearest first
+    def nodes(self):
+        with self._lock:
+            seen = []
+            for f in self._entries:
+                if f is not None and f not in seen:
+                    seen.append(f)
+            return seen
+
+    def __str__(self):
+        with self._lock:
+            return ", ".join("{0}: {1}".format(self.start(i), f)
+                             for i, f in enumerate(self._entries))
@@ -0,0 +1,625 @@
+from concurrent.futures import Future, wait as waitFutures, FIRST_COMPLETED
+from threading import Thread
+from time import sleep, monotonic
+from random import Random
+
+import tempfile
+import asyncio
+import sys
+import os
+
+import DHTNode
+import keySpace
+from dhtClient import DHTClient, walkRing
+
+
+# a ring of peers running inside this process
+# threaded peers are DHTNode instances, async peers share
+# one event loop running in a thread of its own
+# every peer listens on basePort + ID + 1 and serves files from dataDir
+# the workload reaches the peers the way programs do, through a
+# DHTClient on their control sockets
+class ringHarness(object):
+    def __init__(self, *, engine="thread", basePort=20000, pingInterval=2,
+                 dataDir=None, log=None, **nodeArgs):
+        if engine not in ("thread", "async"):
+            raise ValueError("Unknown engine {0}".format(engine))
+        self._engine = engine
+        self._pingInterval = pingInterval
+        # nobody reads the pings of a whole ring
+        self._nodeArgs = dict(nodeArgs)
+        self._nodeArgs.setdefault("verbose", False)
+        self._nodeArgs["control"] = True
+
+        # every port is derived from DHTNode.basePort
+        DHTNode.basePort = basePort
+        DHTNode.checkRing()
+
+        self.dataDir = dataDir if dataDir is not None else \
+            tempfile.mkdtemp(prefix="dht")
+
+        # ID -> peer, and the peers which are gone
+        self._nodes = dict()
+        self._gone = []
+
+        # ID -> future of asyncDHTNode.serve
+        self._serving = dict()
+
+        # ID -> client connected to the control socket of the peer,
+        # made the first time the workload goes through it
+        self._clients = dict()
+
+        # the peers print a lot, it goes to log
+        self._stdout = sys.stdout
+        sys.stdout = open(log if log is not None else os.devnull, "w")
+
+        self._loop = None
+        if engine == "async":
+            self._loop = asyncio.new_event_loop()
+            Thread(target=self._loop.run_forever, name="harness loop",
+                   daemon=True).start()
+
+    def ids(self):
+        return sorted(self._nodes.keys())
+
+    def __len__(self):
+        return len(self._nodes)
+
+    # start a ring of the peers in ids
+    # returns once every peer was pinged by its predecessor,
+    # a join reaching a peer before that cannot be placed
+    def start(self, ids, timeout=30):
+        ids = sorted(ids)
+        for i, ID in enumerate(ids):
+            self._start(ID, "init", fst=ids[(i + 1) % len(ids)],
+                        snd=ids[(i + 2) % len(ids)])
+        return self.settle(timeout)
+
+    # wait until every peer knows its predecessor
+    # returns False if some peer does not after timeout seconds
+    def settle(self, timeout=30):
+        deadline = monotonic() + timeout
+        while monotonic() < deadline:
+            if all(n._predecessor() is not None
+                   for n in list(self._nodes.values())):
+                return True
+            sleep(0.1)
+        return False
+
+    # join ID through knownNode
+    # returns False if the join did not finish within timeout seconds
+    def join(self, ID, knownNode, timeout=30):
+        return self._start(ID, "join", timeout, knownNode=knownNode)
+
+    # start ID again from the snapshot it left in the data directory,
+    # joining through knownNode if its place is taken
+    # returns False if the restart did not finish within timeout seconds
+    def restart(self, ID, knownNode=None, timeout=30):
+        return self._start(ID, "restart", timeout, knownNode=knownNode)
+
+    # join every ID at once, each through its own known node
+    # returns the IDs which joined within timeout seconds
+    def joinMany(self, joins, timeout=30):
+        joined = []
+
+        def joinOne(ID, knownNode):
+            if self.join(ID, knownNode, timeout):
+                joined.append(ID)
+
+        threads = []
+        for ID, knownNode in joins:
+            thread = Thread(target=joinOne, args=(ID, knownNode),
+                            daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return sorted(joined)
+
+    # does every peer have the successors and the predecessor
+    # the sorted IDs say it should
+    def converged(self):
+        ids = self.ids()
+        for i, ID in enumerate(ids):
+            node = self._nodes[ID]
+            if node._firstID != ids[(i + 1) % len(ids)] or \
+                    node._secondID != ids[(i + 2) % len(ids)] or \
+                    node._predecessor() != ids[i - 1]:
+                return False
+        return True
+
+    # wait until the ring converged
+    # returns the seconds it took, None if it did not after timeout
+    def converge(self, timeout=60):
+        begin = monotonic()
+        while not self.converged():
+            if monotonic() - begin > timeout:
+                return None
+            sleep(0.05)
+        return monotonic() - begin
+
+    # leave gracefully
+    # returns False if the peer did not stop within timeout seconds
+    def quit(self, ID, timeout=30):
+        self._dropClient(ID)
+        node = self._nodes.pop(ID)
+        self._gone.append(node)
+        if self._engine == "thread":
+            node.quit()
+            if node.wait(timeout):
+                return True
+            node.halt()
+            return False
+        self._call(node.quit())
+        try:
+            self._serving.pop(ID).result(timeout)
+            return True
+        except Exception:
+            self._call(node.close())
+            return False
+
+    # stop ID without telling anybody
+    def kill(self, ID):
+        self._dropClient(ID)
+        node = self._nodes.pop(ID)
+        self._gone.append(node)
+        if self._engine == "thread":
+            node.halt()
+            node.wait(10)
+        else:
+            self._call(node.close())
+            self._serving.pop(ID, None)
+
+    # store or request filename through peer ID
+    # returns a concurrent.futures.Future, see DHTClient.store
+    def submit(self, ID, opr, filename, iterative=False):
+        return self._through(ID, lambda client: getattr(client, opr)(
+            filename, iterative))
+
+    # store or request every name in names through peer ID in batches
+    # returns a concurrent.futures.Future, see DHTClient.storeBatch
+    def submitBatch(self, ID, opr, names):
+        return self._through(ID, lambda client: getattr(
+            client, opr + "Batch")(names))
+
+    # list a page of the keys of peer, through peer ID
+    # returns a concurrent.futures.Future, see DHTClient.scanPage
+    def scan(self, ID, peer=None, lo=0, hi=0, limit=DHTNode.scanPageSize,
+             after=None):
+        return self._through(ID, lambda client: client.scanPage(
+            peer, lo, hi, limit, after))
+
+    # write a file of size bytes named name into the data directory
+    # text files are random numbers like the ones run.sh writes,
+    # which compress, other files are random bytes, which do not
+    def makeFile(self, name, size, text=False):
+        path = os.path.join(self.dataDir, name + ".txt")
+        with open(path, "wb") as file:
+            file.write(numberText(size) if text else os.urandom(size))
+        return path
+
+    # requests sent over pooled connections by every peer so far,
+    # plus the next hop queries of iterative lookups and the pages of
+    # scans, without the stabilization every peer keeps up in the
+    # background
+    def messages(self):
+        nodes = list(self._nodes.values()) + self._gone
+        counters = [n._stats.toDict()["counters"] for n in nodes]
+        return sum(self._counters(n)["messages"] for n in nodes) + \
+            sum(c.get("hopQueries", 0) + c.get("scanPages", 0)
+                for c in counters) - \
+            sum(c.get("stabilizeMessages", 0) for c in counters)
+
+    # requests refused with a busy reply by every peer so far
+    def rejections(self):
+        nodes = list(self._nodes.values()) + self._gone
+        return sum(v for n in nodes
+                   for k, v in n._stats.toDict()["counters"].items()
+                   if k.startswith("rejected"))
+
+    def close(self):
+        for ID in list(self._clients.keys()):
+            self._dropClient(ID)
+        for ID in list(self._nodes.keys()):
+            try:
+                self.kill(ID)
+            except Exception:
+                pass
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        sys.stdout.close()
+        sys.stdout = self._stdout
+
+    # call fn with the client of peer ID
+    # a control socket which cannot be reached fails the future
+    def _through(self, ID, fn):
+        try:
+            if ID not in self._clients:
+                self._clients[ID] = DHTClient(ID, self.dataDir)
+            return fn(self._clients[ID])
+        except OSError as e:
+            self._dropClient(ID)
+            future = Future()
+            future.set_exception(e)
+            return future
+
+    def _dropClient(self, ID):
+        client = self._clients.pop(ID, None)
+        if client is not None:
+            client.close()
+
+    def _start(self, ID, startType, timeout=30, **kwargs):
+        self._dropClient(ID)
+        if self._engine == "thread":
+            node = DHTNode.DHTNode(ID, self._pingInterval,
+                                   dataDir=self.dataDir, interactive=False,
+                                   **self._nodeArgs)
+            failed = []
+
+            def startNode():
+                try:
+                    node.start(startType, **kwargs)
+                except Exception as e:
+                    failed.append(e)
+
+            starter = Thread(target=startNode, daemon=True)
+            starter.start()
+            starter.join(timeout)
+            # a peer still starting would keep its listener and
+            # consumer running, and the process with them
+            if starter.is_alive() or failed:
+                node.halt()
+                node.wait(10)
+                return False
+        else:
+            from asyncNode import asyncDHTNode
+            node = asyncDHTNode(ID, self._pingInterval, interactive=False,
+                                dataDir=self.dataDir, **self._nodeArgs)
+            starting = asyncio.run_coroutine_threadsafe(
+                node.start(startType, **kwargs), self._loop)
+            try:
+                starting.result(timeout)
+            except Exception:
+                # a cancelled start closes what it opened
+                starting.cancel()
+                return False
+            self._serving[ID] = asyncio.run_coroutine_threadsafe(
+                node.serve(), self._loop)
+        self._nodes[ID] = node
+        return True
+
+    def _call(self, coro, timeout=30):
+        return asyncio.run_coroutine_threadsafe(
+            coro, self._loop).result(timeout)
+
+    def _counters(self, node):
+        if self._engine == "thread":
+            return node._pool.stats()
+        return node.poolStats()
+
+
+# size bytes of random numbers between 1 and 10000000, a few per line
+def numberText(size):
+    rand = Random(size)
+    lines = []
+    length = 0
+    while length < size:
+        line = " ".join(str(rand.randint(1, 10000000)) for i in range(3))
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines).encode('utf-8')[:size]
+
+
+# sizes such as 512, 4K, 20M or 1G in bytes
+units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parseSize(sz):
+    if sz[-1].upper() in units:
+        return int(sz[:-1]) * units[sz[-1].upper()]
+    return int(sz)
+
+
+# the p-th percentile of sorted values
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    i = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[i]
+
+
+# what happened during one step of a workload
+class stepReport(object):
+    def __init__(self, step):
+        self.step = step
+        self.ok = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.latencies = []
+        self.hops = []
+        self.bytes = 0
+        self.transferSeconds = 0.0
+        self.messages = 0
+        self.rejected = 0
+        self.seconds = 0.0
+
+        # seconds until the ring converged after parallel joins
+        self.convergeSeconds = 0.0
+
+        # names stored or requested, a batch has many
+        self.keys = 0
+
+    def record(self, result):
+        self.ok += 1
+        self.latencies.append(result["seconds"])
+        if "hops" in result:
+            self.hops.append(result["hops"])
+        self.bytes += result.get("size", 0)
+        self.transferSeconds += result.get("transferSeconds", 0.0)
+
+    def toDict(self):
+        ops = self.ok + self.failed + self.timeouts
+        latencies = sorted(self.latencies)
+        return {
+            "step": self.step,
+            "ops": ops,
+            "ok": self.ok,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "convergeSeconds": round(self.convergeSeconds, 3),
+            "seconds": round(self.seconds, 3),
+            "opsPerSecond": round(ops / self.seconds, 1)
+            if self.seconds > 0 else 0.0,
+            "p50Ms": round(percentile(latencies, 50) * 1000, 2),
+            "p90Ms": round(percentile(latencies, 90) * 1000, 2),
+            "p99Ms": round(percentile(latencies, 99) * 1000, 2),
+            "maxMs": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            "meanHops": round(sum(self.hops) / len(self.hops), 2)
+            if self.hops else 0.0,
+            "maxHops": max(self.hops) if self.hops else 0,
+            "messagesPerOp": round(self.messages / ops, 2) if ops else 0.0,
+            "messagesPerKey": round(self.messages / self.keys, 2)
+            if self.keys else 0.0,
+            "transferMBps": round(self.bytes / self.transferSeconds / 1e6, 2)
+            if self.transferSeconds > 0 else 0.0,
+        }
+
+
+# drive a harness through a workload
+# steps are "opr:count" strings run one after the other:
+#   store:N    store N new files
+#   request:N  request N stored files, skew > 0 makes a few files hot
+#   storeBatch:N, requestBatch:N
+#              the same in batches of batchSize names, one operation
+#              per batch
+#   storeIterative:N, requestIterative:N
+#              the same with the requester looking up every owner
+#              itself, see DHTNode._submit
+#   join:N     join N new peers
+#   joinParallel:N
+#              join N new peers at once, the step ends once the ring
+#              converged
+#   quit:N     N peers leave gracefully
+#   kill:N     N peers stop without telling anybody
+#   restart:N  N peers are killed and restarted from their snapshot
+#              one after the other
+#   scan:N     list every key of the ring from one peer, N names per
+#              page and up to concurrency peers at once, one operation
+#              per page, a stored name the scan did not list failed
+#   sleep:S    wait S seconds
+# stores and requests keep up to concurrency operations in flight,
+# each failing after timeout seconds, and the ring may take
+# convergeTimeout seconds to converge after a joinParallel step
+class workload(object):
+    def __init__(self, harness, *, concurrency=16, timeout=10,
+                 fileSize=1024, skew=0.0, seed=9331, batchSize=100,
+                 text=False, convergeTimeout=60):
+        self._harness = harness
+        self._batchSize = batchSize
+        self._concurrency = concurrency
+        self._timeout = timeout
+        self._convergeTimeout = convergeTimeout
+        self._fileSize = fileSize
+        self._text = text
+        self._skew = skew
+        self._rand = Random(seed)
+
+        # names of the files stored so far
+        self.stored = []
+        self._unused = list(range(10000))
+        self._rand.shuffle(self._unused)
+
+    def run(self, steps):
+        return [self.runStep(step) for step in steps]
+
+    def runStep(self, step):
+        opr, arg = step.split(":")
+        report = stepReport(step)
+        messages = self._harness.messages()
+        rejected = self._harness.rejections()
+        begin = monotonic()
+        if opr == "store":
+            names = [self._newName() for i in range(int(arg))]
+            for name in names:
+                self._harness.makeFile(name, self._fileSize, self._text)
+            self._drive("store", names, report)
+        elif opr == "request":
+            self._drive("request", self._pick(int(arg)), report)
+        elif opr == "storeBatch":
+            names = [self._newName() for i in range(int(arg))]
+            for name in names:
+                self._harness.makeFile(name, self._fileSize, self._text)
+            self._drive("store", self._batches(names), report)
+        elif opr == "requestBatch":
+            self._drive("request", self._batches(self._pick(int(arg))),
+                        report)
+        elif opr == "storeIterative":
+            names = [self._newName() for i in range(int(arg))]
+            for name in names:
+                self._harness.makeFile(name, self._fileSize, self._text)
+            self._drive("store", names, report, iterative=True)
+        elif opr == "requestIterative":
+            self._drive("request", self._pick(int(arg)), report,
+                        iterative=True)
+        elif opr == "join":
+            for i in range(int(arg)):
+                self._membership(report, self._join)
+                self._harness.settle()
+        elif opr == "joinParallel":
+            self._joinParallel(int(arg), report, self._convergeTimeout)
+        elif opr == "quit":
+            for i in range(int(arg)):
+                self._membership(report, self._quit)
+        elif opr == "kill":
+            for i in range(int(arg)):
+                self._membership(report, self._kill)
+        elif opr == "restart":
+            for i in range(int(arg)):
+                self._membership(report, self._restart)
+        elif opr == "scan":
+            self._scan(int(arg), report)
+        elif opr == "sleep":
+            sleep(float(arg))
+        else:
+            raise ValueError("Unknown step {0}".format(step))
+        report.seconds = monotonic() - begin
+        report.messages = self._harness.messages() - messages
+        report.rejected = self._harness.rejections() - rejected
+        return report
+
+    # submit opr for every name, or every batch of names,
+    # at most concurrency at once
+    def _drive(self, opr, names, report, iterative=False):
+        pending = dict()
+        names = list(names)
+        while names or pending:
+            while names and len(pending) < self._concurrency:
+                name = names.pop()
+                ID = self._rand.choice(self._harness.ids())
+                if isinstance(name, list):
+                    future = self._harness.submitBatch(ID, opr, name)
+                    report.keys += len(name)
+                else:
+                    future = self._harness.submit(ID, opr, name, iterative)
+                    report.keys += 1
+                pending[future] = (name, monotonic())
+
+            done, notDone = waitFutures(list(pending.keys()), timeout=0.1,
+                                        return_when=FIRST_COMPLETED)
+            for future in done:
+                name, submitted = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    report.failed += 1
+                    continue
+                if isinstance(name, list):
+                    # a batch fails if one of its names did
+                    lost = set(result["missing"]) | set(result["unanswered"])
+                    if opr == "store":
+                        self.stored.extend(x for x in name if x not in lost)
+                    if lost:
+                        report.failed += 1
+                        continue
+                elif opr == "store":
+                    self.stored.append(name)
+                report.record(result)
+
+            now = monotonic()
+            for future, (name, submitted) in list(pending.items()):
+                if now - submitted > self._timeout:
+                    del pending[future]
+                    future.cancel()
+                    report.timeouts += 1
+
+    # time a membership change, fn returns False if it failed
+    def _membership(self, report, fn):
+        begin = monotonic()
+        if fn():
+            report.record({"seconds": monotonic() - begin})
+        else:
+            report.failed += 1
+
+    def _join(self, timeout=30):
+        ids = self._harness.ids()
+        free = [x for x in range(keySpace.ringSize) if x not in ids]
+        ID = self._rand.choice(free)
+        return self._harness.join(ID, self._rand.choice(ids), timeout)
+
+    # every join is one operation, taking as long as the ring took
+    # to converge after all of them were sent
+    def _joinParallel(self, count, report, timeout=60):
+        ids = self._harness.ids()
+        free = [x for x in range(keySpace.ringSize) if x not in ids]
+        joins = [(ID, self._rand.choice(ids))
+                 for ID in self._rand.sample(free, count)]
+        begin = monotonic()
+        joined = self._harness.joinMany(joins, timeout)
+        report.failed += count - len(joined)
+        seconds = self._harness.converge(timeout)
+        if seconds is None:
+            report.timeouts += len(joined)
+            return
+        report.convergeSeconds = monotonic() - begin
+        for ID in joined:
+            report.record({"seconds": report.convergeSeconds})
+
+    def _scan(self, pageSize, report):
+        ID = self._rand.choice(self._harness.ids())
+
+        def page(peer, after):
+            begin = monotonic()
+            future = self._harness.scan(ID, peer, limit=pageSize,
+                                        after=after)
+            future.add_done_callback(
+                lambda f: f.cancelled() or f.exception() is not None or
+                report.record({"seconds": monotonic() - begin}))
+            return future
+
+        listed = set()
+        try:
+            for item in walkRing(page, ID, self._concurrency):
+                listed.add(item["name"])
+                report.keys += 1
+        except Exception:
+            report.failed += 1
+        report.failed += len(set(self.stored) - listed)
+
+    # the last three peers always stay
+    def _quit(self):
+        ids = self._harness.ids()
+        if len(ids) <= 3:
+            return False
+        return self._harness.quit(self._rand.choice(ids))
+
+    def _kill(self):
+        ids = self._harness.ids()
+        if len(ids) <= 3:
+            return False
+        self._harness.kill(self._rand.choice(ids))
+        return True
+
+    # a restart takes as long as the new process needs to be in the ring
+    def _restart(self):
+        ID = self._rand.choice(self._harness.ids())
+        self._harness.kill(ID)
+        return self._harness.restart(ID)
+
+    # names split into lists of at most batchSize names
+    def _batches(self, names):
+        return [names[i:i + self._batchSize]
+                for i in range(0, len(names), self._batchSize)]
+
+    def _newName(self):
+        return "{0:04d}".format(self._unused.pop())
+
+    # count stored names, the i-th most popular with weight 1 / i ** skew
+    def _pick(self, count):
+        if len(self.stored) == 0:
+            return []
+        if self._skew <= 0:
+            return [self._rand.choice(self.stored) for i in range(count)]
+        weights = [1.0 / (i + 1) ** self._skew
+                   for i in range(len(self.stored))]
+        return self._rand.choices(self.stored, weights, k=count)
@@ -0,0 +1,86 @@
+from fingerTable import betweenRight
+from keySpace import distance
+
+
+# the state of a lookup driven by the requesting peer
+# instead of forwarding the request, the requester asks peers for their
+# best next hop and contacts the next peer itself, parallel peers
+# at a time, so a slow or dead peer costs one hop timeout and not the
+# whole request
+# candidates are tried closest to the key first, and only if they are
+# closer than every peer which answered, so a lookup never walks back
+# the second successor of a peer stands in for a first one which did
+# not answer
+class iterativeLookup(object):
+    def __init__(self, key, candidates, parallel=2, maxRounds=32):
+        self.key = key
+        self._parallel = max(1, parallel)
+        self._maxRounds = maxRounds
+
+        self._candidates = set(candidates)
+        self._queried = set()
+        self.failed = set()
+
+        # peer -> content of its answer
+        self._answers = dict()
+
+        # rounds of queries sent so far
+        self.rounds = 0
+
+        # the peer owning key once a peer named it,
+        # and the successor standing in for it
+        self.owner = None
+        self.backup = None
+
+    # the next peers to ask, an empty list once the lookup is over
+    def next(self):
+        if self.owner is not None or self.rounds >= self._maxRounds:
+            return []
+        peers = sorted(self._candidates - self._queried - self.failed,
+                       key=lambda p: distance(p, self.key))
+        if self._answers:
+            best = min(distance(p, self.key) for p in self._answers)
+            peers = [p for p in peers if distance(p, self.key) < best]
+        peers = peers[:self._parallel]
+        if peers:
+            self._queried.update(peers)
+            self.rounds += 1
+        return peers
+
+    # peer did not answer in time
+    def fail(self, peer):
+        self.failed.add(peer)
+        for answered in list(self._answers):
+            self._skipFailed(answered)
+
+    # the content of a hopped reply from peer
+    def answer(self, peer, content):
+        self._answers[peer] = content
+        if "owner" in content:
+            # the answer closest to the key wins if several peers knew
+            owner = int(content["owner"])
+            if self.owner is None or \
+                    distance(self.key, owner) < distance(self.key, self.owner):
+                self.owner = owner
+                self.backup = int(content["backup"])
+            return
+        for field in ("next", "_firstID", "_secondID"):
+            if field in content:
+                self._candidates.add(int(content[field]))
+        self._skipFailed(peer)
+
+    # the key falls between peer and its second successor and the first
+    # one is gone, so the second one owns it now
+    def _skipFailed(self, peer):
+        content = self._answers[peer]
+        first, second = int(content["_firstID"]), int(content["_secondID"])
+        if self.owner is None and first in self.failed and \
+                betweenRight(self.key, peer, second):
+            self.owner = second
+            self.backup = None
+
+    # the peer to send the request to if the owner is unreachable
+    def fallback(self):
+        if self.backup is not None and self.backup != self.owner:
+            return self.backup
+        return None
@@ -0,0 +1,83 @@
+from hashlib import blake2b
+
+# the identifier ring has 2 ** ringBits positions
+# 8 bits match the "% 256" of the assignment, a wider ring needs
+# every peer of the DHT to be started with the same width
+ringBits = 8
+ringSize = 1 << ringBits
+
+# peers listen on a port derived from their ID,
+# so the ring is never wider than the ports allow
+maxRingBits = 15
+
+# "digits" - the names 0 to 9999 of the assignment, key is name % ringSize
+def digitsKey(name):
+    try:
+        digit = int(name)
+    except ValueError:
+        return None
+    if digit < 0 or digit > 9999:
+        return None
+    return digit % ringSize
+
+
+# "blake2b" - any name which is not empty, key is the top ringBits bits
+# of a 64-bit blake2b digest of its UTF-8 bytes, spread evenly whatever
+# the names look like
+def blake2bKey(name):
+    if not name:
+        return None
+    return hash64(name) >> (64 - ringBits)
+
+
+def hash64(text):
+    return int.from_bytes(blake2b(text.encode('utf-8'),
+                                  digest_size=8).digest(), "big")
+
+
+hashFunctions = {"digits": digitsKey, "blake2b": blake2bKey}
+hashName = "digits"
+
+
+# change the ring width or the hash of names for this process
+def configure(bits=None, hashing=None):
+    global ringBits, ringSize, hashName
+    if bits is not None:
+        if not 1 <= bits <= maxRingBits:
+            raise ValueError("Ring bits must be between 1 and {0}".format(
+                maxRingBits))
+        ringBits = bits
+        ringSize = 1 << bits
+    if hashing is not None:
+        if hashing not in hashFunctions:
+            raise ValueError("Unknown hash {0}".format(hashing))
+        hashName = hashing
+
+
+# the key of name on the ring, None if name is not valid
+def toKey(name):
+    return hashFunctions[hashName](name)
+
+
+# how far b is after a on the ring
+def distance(a, b):
+    return (b - a) % ringSize
+
+
+# the peer in peers which owns key, the first one at or after it
+def successor(key, peers):
+    return min(peers, key=lambda p: distance(key, p))
+
+
+# the ring positions of a peer hosting count virtual nodes
+# the first one is nodeID itself, the others are spread over the ring
+# by hashing "nodeID#i", positions in taken are skipped
+def virtualIDs(nodeID, count, taken=()):
+    ids = [] if nodeID in taken else [nodeID]
+    i = 1
+    while len(ids) < count and i < 64 * count:
+        vID = hash64("{0}#{1}".format(nodeID, i)) >> (64 - ringBits)
+        if vID not in ids and vID not in taken:
+            ids.append(vID)
+        i += 1
+    return ids
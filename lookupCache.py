@@ -0,0 +1,128 @@
+from time import monotonic
+from threading import RLock
+from collections import OrderedDict
+from bisect import bisect_left, insort
+
+from fingerTable import betweenRight
+
+
+# what a node remembers about the owners of keys it looked up,
+# and optionally the files it fetched
+# both are bounded LRU caches whose entries expire after ttl seconds
+class lookupCache(object):
+    def __init__(self, capacity=1024, ttl=30, fileCapacity=0):
+        self._capacity = capacity
+        self._ttl = ttl
+        self._fileCapacity = fileCapacity
+
+        # hi -> [lo, owner, expires], the owner of keys in (lo, hi]
+        # ranges never overlap, so the end of a range identifies it
+        self._ranges = OrderedDict()
+        self._ends = []
+
+        # filename -> [path, size, expires]
+        self._files = OrderedDict()
+
+        self._lock = RLock()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidations = 0
+        self.fileHits = 0
+        self.fileMisses = 0
+
+    # the owner of key, None if it is not known
+    def owner(self, key):
+        with self._lock:
+            if len(self._ends) == 0:
+                self.misses += 1
+                return None
+            hi = self._ends[bisect_left(self._ends, key) % len(self._ends)]
+            lo, owner, expires = self._ranges[hi]
+            if lo != hi and not betweenRight(key, lo, hi):
+                self.misses += 1
+                return None
+            if monotonic() > expires:
+                self._dropRange(hi)
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._ranges.move_to_end(hi)
+            self.hits += 1
+            return owner
+
+    # owner owns the keys in (lo, hi]
+    # lo == hi stands for the whole ring
+    def put(self, lo, hi, owner):
+        with self._lock:
+            for end, (start, _, _) in list(self._ranges.items()):
+                if start == end or lo == hi or \
+                        betweenRight(end, lo, hi) or \
+                        betweenRight(hi, start, end):
+                    self._dropRange(end)
+            self._ranges[hi] = [lo, owner, monotonic() + self._ttl]
+            insort(self._ends, hi)
+            while len(self._ranges) > self._capacity:
+                self._dropRange(next(iter(self._ranges)))
+
+    # forget every range owned by nodeID or containing it,
+    # the owners around nodeID changed
+    def invalidate(self, nodeID):
+        with self._lock:
+            for end, (start, owner, _) in list(self._ranges.items()):
+                if owner == nodeID or start == end or \
+                        betweenRight(nodeID, start, end):
+                    self._dropRange(end)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._ranges)
+            self._ranges.clear()
+            self._ends = []
+            self._files.clear()
+
+    # the path of a fetched file, None if it is not cached
+    def getFile(self, filename):
+        if self._fileCapacity < 1:
+            return None
+        with self._lock:
+            entry = self._files.get(filename)
+            if entry is None or monotonic() > entry[2]:
+                self._files.pop(filename, None)
+                self.fileMisses += 1
+                return None
+            self._files.move_to_end(filename)
+            self.fileHits += 1
+            return entry[0]
+
+    def putFile(self, filename, path, size):
+        if self._fileCapacity < 1:
+            return
+        with self._lock:
+            self._files[filename] = [path, size, monotonic() + self._ttl]
+            self._files.move_to_end(filename)
+            while len(self._files) > self._fileCapacity:
+                self._files.popitem(last=False)
+
+    # counters for the stats command
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "ranges": len(self._ranges),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit rate": "{0:.1f}%".format(
+                    100.0 * self.hits / lookups if lookups else 0.0),
+                "expired": self.expired,
+                "invalidations": self.invalidations,
+                "files": len(self._files),
+                "file hits": self.fileHits,
+            }
+
+    def _dropRange(self, hi):
+        del self._ranges[hi]
+        self._ends.pop(bisect_left(self._ends, hi))
@@ -0,0 +1,202 @@
+from threading import RLock
+from time import monotonic, time
+from random import Random
+
+import math
+
+from keySpace import distance
+
+# states of a member
+# of two claims with the same incarnation the later state wins
+alive, suspect, dead, left = "alive", "suspect", "dead", "left"
+stateRank = {alive: 0, suspect: 1, dead: 2, left: 2}
+stateCodes = {alive: "a", suspect: "s", dead: "d", left: "l"}
+codeStates = dict((v, k) for k, v in stateCodes.items())
+
+
+# SWIM-style membership list
+# every peer keeps the state of every peer it heard of, and the changes
+# it learned recently are piggybacked on the pings it sends
+# each change is sent retransmitFactor * log2(n) times, so that it
+# reaches every peer in O(log n) rounds without walking the ring
+# a peer hearing that it is suspected raises its incarnation and
+# tells everybody it is alive
+class memberList(object):
+    def __init__(self, nodeID, retransmitFactor=3, suspectTimeout=10,
+                 tombstoneTTL=300, seed=None):
+        self._nodeID = nodeID
+        self._retransmitFactor = retransmitFactor
+        self._suspectTimeout = suspectTimeout
+        self._tombstoneTTL = tombstoneTTL
+        self._rand = Random(seed)
+
+        # a restarted peer starts with a higher incarnation
+        # than any claim about its last life
+        self.incarnation = int(time())
+
+        # peer -> [state, incarnation, since]
+        self._members = dict()
+        # peer -> times its latest change is still to be sent
+        self._queue = dict()
+
+        self._lock = RLock()
+
+        # counters
+        self.updates = 0
+        self.refuted = 0
+
+        self._set(nodeID, alive, self.incarnation)
+
+    def __contains__(self, peer):
+        return peer in self._members
+
+    # the state of peer, None if we never heard of it
+    def state(self, peer):
+        with self._lock:
+            entry = self._members.get(peer)
+            return None if entry is None else entry[0]
+
+    # dead or left
+    def gone(self, peer):
+        return stateRank.get(self.state(peer), 0) == 2
+
+    # every peer believed to be alive, suspected ones included
+    def alivePeers(self):
+        with self._lock:
+            return sorted(peer for peer, entry in self._members.items()
+                          if stateRank[entry[0]] < 2)
+
+    # the next count live peers after this one on the ring
+    def successors(self, count):
+        peers = [p for p in self.alivePeers() if p != self._nodeID]
+        peers.sort(key=lambda p: distance(self._nodeID, p))
+        return peers[:count]
+
+    # the last count peers before this one on the ring,
+    # suspected ones are skipped
+    def predecessors(self, count):
+        with self._lock:
+            peers = [peer for peer, entry in self._members.items()
+                     if entry[0] == alive and peer != self._nodeID]
+        peers.sort(key=lambda p: distance(p, self._nodeID))
+        return peers[:count]
+
+    # up to count live peers other than exclude, picked at random
+    def randomPeers(self, count, exclude=()):
+        peers = [p for p in self.alivePeers()
+                 if p != self._nodeID and p not in exclude]
+        return self._rand.sample(peers, min(count, len(peers)))
+
+    # a claim about peer
+    # returns True if it changed what we know, it is then passed on
+    def apply(self, peer, state, incarnation):
+        with self._lock:
+            if peer == self._nodeID:
+                # somebody thinks we are gone, tell them otherwise
+                if state != alive and \
+                        self.state(peer) == alive and \
+                        incarnation >= self.incarnation:
+                    self.incarnation = incarnation + 1
+                    self._set(peer, alive, self.incarnation)
+                    self.refuted += 1
+                return False
+            entry = self._members.get(peer)
+            if entry is not None and (
+                    incarnation < entry[1] or
+                    (incarnation == entry[1] and
+                     stateRank[state] <= stateRank[entry[0]])):
+                return False
+            self._set(peer, state, incarnation)
+            return True
+
+    # we heard from peer, it is alive if we knew nothing about it
+    # returns True if peer is new to us
+    def heard(self, peer):
+        with self._lock:
+            if peer in self._members:
+                return False
+            self._set(peer, alive, 0)
+            return True
+
+    # suspect peer, it is declared dead unless it refutes
+    # within suspectTimeout seconds
+    def suspect(self, peer):
+        with self._lock:
+            entry = self._members.get(peer)
+            incarnation = 0 if entry is None else entry[1]
+            return self.apply(peer, suspect, incarnation)
+
+    # we leave gracefully
+    def leave(self):
+        with self._lock:
+            self._set(self._nodeID, left, self.incarnation)
+
+    # suspects which did not refute are dead now,
+    # and long gone peers are forgotten
+    # returns the peers declared dead
+    def expire(self, now=None):
+        now = monotonic() if now is None else now
+        found = []
+        with self._lock:
+            for peer, (state, incarnation, since) in \
+                    list(self._members.items()):
+                if state == suspect and \
+                        now - since > self._suspectTimeout:
+                    self._set(peer, dead, incarnation)
+                    found.append(peer)
+                elif stateRank[state] == 2 and peer != self._nodeID and \
+                        now - since > self._tombstoneTTL:
+                    del self._members[peer]
+                    self._queue.pop(peer, None)
+        return found
+
+    # the changes to send with the next message, "peer/state/incarnation"
+    # joined with ";", the least sent first
+    def piggyback(self, limit=16):
+        with self._lock:
+            peers = sorted(self._queue, key=self._queue.get,
+                           reverse=True)[:limit]
+            items = []
+            for peer in peers:
+                state, incarnation, since = self._members[peer]
+                items.append("{0}/{1}/{2}".format(
+                    peer, stateCodes[state], incarnation))
+                self._queue[peer] -= 1
+                if self._queue[peer] <= 0:
+                    del self._queue[peer]
+            return ";".join(items)
+
+    # apply the changes piggybacked by another peer
+    # returns (peer, state) of every change new to us
+    def merge(self, text):
+        changes = []
+        if not text:
+            return changes
+        for item in text.split(";"):
+            try:
+                peer, code, incarnation = item.split("/")
+                peer, state = int(peer), codeStates[code]
+                incarnation = int(incarnation)
+            except (ValueError, KeyError):
+                continue
+            if self.apply(peer, state, incarnation):
+                changes.append((peer, state))
+        return changes
+
+    # counters for the stats command
+    def stats(self):
+        with self._lock:
+            counts = dict.fromkeys((alive, suspect, dead, left), 0)
+            for state, incarnation, since in self._members.values():
+                counts[state] += 1
+            counts["queued"] = len(self._queue)
+            counts["updates"] = self.updates
+            counts["refuted"] = self.refuted
+            return counts
+
+    def _set(self, peer, state, incarnation):
+        self._members[peer] = [state, incarnation, monotonic()]
+        n = max(1, len(self._members))
+        self._queue[peer] = self._retransmitFactor * \
+            int(math.ceil(math.log2(n + 1)))
+        self.updates += 1
@@ -0,0 +1,228 @@
+from threading import Lock
+from bisect import bisect_left
+from time import time
+
+import json
+import math
+import re
+import os
+
+# upper bounds of the latency buckets in seconds
+latencyBuckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                  0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+
+# upper bounds of the hop buckets
+hopBuckets = (0, 1, 2, 3, 4, 5, 6, 8, 10, 12, 16, math.inf)
+
+# upper bounds of the compression ratio buckets
+ratioBuckets = (1.0, 1.25, 1.5, 2.0, 3.0, 4.0, 6.0, 8.0, 12.0, 16.0, math.inf)
+
+
+# counts of values falling into fixed buckets, as scraped by Prometheus
+# quantiles are the upper bound of the bucket they fall into,
+# which is exact enough to tell a slow peer from a fast one
+class histogram(object):
+    def __init__(self, bounds=latencyBuckets):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def toDict(self):
+        return {"count": self.count, "sum": self.sum, "max": self.max,
+                "buckets": dict(zip(map(str, self.bounds), self.counts))}
+
+
+# counters and latency of every operation handled by a node
+# latency is measured from the moment a request was queued
+# until its handler returned, so it includes the queue wait
+# every other measurement is a named counter or histogram,
+# see DHTNode for the names
+class opStats(object):
+    def __init__(self):
+        self._lock = Lock()
+
+        # operation -> histogram of its handling time
+        self._ops = dict()
+
+        # name -> value, and name -> histogram
+        self._counters = dict()
+        self._histograms = dict()
+
+        # depth of the operation queue when the last request
+        # was taken out of it, and the deepest it has been
+        self.depth = 0
+        self.maxDepth = 0
+
+    def observeDepth(self, depth):
+        with self._lock:
+            self.depth = depth
+            if depth > self.maxDepth:
+                self.maxDepth = depth
+
+    def record(self, opr, seconds):
+        with self._lock:
+            entry = self._ops.get(opr)
+            if entry is None:
+                entry = histogram()
+                self._ops[opr] = entry
+            entry.observe(seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name, value, bounds=latencyBuckets):
+        with self._lock:
+            entry = self._histograms.get(name)
+            if entry is None:
+                entry = histogram(bounds)
+                self._histograms[name] = entry
+            entry.observe(value)
+
+    # operation -> (count, mean seconds, max seconds)
+    def snapshot(self):
+        with self._lock:
+            return dict((opr, (h.count, h.mean(), h.max))
+                        for opr, h in self._ops.items())
+
+    # human-readable lines for the stats command
+    def summary(self):
+        lines = ["queue depth: {0}, max queue depth: {1}".format(
+            self.depth, self.maxDepth)]
+        with self._lock:
+            for opr, h in sorted(self._ops.items()):
+                lines.append("{0}: {1} handled, mean {2:.2f} ms, "
+                             "p99 {3:.2f} ms, max {4:.2f} ms".format(
+                                 opr, h.count, h.mean() * 1000,
+                                 h.quantile(0.99) * 1000, h.max * 1000))
+            for name, h in sorted(self._histograms.items()):
+                lines.append("{0}: {1} seen, mean {2:.4g}, p50 {3:.4g}, "
+                             "p99 {4:.4g}, max {5:.4g}".format(
+                                 name, h.count, h.mean(), h.quantile(0.5),
+                                 h.quantile(0.99), h.max))
+            if self._counters:
+                lines.append(", ".join(
+                    "{0}: {1}".format(k, v)
+                    for k, v in sorted(self._counters.items())))
+        return lines
+
+    def toDict(self):
+        with self._lock:
+            return {"depth": self.depth, "maxDepth": self.maxDepth,
+                    "ops": dict((opr, h.toDict())
+                                for opr, h in self._ops.items()),
+                    "counters": dict(self._counters),
+                    "histograms": dict((name, h.toDict()) for name, h
+                                       in self._histograms.items())}
+
+    # the Prometheus text format, every sample labelled with labels
+    # extra counters such as those of the connection pool are added
+    def prometheus(self, labels, extra=None):
+        base = ",".join('{0}="{1}"'.format(k, v)
+                        for k, v in sorted(labels.items()))
+        lines = []
+        with self._lock:
+            lines.append("# TYPE dht_queue_depth gauge")
+            lines.append("dht_queue_depth{{{0}}} {1}".format(base, self.depth))
+            lines.append("# TYPE dht_queue_depth_max gauge")
+            lines.append("dht_queue_depth_max{{{0}}} {1}".format(
+                base, self.maxDepth))
+            lines.append("# TYPE dht_op_seconds histogram")
+            for opr, h in sorted(self._ops.items()):
+                lines.extend(promHistogram(
+                    "dht_op_seconds", '{0},op="{1}"'.format(base, opr), h))
+            for name, h in sorted(self._histograms.items()):
+                metric = "dht_" + snakeCase(name)
+                lines.append("# TYPE {0} histogram".format(metric))
+                lines.extend(promHistogram(metric, base, h))
+            counters = dict(self._counters)
+        counters.update(extra or {})
+        for name, value in sorted(counters.items()):
+            metric = "dht_{0}_total".format(snakeCase(name))
+            lines.append("# TYPE {0} counter".format(metric))
+            lines.append("{0}{{{1}}} {2}".format(metric, base, value))
+        return "\n".join(lines) + "\n"
+
+
+def promHistogram(metric, labels, h):
+    lines = []
+    seen = 0
+    for bound, count in zip(h.bounds, h.counts):
+        seen += count
+        le = "+Inf" if bound == math.inf else repr(bound)
+        lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+            metric, labels, le, seen))
+    lines.append("{0}_sum{{{1}}} {2}".format(metric, labels, h.sum))
+    lines.append("{0}_count{{{1}}} {2}".format(metric, labels, h.count))
+    return lines
+
+
+def snakeCase(name):
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+
+
+# write text to path in one rename, so a scraper never reads half of it
+def writeAtomic(path, text):
+    tmpPath = path + ".tmp"
+    with open(tmpPath, "w") as file:
+        file.write(text)
+    os.replace(tmpPath, path)
+
+
+# the path a request took through the ring
+# every peer appends what it did with a request to its own
+# trace<ID>.jsonl, keyed by the request stamp which is kept across
+# hops, so that the files of all peers together show every hop
+# only one stamp in sample is traced, every peer picks the same ones
+class traceLog(object):
+    def __init__(self, path, sample=1):
+        self._path = path
+        self._sample = max(1, sample)
+        self._file = open(path, "a")
+        self._lock = Lock()
+
+    def wants(self, stamp):
+        return stamp % self._sample == 0
+
+    def event(self, stamp, peer, what, **fields):
+        if not self.wants(stamp):
+            return
+        fields.update(stamp=stamp, peer=peer, what=what, time=time())
+        line = json.dumps(fields, sort_keys=True)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,75 @@
+from threading import Lock
+
+import json
+
+from metrics import writeAtomic
+
+
+# the routing state of a peer, kept in a file next to its data so that
+# a restarted peer can take its old place back without walking the ring
+# the keys are not in it, the store index survives restarts on its own
+# the file is only written again once the state changed
+# the workers of a threaded peer save at the same time
+class nodeSnapshot(object):
+    def __init__(self, path):
+        self._path = path
+        self._saved = None
+        self._lock = Lock()
+        self.writes = 0
+
+    # state holds the successors, the predecessor and the fingers
+    # returns True if the file was written
+    def save(self, state):
+        text = json.dumps(state, sort_keys=True)
+        with self._lock:
+            if text == self._saved:
+                return False
+            writeAtomic(self._path, text)
+            self._saved = text
+            self.writes += 1
+        return True
+
+    # the state saved last, None if there is none or it is broken
+    def load(self):
+        try:
+            with open(self._path) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(state, dict) or \
+                not all(k in state for k in ("_firstID", "_secondID",
+                                              "pred", "fingers")):
+            return None
+        return state
+
+
+# the peers a peer restarted from state asks about its old place,
+# its predecessor first
+def recordedPeers(state, nodeID):
+    peers = []
+    for field in ("pred", "_firstID", "_secondID"):
+        peer = state.get(field)
+        if peer is not None and peer != nodeID and peer not in peers:
+            peers.append(peer)
+    return peers
+
+
+# can nodeID take the place recorded in state back
+# replies holds peer -> content of its hopped reply for the recorded
+# peers which answered
+# the predecessor and the first successor have to be alive, and the
+# predecessor still has nodeID or that successor after it, or else a
+# peer joined in between and the place is not ours any more
+# returns (predecessor, first successor, second successor),
+# None if the peer has to join again
+def rejoinPlace(state, nodeID, replies):
+    pred, first = state.get("pred"), state.get("_firstID")
+    if pred is None or first is None or nodeID in (pred, first) or \
+            pred not in replies or first not in replies:
+        return None
+    if int(replies[pred]["_firstID"]) not in (nodeID, first):
+        return None
+    second = int(replies[first]["_firstID"])
+    if second == first:
+        second = nodeID
+    return pred, first, second
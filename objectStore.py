@@ -0,0 +1,300 @@
+from threading import RLock
+from bisect import bisect_left, bisect_right
+
+import json
+import os
+
+import keySpace
+
+
+# what a peer knows about one stored file
+class storeEntry(object):
+    __slots__ = ("name", "key", "path", "size", "mtime")
+
+    def __init__(self, name, key, path=None, size=0, mtime=0):
+        self.name = name
+        self.key = key
+
+        # where the file is in the data directory, None if it is not there
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+
+    def toDict(self):
+        return {"name": self.name, "key": self.key, "path": self.path,
+                "size": self.size, "mtime": self.mtime}
+
+
+# the files a peer keeps track of
+# every filename is indexed, so a lookup never scans the data directory,
+# and grouped by hash so that a range of keys can be handed over
+# every change is appended to an index file which is replayed at startup
+class objectStore(object):
+    def __init__(self, dataDir, indexPath, toHash):
+        self._dataDir = dataDir
+        self._indexPath = indexPath
+        self._toHash = toHash
+
+        # filename -> storeEntry
+        self._entries = dict()
+
+        # hash -> set of filenames
+        self._byHash = dict()
+
+        # the hashes in order for paging, None after they changed
+        self._keys = None
+
+        # the data directory, stem -> file name
+        # it is rebuilt only when the directory itself changed
+        self._files = dict()
+        self._dirMtime = None
+
+        # number of lines in the index file
+        self._logLines = 0
+        self._log = None
+
+        self._lock = RLock()
+        self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, filename):
+        return filename in self._entries
+
+    # hash -> set of filenames, the old localHashTable
+    # a copy, the store changes under the caller otherwise
+    def hashTable(self):
+        with self._lock:
+            return dict((key, set(names))
+                        for key, names in self._byHash.items())
+
+    # keep track of filename
+    # returns its entry, or None if filename is not valid
+    def put(self, filename):
+        with self._lock:
+            entry = self._put(filename)
+            self._flush()
+            return entry
+
+    # keep track of many files at once, the index file is flushed once
+    # returns the number of valid filenames
+    def putMany(self, filenames):
+        count = 0
+        with self._lock:
+            for filename in filenames:
+                if self._put(filename) is not None:
+                    count += 1
+            self._flush()
+        return count
+
+    # the entry of filename with an up-to-date path, size and mtime
+    # returns None if filename is not kept here
+    def get(self, filename):
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                return None
+            self._locate(entry)
+            return entry
+
+    def remove(self, filename):
+        with self._lock:
+            entry = self._remove(filename)
+            self._flush()
+            return entry
+
+    def removeMany(self, filenames):
+        with self._lock:
+            for filename in filenames:
+                self._remove(filename)
+            self._flush()
+
+    # every entry, in no particular order
+    def entries(self):
+        with self._lock:
+            return list(self._entries.values())
+
+    # the entries whose hash satisfies match
+    def select(self, match):
+        with self._lock:
+            return [self._entries[name]
+                    for key, names in self._byHash.items() if match(key)
+                    for name in names]
+
+    # up to limit entries with hashes in (lo, hi], in ring order from lo
+    # and by name within a hash, following the entry named after
+    # lo == hi stands for the whole ring
+    # a scan goes on from the last name of its page, so files coming
+    # and going between pages never make it repeat or skip the others
+    # within = (a, b) keeps only the hashes in (a, b] as well
+    def page(self, lo, hi, limit, after=None, within=None):
+        with self._lock:
+            if self._keys is None:
+                self._keys = sorted(self._byHash)
+            keys = self._keys
+            end = keySpace.distance(lo, hi) or keySpace.ringSize
+            if after is None:
+                first, afterKey = bisect_right(keys, lo), None
+            else:
+                afterKey = self._toHash(after)
+                first = bisect_left(keys, afterKey)
+
+            entries = []
+            last = 0
+            for i in range(len(keys)):
+                key = keys[(first + i) % len(keys)]
+                position = keySpace.distance(lo, key) or keySpace.ringSize
+                # past hi, or round the ring back to lo
+                if position > end or position < last:
+                    break
+                last = position
+                if within is not None and not 0 < keySpace.distance(
+                        within[0], key) <= (keySpace.distance(*within) or
+                                            keySpace.ringSize):
+                    continue
+                names = sorted(self._byHash[key])
+                if key == afterKey:
+                    names = names[bisect_right(names, after):]
+                for name in names:
+                    entries.append(self._entries[name])
+                    if len(entries) == limit:
+                        return entries
+            return entries
+
+    # replay the index file, then rewrite it without the history
+    def load(self):
+        with self._lock:
+            if os.path.exists(self._indexPath):
+                with open(self._indexPath, "r") as file:
+                    for line in file:
+                        try:
+                            item = json.loads(line)
+                        except ValueError:
+                            # the last line of a crashed peer
+                            continue
+                        self._replay(item)
+            self.compact()
+
+    # rewrite the index file with one line per entry
+    def compact(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+            tmpPath = self._indexPath + ".tmp"
+            with open(tmpPath, "w") as file:
+                for entry in self._entries.values():
+                    file.write(json.dumps(
+                        dict(entry.toDict(), op="put")) + "\n")
+            os.replace(tmpPath, self._indexPath)
+            self._logLines = len(self._entries)
+            self._log = open(self._indexPath, "a")
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    def _replay(self, item):
+        name = item["name"]
+        if item["op"] == "del":
+            self._remove(name)
+            return
+        entry = storeEntry(name, item["key"], item.get("path"),
+                           item.get("size", 0), item.get("mtime", 0))
+        self._entries[name] = entry
+        self._byHash.setdefault(entry.key, set()).add(name)
+        self._keys = None
+
+    def _put(self, filename):
+        key = self._toHash(filename)
+        if key is None:
+            return None
+        entry = self._entries.get(filename)
+        if entry is None:
+            entry = storeEntry(filename, key)
+            self._entries[filename] = entry
+            if key not in self._byHash:
+                self._keys = None
+            self._byHash.setdefault(key, set()).add(filename)
+        self._locate(entry)
+        self._append("put", entry)
+        return entry
+
+    def _remove(self, filename):
+        entry = self._entries.pop(filename, None)
+        if entry is None:
+            return None
+        names = self._byHash.get(entry.key)
+        if names is not None:
+            names.discard(filename)
+            if len(names) == 0:
+                del self._byHash[entry.key]
+                self._keys = None
+        self._append("del", entry)
+        return entry
+
+    def _append(self, op, entry):
+        if self._log is None:
+            return
+        self._log.write(json.dumps(dict(entry.toDict(), op=op)) + "\n")
+        self._logLines += 1
+
+    def _flush(self):
+        if self._log is None:
+            return
+        self._log.flush()
+        # most of the file is history, start again
+        if self._logLines > 2 * len(self._entries) + 1024:
+            self.compact()
+
+    # refresh path, size and mtime of entry
+    # the data directory is only listed when a file is missing from it
+    # and the directory changed since it was listed last
+    def _locate(self, entry):
+        if entry.path is not None:
+            try:
+                st = os.stat(entry.path)
+                entry.size = st.st_size
+                entry.mtime = st.st_mtime
+                return
+            except OSError:
+                entry.path = None
+
+        name = self._files.get(entry.name)
+        if name is None and self._refreshFiles():
+            name = self._files.get(entry.name)
+        if name is None:
+            entry.size = 0
+            entry.mtime = 0
+            return
+        entry.path = os.path.join(self._dataDir, name)
+        try:
+            st = os.stat(entry.path)
+            entry.size = st.st_size
+            entry.mtime = st.st_mtime
+        except OSError:
+            entry.path = None
+
+    # list the data directory if it changed
+    # returns True if it was listed
+    def _refreshFiles(self):
+        try:
+            mtime = os.stat(self._dataDir).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._dirMtime:
+            return False
+        with os.scandir(self._dataDir) as it:
+            names = [item.name for item in it if item.is_file()]
+        # "report.v2.txt" is the file of key report.v2, only the last
+        # extension comes off, and a file named exactly like a key is
+        # the file of that key before any other
+        files = dict()
+        for name in names:
+            files.setdefault(name.rsplit(".", 1)[0], name)
+        files.update((name, name) for name in names)
+        self._files = files
+        self._dirMtime = mtime
+        return True
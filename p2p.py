@@ -1,32 +1,134 @@
-from DHTNode import DHTNode
+from DHTNode import DHTNode, replicaFactor, checkRing, stabilizeInterval
+from keySpace import virtualIDs
+import argparse
+import keySpace
+import admission
 import sys
 
+usage = """python3 p2p.py [options] init ID FIRST SECOND PING
+       python3 p2p.py [options] join ID KNOWN PING
+       python3 p2p.py [options] restart ID PING [KNOWN]"""
+
+
+# the other virtual nodes of node join the DHT through it once
+# it has a predecessor, and leave once it stopped
+def hostVirtual(node, count, pingInterval, **nodeArgs):
+    while node._predecessor() is None:
+        if node.wait(1):
+            return
+    hosted = []
+    # a position taken by another peer is skipped
+    for vID in virtualIDs(node._nodeID, 4 * count)[1:]:
+        if len(hosted) == count - 1:
+            break
+        vnode = DHTNode(vID, pingInterval, interactive=False, **nodeArgs)
+        try:
+            vnode.start("join", knownNode=node._nodeID)
+        except OSError:
+            print("Virtual node {0} is taken".format(vID))
+            continue
+        hosted.append(vnode)
+    print("Peer {0} hosts virtual nodes {1}".format(
+        node._nodeID, ", ".join(str(v._nodeID) for v in hosted)))
+    node.wait()
+    for vnode in hosted:
+        vnode.quit()
+        vnode.wait()
 
-def main():
 
-    requestType = sys.argv[1]
-    ID = ""
-    firstSuccessor = ""
-    secondSuccessor = ""
-    pingInterval = ""
-    knownNode = ""
+def parseArgs():
+    parser = argparse.ArgumentParser(usage=usage)
+    parser.add_argument("startType", metavar="init|join|restart")
+    parser.add_argument("numbers", nargs="*", type=int,
+                        help="the IDs and ping interval of the start type")
+    parser.add_argument("--async", dest="useAsync", action="store_true",
+                        help="run the peer on an asyncio event loop")
+    parser.add_argument("--quiet", action="store_true",
+                        help="do not print every ping and request handled")
+    parser.add_argument("--replicas", type=int, default=replicaFactor,
+                        help="copy every key to N successors")
+    parser.add_argument("--cache-files", type=int, default=0,
+                        help="keep the last N fetched files at hand")
+    parser.add_argument("--compress", type=int, default=0,
+                        help="send files as zlib streams at LEVEL 1 to 9 "
+                        "to peers accepting them, small or incompressible "
+                        "files go as they are")
+    parser.add_argument("--queue-limit", type=int,
+                        default=admission.queueLimit,
+                        help="refuse new store and request work with a "
+                        "busy reply once N requests wait for a worker")
+    parser.add_argument("--stabilize", type=float,
+                        default=stabilizeInterval,
+                        help="ask the first successor for its predecessor "
+                        "every SECONDS to repair the ring after "
+                        "concurrent joins")
+    parser.add_argument("--metrics",
+                        help="write the metrics of the peer to "
+                        "DIR/peer<ID>.prom")
+    parser.add_argument("--trace", type=int, default=0,
+                        help="follow one request in N through the ring, "
+                        "in DIR/trace<ID>.jsonl")
+    # every peer of the DHT needs the same ring and hash
+    parser.add_argument("--ring-bits", type=int,
+                        help="make the ring 2 ** N IDs wide")
+    parser.add_argument("--hash", choices=sorted(keySpace.hashFunctions),
+                        help="hash names with this function")
+    parser.add_argument("--vnodes", type=int, default=1,
+                        help="place this peer at N positions of the ring, "
+                        "the others are hosted by this process as well")
+    # options may come before, between or after the numbers
+    return parser, parser.parse_intermixed_args()
 
-    requestType = requestType.lower()
 
-    ID = sys.argv[2]
+# the numbers each start type takes after it
+startNumbers = {"init": (4,), "join": (3,), "restart": (2, 3)}
+
+
+def main():
+    parser, args = parseArgs()
+    keySpace.configure(args.ring_bits, args.hash)
+    checkRing()
+
+    requestType = args.startType.lower()
+    if requestType not in startNumbers:
+        print("Unknown start type {0}".format(args.startType))
+        parser.print_usage()
+        sys.exit(2)
+    if len(args.numbers) not in startNumbers[requestType]:
+        parser.error("wrong number of arguments for " + requestType)
+
     if requestType == "init":
-        firstSuccessor = sys.argv[3]
-        secondSuccessor = sys.argv[4]
-        pingInterval = sys.argv[5]
-        node = DHTNode(int(ID), int(pingInterval))
-        node.start("init", fst=int(firstSuccessor), snd=int(
-            secondSuccessor))
+        ID, firstSuccessor, secondSuccessor, pingInterval = args.numbers
+        kwargs = {"fst": firstSuccessor, "snd": secondSuccessor}
 
     elif requestType == "join":
-        knownNode = sys.argv[3]
-        pingInterval = sys.argv[4]
-        node = DHTNode(int(ID), int(pingInterval))
-        node.start("join", knownNode=int(knownNode))
+        ID, knownNode, pingInterval = args.numbers
+        kwargs = {"knownNode": knownNode}
+
+    # restart where the snapshot of the peer left it, or join through
+    # the known node if given and the ring changed meanwhile
+    else:
+        ID, pingInterval = args.numbers[:2]
+        kwargs = {"knownNode": args.numbers[2]
+                  if len(args.numbers) > 2 else None}
+
+    # what every peer of this process is made with
+    nodeArgs = {"replicas": args.replicas, "cacheFiles": args.cache_files,
+                "verbose": not args.quiet, "metricsDir": args.metrics,
+                "traceSample": args.trace,
+                "compressLevel": args.compress, "control": True,
+                "queueLimit": args.queue_limit,
+                "stabilizeInterval": args.stabilize}
+
+    if args.useAsync:
+        from asyncNode import runNode
+        runNode(ID, pingInterval, requestType, vnodes=args.vnodes,
+                **nodeArgs, **kwargs)
+    else:
+        node = DHTNode(ID, pingInterval, **nodeArgs)
+        node.start(requestType, **kwargs)
+        if args.vnodes > 1:
+            hostVirtual(node, args.vnodes, pingInterval, **nodeArgs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+from time import thread_time
+
+import zlib
+import os
+
+# the codecs a receiver accepts, offered by the sender in the transfer
+# request and confirmed by the receiver in its ready reply
+codecs = ("zlib",)
+
+# files smaller than minSize are always sent raw
+minSize = 16 << 10
+
+# a file is only compressed if its first sampleSize bytes
+# shrink below worthRatio of their size
+sampleSize = 16 << 10
+worthRatio = 0.9
+
+# the file is read and compressed blockSize bytes at a time
+blockSize = 256 << 10
+
+
+# is the file at path worth compressing at level
+# level 0 turns compression off
+def worthCompressing(path, level):
+    if level <= 0 or os.path.getsize(path) < minSize:
+        return False
+    with open(path, "rb") as file:
+        sample = file.read(sampleSize)
+    return len(zlib.compress(sample, level)) < worthRatio * len(sample)
+
+
+# the sending side of a zlib stream
+# blocks() yields the compressed file block by block and counts
+# the bytes read, the bytes sent and the CPU seconds spent on them
+class zlibStream(object):
+    def __init__(self, path, level):
+        self._path = path
+        self._level = level
+        self.raw = 0
+        self.wire = 0
+        self.cpu = 0.0
+
+    def blocks(self):
+        compressor = zlib.compressobj(self._level)
+        with open(self._path, "rb") as file:
+            while True:
+                data = file.read(blockSize)
+                begin = thread_time()
+                out = compressor.compress(data) if data \
+                    else compressor.flush()
+                self.cpu += thread_time() - begin
+                self.raw += len(data)
+                self.wire += len(out)
+                if out:
+                    yield out
+                if not data:
+                    return
+
+    def ratio(self):
+        return self.raw / self.wire if self.wire else 0.0
+
+    def __str__(self):
+        return describe(self)
+
+
+# the receiving side of a zlib stream, writing what it decompressed
+# to file, done once the end of the stream arrived
+class zlibSink(object):
+    def __init__(self, file):
+        self._file = file
+        self._decompressor = zlib.decompressobj()
+        self.raw = 0
+        self.wire = 0
+        self.cpu = 0.0
+
+    def feed(self, data):
+        begin = thread_time()
+        out = self._decompressor.decompress(data)
+        self.cpu += thread_time() - begin
+        self.wire += len(data) - len(self._decompressor.unused_data)
+        self.raw += len(out)
+        self._file.write(out)
+
+    @property
+    def done(self):
+        return self._decompressor.eof
+
+    def ratio(self):
+        return self.raw / self.wire if self.wire else 0.0
+
+    def __str__(self):
+        return describe(self)
+
+
+# a line about a stream or sink for the log
+def describe(codec):
+    return "zlib {0:.2f}x, {1} bytes on the wire, {2:.1f} ms CPU".format(
+        codec.ratio(), codec.wire, codec.cpu * 1000)